@@ -1,12 +1,20 @@
+from datetime import datetime
+
+from django.contrib.auth.models import User
 from django.db.models import F
 from rest_framework.status import HTTP_403_FORBIDDEN
 
 from tc_instruments.models import BaseInstrument
 
 from accounts.service import AccountService
-from trade.models import Instrument, FavoriteInstrument, ClientTrade
-from trade.serializers import InstrumentSerializer, PositionSerializer, PositionCreateSerializer, PositionCloseSerializer, ClientTradeSerializer, RequiredMarginSerializer, PlaceOrderSerializer, CancelOrderSerializer, OrderSerializer
-from trade.service import TradeService, InstrumentNotTradeable, Overdraft, WrongAmount
+from trade.models import Instrument, FavoriteInstrument, ClientTrade, ArchivedPosition, ArchivedClientTrade
+from trade.serializers import InstrumentSerializer, PositionSerializer, PositionCreateSerializer, PositionCloseSerializer, ClientTradeSerializer, RequiredMarginSerializer, PlaceOrderSerializer, CancelOrderSerializer, OrderSerializer, FavoriteReorderSerializer
+from trade.service import TradeService, InstrumentNotTradeable, Overdraft, WrongAmount, WrongExpiry
+from trade.db_router import ReplicaReadMixin, stick_to_primary
+from trade.archive import ArchiveHistoryMixin
+from trade.fix_audit import FixAuditService, WrongCursor
+from trade.equity_curve import EquityCurveService
+from trade.leaderboard import Leaderboard, METRICS, OVERALL, asset_class_board, instrument_board
 
 from rest_framework import status, permissions, viewsets, mixins, generics
 from rest_framework.response import Response
@@ -36,7 +44,12 @@ class OverdraftApi(APIException):
     status_code = HTTP_403_FORBIDDEN
 
 
-class InstrumentViewSet(viewsets.ModelViewSet):
+class WrongExpiryApi(APIException):
+    detail = "Wrong expiry provided for the order"
+    status_code = HTTP_403_FORBIDDEN
+
+
+class InstrumentViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     lookup_field = 'symbol'
     model = Instrument
     serializer_class = InstrumentSerializer
@@ -127,6 +140,20 @@ class InstrumentViewSet(viewsets.ModelViewSet):
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+class FavoriteReorderViewSet(viewsets.GenericViewSet):
+    serializer_class = FavoriteReorderSerializer
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def create(self, request):
+        serializer = FavoriteReorderSerializer(data=request.DATA)
+        if serializer.is_valid():
+            object = serializer.save()
+            FavoriteInstrument.reorder(request.user.id, object['instrument_ids'])
+            stick_to_primary(request.user.id)
+            return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class ModelViewSetStripped(#mixins.CreateModelMixin,
                     mixins.RetrieveModelMixin,
                     #mixins.UpdateModelMixin,
@@ -141,7 +168,7 @@ class ModelViewSetStripped(#mixins.CreateModelMixin,
 
 
 #region Positions
-class OpenPositionsViewSet(ModelViewSetStripped):
+class OpenPositionsViewSet(ReplicaReadMixin, ModelViewSetStripped):
     serializer_class = PositionSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
@@ -149,7 +176,7 @@ class OpenPositionsViewSet(ModelViewSetStripped):
         return AccountService(self.request.user).user_current_open_positions()
 
 
-class ClosedPositionsViewSet(viewsets.ModelViewSet):
+class ClosedPositionsViewSet(ReplicaReadMixin, ArchiveHistoryMixin, viewsets.ModelViewSet):
     serializer_class = PositionSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     paginate_by = 10
@@ -157,6 +184,9 @@ class ClosedPositionsViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return AccountService(self.request.user).user_history_by_positions()
 
+    def get_archived_queryset(self):
+        return ArchivedPosition.objects.filter(user=self.request.user)
+
 
 class CreatePositionViewSet(viewsets.GenericViewSet):
     serializer_class = PositionCreateSerializer
@@ -211,13 +241,42 @@ class PlaceOrderViewSet(viewsets.GenericViewSet):
         if serializer.is_valid():
             object = serializer.save()
             object['user'] = request.user
-            order_id = TradeService.place_conditional_order(**object)
+            try:
+                order_id = TradeService.place_conditional_order(**object)
+            except WrongExpiry:
+                raise WrongExpiryApi
             result = {'order_id': order_id}
             result.update(serializer.data)
             return Response(result, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class PlaceOrderGroupViewSet(viewsets.GenericViewSet):
+    """
+    Places linked one-cancels-other orders, `orders` is a list of PlaceOrderSerializer payloads
+    """
+    serializer_class = PlaceOrderSerializer
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly, )
+
+    def create(self, request):
+        legs_data = request.DATA.get('orders')
+        if not isinstance(legs_data, list) or len(legs_data) < 2:
+            return Response({'orders': ['Should be a list of at least two orders']}, status=status.HTTP_400_BAD_REQUEST)
+
+        legs = []
+        for leg_data in legs_data:
+            serializer = PlaceOrderSerializer(data=leg_data)
+            if not serializer.is_valid():
+                return Response({'orders': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+            legs.append(serializer.save())
+
+        try:
+            group_id, order_ids = TradeService.place_order_group(request.user, legs)
+        except WrongExpiry:
+            raise WrongExpiryApi
+        return Response({'group_id': group_id, 'order_ids': order_ids}, status=status.HTTP_201_CREATED)
+
+
 class CancelOrderViewSet(viewsets.GenericViewSet):
     serializer_class = CancelOrderSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly, )
@@ -232,7 +291,7 @@ class CancelOrderViewSet(viewsets.GenericViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PendingOrdersViewSet(ModelViewSetStripped):
+class PendingOrdersViewSet(ReplicaReadMixin, ModelViewSetStripped):
     serializer_class = OrderSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
@@ -241,6 +300,73 @@ class PendingOrdersViewSet(ModelViewSetStripped):
 #endregion Orders
 
 
+class AccountSnapshotViewSet(ReplicaReadMixin, viewsets.GenericViewSet):
+    """
+    Open positions with uPnL, pending orders, margin totals and today's realized PnL in one call
+    """
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def list(self, request):
+        return Response(TradeService.get_account_snapshot(request.user))
+
+
+class EquityCurveViewSet(ReplicaReadMixin, viewsets.GenericViewSet):
+    """
+    Daily equity, returns and drawdown of the user up to the last complete day
+    """
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def list(self, request):
+        curve = EquityCurveService.get_curve(request.user)
+        if curve is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(curve)
+
+
+class LeaderboardViewSet(viewsets.GenericViewSet):
+    """
+    Top traders by `metric` (pnl or win_rate), overall or for an `asset_class` or `instrument` slug,
+    with the rank of the requesting user
+    """
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly, )
+
+    def list(self, request):
+        params = request.QUERY_PARAMS
+        metric = params.get('metric', METRICS[0])
+        board = OVERALL
+        try:
+            if metric not in METRICS:
+                raise ValueError(metric)
+            limit = min(int(params.get('limit', 10)), 100)
+            offset = int(params.get('offset', 0))
+            if params.get('instrument'):
+                board = instrument_board(Instrument.objects.get(url_slug=params['instrument']).pk)
+            elif params.get('asset_class'):
+                asset_classes = dict(BaseInstrument.ASSET_CLASSES)
+                asset_classes = dict(zip(asset_classes.values(), asset_classes.keys()))
+                board = asset_class_board(asset_classes[params['asset_class']])
+        except (ValueError, KeyError, Instrument.DoesNotExist):
+            return Response({'detail': 'Wrong query parameters'}, status=status.HTTP_400_BAD_REQUEST)
+
+        top = Leaderboard.top(board, metric, limit, offset)
+        users = User.objects.in_bulk([user_id for user_id, score in top])
+        me = None
+        if request.user.is_authenticated():
+            ranked = Leaderboard.rank(request.user.pk, board, metric)
+            if ranked is not None:
+                me = {'rank': ranked[0], 'score': ranked[1]}
+        return Response({
+            'count': Leaderboard.size(board, metric),
+            'results': [{
+                'rank': offset + index + 1,
+                'user_id': user_id,
+                'username': users[user_id].username if user_id in users else None,
+                'score': score,
+            } for index, (user_id, score) in enumerate(top)],
+            'me': me,
+        })
+
+
 class RequiredMarginViewSet(viewsets.GenericViewSet):
     serializer_class = RequiredMarginSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly, )
@@ -256,12 +382,58 @@ class RequiredMarginViewSet(viewsets.GenericViewSet):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class TradesViewSet(viewsets.ModelViewSet):
+class TradesViewSet(ReplicaReadMixin, ArchiveHistoryMixin, viewsets.ModelViewSet):
     serializer_class = ClientTradeSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
     def get_queryset(self):
         return ClientTrade.objects.filter(user=self.request.user, success=True)
 
+    def get_archived_queryset(self):
+        return ArchivedClientTrade.objects.filter(user=self.request.user, success=True)
 
 
+class FixTradeMsgViewSet(viewsets.GenericViewSet):
+    """
+    FIX audit trail lookups for support. Filters are position_id, house_trade_id, cl_ord_id, order_id,
+    exec_id, symbol and from/to epoch seconds, `cursor` is the `next` value of the previous page.
+    """
+    permission_classes = (permissions.IsAdminUser, )
+
+    def list(self, request):
+        params = request.QUERY_PARAMS
+        filters = dict((key, params[key]) for key in FixAuditService.FILTERS if params.get(key))
+        try:
+            for key in ('position_id', 'house_trade_id'):
+                if key in filters:
+                    filters[key] = int(filters[key])
+            dates = dict(
+                (name, datetime.utcfromtimestamp(int(params[name]))) for name in ('from', 'to') if params.get(name)
+            )
+            messages, cursor = FixAuditService.find(
+                date_from=dates.get('from'),
+                date_to=dates.get('to'),
+                cursor=params.get('cursor') or None,
+                limit=int(params.get('limit', 100)),
+                **filters
+            )
+        except (ValueError, WrongCursor):
+            return Response({'detail': 'Wrong query parameters'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'results': [{
+                'id': str(msg.id),
+                'way': msg.way,
+                'name': msg.name,
+                'date': msg.date,
+                'position_id': msg.position_id,
+                'house_trade_id': msg.house_trade_id,
+                'cl_ord_id': msg.cl_ord_id,
+                'order_id': msg.order_id,
+                'exec_id': msg.exec_id,
+                'symbol': msg.symbol,
+                'message': msg.message,
+                'body': msg.body,
+            } for msg in messages],
+            'next': cursor,
+        })
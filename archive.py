@@ -0,0 +1,304 @@
+"""
+Hot/cold split of the trading history. Closed positions untouched for ARCHIVE_RETENTION_DAYS are
+moved with their client trades to the archive tables, and old house trades no hot client trade
+points to follow them, so the hot tables only hold open and recent positions.
+
+Only this app's tables are changed. A row referenced from another table, like a wallet entry or
+a post, stays in the hot table so the reference keeps resolving, unless ARCHIVE_CLEARED_LINKS lists
+the nullable foreign key as 'app_label.model.field': its link is then kept in ArchivedReference
+and the foreign key cleared.
+"""
+from datetime import timedelta
+from operator import attrgetter
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from trade import consts
+from .models import Position, ClientTrade, HouseTrade, Order, ArchivedPosition, ArchivedClientTrade, ArchivedHouseTrade, \
+    ArchivedReference
+
+
+#foreign keys the archive moves or clears itself
+POSITION_LINKS = ((ClientTrade, 'position'), (Order, 'position'))
+HOUSE_TRADE_LINKS = ((ClientTrade, 'house_trade'), )
+
+
+def retention_horizon(now=None):
+    return (now or timezone.now()) - timedelta(days=getattr(settings, 'ARCHIVE_RETENTION_DAYS', 90))
+
+
+def _copy(source, target, column, ids, extra_columns=(), extra_values=(), params=()):
+    """
+    Copies the rows of `source` whose `column` is in `ids` to `target` with INSERT ... SELECT,
+    `extra_values` are SQL expressions for the archive only `extra_columns`
+    """
+    quote = connection.ops.quote_name
+    columns = [field.column for field in source._meta.local_fields]
+    connection.cursor().execute(
+        'INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s IN (%s)' % (
+            quote(target._meta.db_table),
+            ', '.join(quote(name) for name in columns + list(extra_columns)),
+            ', '.join([quote(name) for name in columns] + list(extra_values)),
+            quote(source._meta.db_table),
+            quote(column),
+            ', '.join(['%s'] * len(ids))
+        ),
+        list(params) + list(ids)
+    )
+
+
+def _delete(source, column, ids):
+    quote = connection.ops.quote_name
+    connection.cursor().execute(
+        'DELETE FROM %s WHERE %s IN (%s)' % (quote(source._meta.db_table), quote(column), ', '.join(['%s'] * len(ids))),
+        list(ids)
+    )
+
+
+def _cleared_links():
+    """
+    (model, field name) of the foreign keys ARCHIVE_CLEARED_LINKS allows the archive to clear
+    """
+    links = set()
+    for label in getattr(settings, 'ARCHIVE_CLEARED_LINKS', ()):
+        app_label, model_name, field = label.split('.')
+        links.add((apps.get_model(app_label, model_name), field))
+    return links
+
+
+def _references(model, handled=()):
+    """
+    Splits the foreign keys to `model`, but the `handled` ones, into [(model, field)] of the ones
+    that pin a referenced row to the hot table and of the allowed ones the archive clears
+    """
+    cleared = _cleared_links()
+    pinning = []
+    clearing = []
+    for related in model._meta.get_all_related_objects():
+        link = (related.model, related.field.name)
+        if link in handled:
+            continue
+        if link in cleared and related.field.null:
+            clearing.append((related.model, related.field))
+        else:
+            pinning.append((related.model, related.field))
+    return pinning, clearing
+
+
+def _pinned(references, ids):
+    """
+    Ids of `ids` referenced through the `references` foreign keys
+    """
+    pinned = set()
+    if not ids:
+        return pinned
+    for model, field in references:
+        pinned.update(model._default_manager.filter(**{'%s__in' % field.name: ids}).values_list(field.attname, flat=True))
+    return pinned
+
+
+def _repoint(references, ids, now):
+    """
+    Moves the links of the rows referencing `ids` to ArchivedReference and clears their foreign keys
+    """
+    if not ids:
+        return
+    quote = connection.ops.quote_name
+    for model, field in references:
+        sql = 'INSERT INTO %s (%s) SELECT %%s, %%s, %s, %s, %%s FROM %s WHERE %s IN (%s)' % (
+            quote(ArchivedReference._meta.db_table),
+            ', '.join(quote(name) for name in ('model', 'field', 'row_id', 'target_id', 'archive_date')),
+            quote(model._meta.pk.column),
+            quote(field.column),
+            quote(model._meta.db_table),
+            quote(field.column),
+            ', '.join(['%s'] * len(ids))
+        )
+        label = '%s.%s' % (model._meta.app_label, model._meta.model_name)
+        connection.cursor().execute(sql, [label, field.name, now] + list(ids))
+        model._default_manager.filter(**{'%s__in' % field.name: ids}).update(**{field.name: None})
+
+
+def archive_positions(before, batch_size, after=0):
+    """
+    Archives one batch of closed positions above the `after` id last modified before `before` with
+    their trades. Returns the last id of the batch, None past the last one, and the number of
+    positions moved, positions pinned by a reference stay behind.
+    """
+    now = timezone.now()
+    quote = connection.ops.quote_name
+    with transaction.atomic():
+        ids = list(Position.objects.select_for_update().filter(
+            pk__gt=after,
+            state__gte=consts.STATE_CLOSED,
+            last_modified__lt=before
+        ).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return None, 0
+        last = ids[-1]
+        position_pinning, position_references = _references(Position, POSITION_LINKS)
+        trade_pinning, trade_references = _references(ClientTrade)
+        trades = list(ClientTrade.objects.filter(position_id__in=ids).values_list('pk', 'position_id'))
+        pinned_trades = _pinned(trade_pinning, [pk for pk, position_id in trades])
+        pinned = _pinned(position_pinning, ids)
+        pinned.update(position_id for pk, position_id in trades if pk in pinned_trades)
+        ids = [pk for pk in ids if pk not in pinned]
+        if not ids:
+            return last, 0
+        trade_ids = [pk for pk, position_id in trades if position_id not in pinned]
+
+        order_id = '(SELECT %s FROM %s WHERE %s = %s.%s)' % (
+            quote('id'),
+            quote(Order._meta.db_table),
+            quote('position_id'),
+            quote(Position._meta.db_table),
+            quote('id')
+        )
+        #positions are copied first so the archived trades can reference them
+        _copy(Position, ArchivedPosition, 'id', ids, ['order_id', 'archive_date'], [order_id, '%s'], [now])
+        _copy(ClientTrade, ArchivedClientTrade, 'position_id', ids, ['archive_date'], ['%s'], [now])
+        Order.objects.filter(position_id__in=ids).update(position=None)
+        _repoint(trade_references, trade_ids, now)
+        _repoint(position_references, ids, now)
+        _delete(ClientTrade, 'position_id', ids)
+        _delete(Position, 'id', ids)
+    return last, len(ids)
+
+
+def archive_house_trades(before, batch_size, after=0):
+    """
+    Archives one batch of house trades above the `after` id older than `before` that no hot client
+    trade points to, returns the last id of the batch, None past the last one, and the number moved
+    """
+    with transaction.atomic():
+        ids = list(HouseTrade.objects.select_for_update().filter(
+            pk__gt=after,
+            time__lt=before,
+            clienttrade__isnull=True
+        ).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return None, 0
+        last = ids[-1]
+        pinning, references = _references(HouseTrade, HOUSE_TRADE_LINKS)
+        pinned = _pinned(pinning, ids)
+        ids = [pk for pk in ids if pk not in pinned]
+        if not ids:
+            return last, 0
+        now = timezone.now()
+        _copy(HouseTrade, ArchivedHouseTrade, 'id', ids, ['archive_date'], ['%s'], [now])
+        _repoint(references, ids, now)
+        _delete(HouseTrade, 'id', ids)
+    return last, len(ids)
+
+
+def archive_history(before=None, batch_size=None):
+    """
+    Archives everything past the retention horizon in batches, each batch in its own transaction
+    so the hot tables are never locked for long. Returns the numbers of positions and house trades moved.
+    """
+    before = before or retention_horizon()
+    batch_size = batch_size or getattr(settings, 'ARCHIVE_BATCH_SIZE', 1000)
+    moved = {}
+    for archive in (archive_positions, archive_house_trades):
+        moved[archive] = 0
+        last = 0
+        while last is not None:
+            last, count = archive(before, batch_size, last)
+            moved[archive] += count
+    return moved[archive_positions], moved[archive_house_trades]
+
+
+class HistoryChain(object):
+    """
+    Hot and archived rows of one history as a single sliceable sequence, ordered like the hot
+    queryset, hot rows first on ties. Usable wherever a queryset is paginated and iterated,
+    e.g. as a viewset queryset.
+    """
+
+    def __init__(self, hot, archived):
+        self.ordering = list(hot.query.order_by or hot.model._meta.ordering or ['pk'])
+        self.querysets = [hot, archived.order_by(*self.ordering)]
+        self.getters = [
+            (attrgetter(field.lstrip('-').replace('__', '.')), field.startswith('-')) for field in self.ordering
+        ]
+        self.counts = None
+        #merged offset -> offset in the hot rows
+        self.boundaries = {0: 0}
+
+    def count(self):
+        if self.counts is None:
+            self.counts = [queryset.count() for queryset in self.querysets]
+        return sum(self.counts)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start = index.start or 0
+            hot, archived = self.querysets
+            if index.stop is None:
+                hot_start = self._boundary(start)
+                rows = list(hot[hot_start:]) + list(archived[start - hot_start:])
+            else:
+                if index.stop <= start:
+                    return []
+                hot_start = self._boundary(start)
+                #each storage holds at most the whole page from its own boundary on
+                size = index.stop - start
+                rows = list(hot[hot_start:hot_start + size]) + list(archived[start - hot_start:start - hot_start + size])
+            return self._sort(rows)[:None if index.stop is None else index.stop - start:index.step]
+        return self[index:index + 1][0]
+
+    def _boundary(self, start):
+        """
+        Number of hot rows among the first `start` merged rows, found by a binary search over
+        single rows of both tables instead of reading all of them
+        """
+        if start not in self.boundaries:
+            self.count()
+            hot, archived = self.querysets
+            low, high = max(0, start - self.counts[1]), min(start, self.counts[0])
+            while low < high:
+                middle = (low + high) // 2
+                if self._precedes(hot[middle], archived[start - middle - 1]):
+                    low = middle + 1
+                else:
+                    high = middle
+            self.boundaries[start] = low
+        return self.boundaries[start]
+
+    def _precedes(self, hot_row, archived_row):
+        for getter, descending in self.getters:
+            hot_value, archived_value = getter(hot_row), getter(archived_row)
+            if hot_value != archived_value:
+                return (hot_value < archived_value) != descending
+        return True
+
+    def _sort(self, rows):
+        #stable sorts from the least significant key keep mixed directions right
+        for getter, descending in reversed(self.getters):
+            rows.sort(key=getter, reverse=descending)
+        return rows
+
+    def filter(self, *args, **kwargs):
+        return HistoryChain(self.querysets[0].filter(*args, **kwargs), self.querysets[1].filter(*args, **kwargs))
+
+
+class ArchiveHistoryMixin(object):
+    """
+    Viewset lists span the hot and the archived history, single objects are looked up in the hot tables.
+    Views define `get_archived_queryset`.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super(ArchiveHistoryMixin, self).filter_queryset(queryset)
+        if self.request.method == 'GET' and self.lookup_field not in self.kwargs:
+            return HistoryChain(queryset, self.get_archived_queryset())
+        return queryset
@@ -0,0 +1,324 @@
+"""
+Micro-benchmarks of the hot pricing, serialization and broadcast paths, run by the run_benchmarks
+command. The pricing ones also run the Decimal formulas trade.pricing replaced, kept in
+tests.test_pricing, as the `decimal:` rows. Fixtures are unsaved instruments and positions
+shaped like the production ones, the command runs them against the test databases and a local
+memory cache. Results are ops/sec, the objects a call leaves alive (retention, not allocations)
+and the growth of the peak resident size.
+
+Baselines are stored per host. Every run also times a fixed pure Python reference workload and
+ops/sec are compared relative to it, so a baseline of another host or of a busier moment still
+gives a usable comparison.
+"""
+import gc
+import json
+import os
+import resource
+import socket
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+
+from currency.models import Currency
+from trade import consts
+from .models import Instrument, Position
+
+
+#slug: base asset, quote currency, tick size, display tick size, minimum stop distance, slippage,
+#minimum margin, stop/slippage/margin absolute, sell and buy rates
+INSTRUMENTS = {
+    'bench-eurusd': ('EUR', 'USD', '0.00001', '0.00001', '10.00', '2.00', '1.00', False, Decimal('1.10815'), Decimal('1.10825')),
+    'bench-usdjpy': ('USD', 'JPY', '0.001', '0.001', '10.00', '2.00', '1.00', False, Decimal('149.512'), Decimal('149.527')),
+    'bench-xauusd': ('XAU', 'USD', '0.01', '0.01', '50.00', '5.00', '2.50', False, Decimal('2312.45'), Decimal('2312.95')),
+    'bench-btcusd': ('BTC', 'USD', '0.5', '1', '100.00', '0.50', '25.00', True, Decimal('63250.5'), Decimal('63270.5')),
+}
+
+
+def fixture_instruments():
+    currencies = {}
+    instruments = []
+    for pk, (slug, row) in enumerate(sorted(INSTRUMENTS.items()), 1):
+        base, quote, tick, display_tick, stop, slippage, margin, absolute, sell, buy = row
+        instruments.append(Instrument(
+            id=pk,
+            url_slug=slug,
+            symbol=slug.split('-')[1].upper(),
+            base_asset=base,
+            quote_asset=currencies.setdefault(quote, Currency(code=quote)),
+            tick_size=Decimal(tick),
+            display_tick_size=Decimal(display_tick),
+            stop_distance_absolute=absolute,
+            minimum_stop_distance=Decimal(stop),
+            slippage_absolute=absolute,
+            slippage=Decimal(slippage),
+            minimum_margin_absolute=absolute,
+            minimum_margin=Decimal(margin),
+        ))
+    return instruments
+
+
+def fixture_positions(instruments):
+    user = User(id=1, username='bench')
+    positions = []
+    for instrument in instruments:
+        sell, buy = INSTRUMENTS[instrument.url_slug][8:]
+        distance = instrument.tick_size * 250
+        for side, open_rate, stop_loss, take_profit in (
+            (consts.TYPE_BUY, buy, buy - distance, buy + 2 * distance),
+            (consts.TYPE_SELL, sell, sell + distance, None),
+        ):
+            positions.append(Position(
+                id=len(positions) + 1,
+                user=user,
+                instrument=instrument,
+                opening_amount=10000,
+                amount=7500,
+                asked_rate=open_rate,
+                open_rate=open_rate,
+                side=side,
+                stop_loss=stop_loss,
+                take_profit=take_profit,
+                state=consts.STATE_PARTIALLY_CLOSED,
+                current_margin=Decimal('250.00'),
+                pnl=Decimal('12.50'),
+            ))
+    return positions
+
+
+def rates_message(instrument):
+    sell, buy = INSTRUMENTS[instrument.url_slug][8:]
+    return {'asset': instrument.url_slug, 'sell': str(sell), 'buy': str(buy), 'low': str(sell), 'high': str(buy)}
+
+
+def use_memory_cache():
+    """
+    Points the modules on the benchmarked paths at a local memory cache
+    """
+    from . import service, socketio_namespaces
+    memory = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='benchmarks')
+    service.cache = memory
+    socketio_namespaces.cache = memory
+    return memory
+
+
+#fixed interpreter workload every run is scaled by
+REFERENCE = 'reference'
+
+
+def reference_workload():
+    total = 0
+    values = {}
+    for i in xrange(2000):
+        total += i * i % 7
+        values[i & 63] = total
+    return total
+
+
+def benchmarks(instruments, positions):
+    """
+    Returns [(name, callable)], each callable runs one operation over the whole fixture set
+    """
+    from rest_framework.renderers import JSONRenderer
+    from .serializers import PositionSerializer
+    from .service import TradeService
+    from .socketio_namespaces import InstrumentsPriceNamespace, instruments_by_slug
+    from .tests import test_pricing
+    from . import pricing
+
+    cache = use_memory_cache()
+    for instrument in instruments:
+        sell, buy = INSTRUMENTS[instrument.url_slug][8:]
+        cache.set('rates_%s' % instrument.url_slug, {'sell': sell, 'buy': buy, 'low': sell, 'high': buy})
+        instruments_by_slug[instrument.url_slug] = instrument
+    messages = [rates_message(instrument) for instrument in instruments]
+    renderer = JSONRenderer()
+
+    def calculate_margin():
+        for position in positions:
+            TradeService._calculate_margin(position.side, position.instrument, position.stop_loss, position.amount, position.open_rate)
+
+    def get_stoploss_rate():
+        for position in positions:
+            TradeService._get_stoploss_rate(position.instrument, Decimal('25.00'), position.open_rate, position.side)
+
+    def distance_to_rate():
+        for position in positions:
+            TradeService._distance_to_rate_convert(position.side, Decimal('25.00'), position.open_rate, position.instrument, True)
+
+    def rate_to_distance():
+        for position in positions:
+            TradeService._rate_to_distance_convert(position.side, position.stop_loss, position.open_rate, position.instrument)
+
+    def open_levels():
+        for position in positions:
+            stop_loss_rate, take_profit_rate, cash = pricing.open_levels(
+                position.instrument, position.side, Decimal('25.00'), position.amount, position.open_rate, Decimal('50.00')
+            )
+            TradeService._quantize_margin(position.instrument, cash)
+
+    def decimal_calculate_margin():
+        for position in positions:
+            test_pricing._calculate_margin(position.side, position.instrument, position.stop_loss, position.amount, position.open_rate)
+
+    def decimal_get_stoploss_rate():
+        for position in positions:
+            test_pricing._get_stoploss_rate(position.instrument, Decimal('25.00'), position.open_rate, position.side)
+
+    def decimal_distance_to_rate():
+        for position in positions:
+            test_pricing._distance_to_rate_convert(position.side, Decimal('25.00'), position.open_rate, position.instrument, True)
+
+    def decimal_rate_to_distance():
+        for position in positions:
+            test_pricing._rate_to_distance_convert(position.side, position.stop_loss, position.open_rate, position.instrument)
+
+    def decimal_open_levels():
+        for position in positions:
+            stop_loss_rate = test_pricing._get_stoploss_rate(position.instrument, Decimal('25.00'), position.open_rate, position.side)
+            test_pricing._distance_to_rate_convert(position.side, Decimal('50.00'), position.open_rate, position.instrument, True)
+            test_pricing._calculate_margin(position.side, position.instrument, stop_loss_rate, position.amount, position.open_rate)
+
+    def quantize_price_down():
+        for position in positions:
+            position.instrument.quantize_price_down(position.open_rate)
+
+    def serialize_positions():
+        renderer.render(PositionSerializer(positions, many=True).data)
+
+    def broadcast_message():
+        for msg in messages:
+            #normalize rewrites the rates in place
+            InstrumentsPriceNamespace.broadcast_message(dict(msg))
+
+    return [
+        ('_calculate_margin', calculate_margin),
+        ('_get_stoploss_rate', get_stoploss_rate),
+        ('_distance_to_rate_convert', distance_to_rate),
+        ('_rate_to_distance_convert', rate_to_distance),
+        ('open_levels', open_levels),
+        ('decimal: _calculate_margin', decimal_calculate_margin),
+        ('decimal: _get_stoploss_rate', decimal_get_stoploss_rate),
+        ('decimal: _distance_to_rate_convert', decimal_distance_to_rate),
+        ('decimal: _rate_to_distance_convert', decimal_rate_to_distance),
+        ('decimal: open_levels', decimal_open_levels),
+        ('Instrument.quantize_price_down', quantize_price_down),
+        ('PositionSerializer', serialize_positions),
+        ('broadcast_message', broadcast_message),
+    ]
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """
+    Best ops/sec over `repeat` runs of enough calls to last `min_time` seconds, with the collector
+    off like timeit, the objects one call leaves alive among the ones tracked by the collector, what
+    it retains rather than what it allocates, and the kilobytes the peak resident size of the process grew by while measuring
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    calls = 1
+    while True:
+        started = time.time()
+        for _ in xrange(calls):
+            func()
+        if time.time() - started >= min_time:
+            break
+        calls *= 2
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = None
+        for _ in xrange(repeat):
+            started = time.time()
+            for _ in xrange(calls):
+                func()
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        #objects kept alive by a call, cycles included since the collector is still off
+        gc.collect()
+        objects = len(gc.get_objects())
+        func()
+        objects = len(gc.get_objects()) - objects
+    finally:
+        if enabled:
+            gc.enable()
+    return {
+        'ops': calls / best,
+        'retained': objects,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - max_rss,
+    }
+
+
+def run(min_time=0.2, repeat=5, only=None):
+    instruments = fixture_instruments()
+    positions = fixture_positions(instruments)
+    results = {REFERENCE: measure(reference_workload, min_time, repeat)}
+    for name, func in benchmarks(instruments, positions):
+        if only and name not in only:
+            continue
+        results[name] = measure(func, min_time, repeat)
+    return results
+
+
+def baseline_path():
+    return getattr(settings, 'BENCHMARK_BASELINE', os.path.join(
+        os.path.dirname(__file__), 'management', 'commands', 'benchmarks_baseline.json'
+    ))
+
+
+def host():
+    return socket.gethostname()
+
+
+def load_baselines(path=None):
+    """
+    Stored baselines keyed by host
+    """
+    try:
+        with open(path or baseline_path()) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def load_baseline(path=None):
+    """
+    (host, results) of the baseline of this host, of another host when this one has none yet
+    """
+    baselines = load_baselines(path)
+    if host() in baselines:
+        return host(), baselines[host()]
+    for name in sorted(baselines):
+        return name, baselines[name]
+    return None, {}
+
+
+def save_baseline(results, path=None):
+    baselines = load_baselines(path)
+    baselines[host()] = results
+    with open(path or baseline_path(), 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True, separators=(',', ': '))
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns [(name, ops, baseline ops, change, regressed)]. The change compares ops/sec relative
+    to the reference workload of each run, a benchmark regressed when it dropped by more than
+    `threshold` percent.
+    """
+    reference = results[REFERENCE]['ops']
+    baseline_reference = baseline.get(REFERENCE, {}).get('ops')
+    rows = []
+    for name in sorted(results):
+        if name == REFERENCE:
+            continue
+        ops = results[name]['ops']
+        previous = baseline.get(name, {}).get('ops')
+        if previous and baseline_reference:
+            change = (ops / reference) / (previous / baseline_reference) * 100 - 100
+        else:
+            change = None
+        rows.append((name, ops, previous, change, change is not None and change < -threshold))
+    return rows
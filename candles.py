@@ -0,0 +1,149 @@
+import calendar
+import time
+from collections import deque
+from datetime import datetime
+
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from .chart_service import ChartService, BASE_TYPES, TYPE_SECONDS, SECONDS_IN_DAY
+from .mongo_models import ChartHistory
+
+
+class Candle(object):
+    __slots__ = ('type', 'start', 'open', 'high', 'low', 'close', 'volume', 'flushed')
+
+    def __init__(self, type, start, price):
+        self.type = type
+        self.start = start
+        self.open = self.high = self.low = self.close = price
+        self.volume = 1
+        #volume already added to the stored bar
+        self.flushed = 0
+
+    def update(self, price):
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += 1
+
+    def as_list(self):
+        return [self.start, self.open, self.high, self.low, self.close, self.volume]
+
+
+class CandleBuilder(object):
+    """
+    Builds bars of every ChartHistory timeframe from the rates stream.
+    Only the current bar of each timeframe is kept per instrument, closed bars
+    wait in a bounded queue until they are flushed to Mongo in one bulk upsert.
+    Upserts merge into the stored bar, so bars written by another builder or before a
+    restart keep their open, extremes and volume. Only the volume added since the last
+    acknowledged write of a bar is incremented, a retried flush does not count it twice.
+    """
+    TYPES = [type for type, name in ChartHistory.TYPES]
+
+    def __init__(self, persist_types=None, max_pending=None):
+        if persist_types is None:
+            persist_types = getattr(settings, 'CANDLE_PERSIST_TYPES', BASE_TYPES)
+        if max_pending is None:
+            max_pending = getattr(settings, 'CANDLE_MAX_PENDING', 100000)
+        self.persist_types = frozenset(persist_types)
+        self.candles = {}
+        self.pending = deque(maxlen=max_pending)
+        #closed bars evicted from the full queue
+        self.dropped = 0
+        self._second = None
+        self._day = None
+        self._starts = None
+        self._calendar_starts = None
+
+    def period_starts(self, timestamp):
+        """
+        Returns the start of the current period for every timeframe, computed once per second
+        """
+        second = int(timestamp)
+        if second != self._second:
+            day = second // SECONDS_IN_DAY
+            if day != self._day:
+                self._day = day
+                month = datetime.utcfromtimestamp(second).replace(day=1, hour=0, minute=0, second=0)
+                #epoch day 0 is a Thursday, shift so weeks start on Monday
+                self._calendar_starts = (
+                    ((day + 3) // 7 * 7 - 3) * SECONDS_IN_DAY,
+                    calendar.timegm(month.timetuple()),
+                )
+            self._second = second
+            self._starts = [
+                second // TYPE_SECONDS[type] * TYPE_SECONDS[type] for type in self.TYPES[:-2]
+            ] + list(self._calendar_starts)
+        return self._starts
+
+    def update(self, symbol, price, timestamp=None):
+        """
+        Applies one tick to all timeframes of the instrument and returns its current bars
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        starts = self.period_starts(timestamp)
+        candles = self.candles.get(symbol)
+        if candles is None:
+            candles = self.candles[symbol] = [
+                Candle(type, start, price) for type, start in zip(self.TYPES, starts)
+            ]
+            return candles
+
+        for i, candle in enumerate(candles):
+            if candle.start == starts[i]:
+                candle.update(price)
+            elif candle.start < starts[i]:
+                if candle.type in self.persist_types:
+                    if len(self.pending) == self.pending.maxlen:
+                        self.dropped += 1
+                    self.pending.append((symbol, candle))
+                candles[i] = Candle(candle.type, starts[i], price)
+        return candles
+
+    def flush(self):
+        """
+        Upserts closed bars and the current state of persisted bars, returns the number of bars written
+        """
+        closed = list(self.pending)
+        bars = list(closed)
+        for symbol, candles in self.candles.items():
+            bars.extend((symbol, candle) for candle in candles if candle.type in self.persist_types)
+        if not bars:
+            return 0
+
+        ChartService.connect()
+        bulk = ChartHistory._get_collection().initialize_unordered_bulk_op()
+        volumes = []
+        for symbol, candle in bars:
+            date = datetime.utcfromtimestamp(candle.start)
+            volumes.append(candle.volume)
+            bulk.find({'instrument': symbol, 'type': candle.type, 'date': date}).upsert().update({
+                '$setOnInsert': {'open': candle.open},
+                '$max': {'high': candle.high},
+                '$min': {'low': candle.low},
+                '$set': {'close': candle.close},
+                '$inc': {'volume': candle.volume - candle.flushed},
+            })
+        dropped = self.dropped
+        try:
+            bulk.execute()
+        except BulkWriteError as error:
+            #unordered, every write but the failed ones was applied
+            failed = set(write_error['index'] for write_error in error.details.get('writeErrors', ()))
+            for i, ((symbol, candle), volume) in enumerate(zip(bars, volumes)):
+                if i not in failed:
+                    candle.flushed = volume
+            raise
+        for (symbol, candle), volume in zip(bars, volumes):
+            candle.flushed = volume
+
+        #bars closed while writing stay queued for the next flush, the full queue evicts the oldest first
+        written = len(closed) - min(len(closed), self.dropped - dropped)
+        for i in range(min(written, len(self.pending))):
+            self.pending.popleft()
+        return len(bars)
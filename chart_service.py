@@ -0,0 +1,196 @@
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+import mongoengine
+
+from django.conf import settings
+
+from .lru_cache import LRUCache
+from .mongo_models import ChartHistory
+
+
+#bars are kept as parallel arrays, dates are epoch seconds (UTC)
+Bars = namedtuple('Bars', ('date', 'open', 'high', 'low', 'close', 'volume'))
+
+SECONDS_IN_DAY = 86400
+
+#period length in seconds for the fixed width timeframes
+TYPE_SECONDS = {
+    ChartHistory.TYPE_M1: 60,
+    ChartHistory.TYPE_M5: 5 * 60,
+    ChartHistory.TYPE_M15: 15 * 60,
+    ChartHistory.TYPE_M30: 30 * 60,
+    ChartHistory.TYPE_H1: 60 * 60,
+    ChartHistory.TYPE_H4: 4 * 60 * 60,
+    ChartHistory.TYPE_DAILY: SECONDS_IN_DAY,
+    ChartHistory.TYPE_WEEKLY: 7 * SECONDS_IN_DAY,
+    ChartHistory.TYPE_MONTHLY: 31 * SECONDS_IN_DAY,
+}
+
+#only these timeframes are stored, the rest are derived from them
+BASE_TYPES = (ChartHistory.TYPE_M1, ChartHistory.TYPE_DAILY)
+
+
+def base_type_for(type):
+    if type < ChartHistory.TYPE_DAILY:
+        return ChartHistory.TYPE_M1
+    return ChartHistory.TYPE_DAILY
+
+
+def bucket_start(dates, type):
+    """
+    Returns the start (epoch seconds) of the `type` period each date falls into
+    """
+    if type == ChartHistory.TYPE_MONTHLY:
+        months = dates.astype('datetime64[s]').astype('datetime64[M]')
+        return months.astype('datetime64[s]').astype(np.int64)
+    if type == ChartHistory.TYPE_WEEKLY:
+        #epoch day 0 is a Thursday, shift so weeks start on Monday
+        days = dates // SECONDS_IN_DAY
+        return ((days + 3) // 7 * 7 - 3) * SECONDS_IN_DAY
+    seconds = TYPE_SECONDS[type]
+    return dates // seconds * seconds
+
+
+def empty_bars():
+    return Bars(
+        date=np.empty(0, dtype=np.int64),
+        open=np.empty(0),
+        high=np.empty(0),
+        low=np.empty(0),
+        close=np.empty(0),
+        volume=np.empty(0, dtype=np.int64),
+    )
+
+
+def resample(bars, type):
+    """
+    Aggregates ascending base bars into `type` bars
+    """
+    if not len(bars.date):
+        return bars
+    keys = bucket_start(bars.date, type)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    ends = np.concatenate((starts[1:], [len(keys)])) - 1
+    return Bars(
+        date=keys[starts],
+        open=bars.open[starts],
+        high=np.maximum.reduceat(bars.high, starts),
+        low=np.minimum.reduceat(bars.low, starts),
+        close=bars.close[ends],
+        volume=np.add.reduceat(bars.volume, starts),
+    )
+
+
+def columnar_payload(bars, precision=6):
+    """
+    Packs bars into parallel arrays, times are the first epoch second followed by deltas
+    """
+    return {
+        't0': int(bars.date[0]) if len(bars.date) else None,
+        'dt': np.diff(bars.date).tolist(),
+        'o': np.round(bars.open, precision).tolist(),
+        'h': np.round(bars.high, precision).tolist(),
+        'l': np.round(bars.low, precision).tolist(),
+        'c': np.round(bars.close, precision).tolist(),
+        'v': bars.volume.tolist(),
+    }
+
+
+class ChartService(object):
+    cache = LRUCache(
+        max_size=getattr(settings, 'CHART_CACHE_SIZE', 512),
+        ttl=getattr(settings, 'CHART_CACHE_TTL', 30)
+    )
+    connected = False
+
+    @staticmethod
+    def connect():
+        #keep one connection per process instead of connecting on every request
+        if not ChartService.connected:
+            mongoengine.connect(**settings.MONGO_DATABASES['chart_history'])
+            ChartService.connected = True
+
+    @staticmethod
+    def get_bars(symbol, type, limit=100, date_from=None, date_to=None, since=None):
+        """
+        Returns up to `limit` latest bars of `type` for the instrument. `date_from`/`date_to` bound
+        the range in epoch seconds, `since` returns the bar open at that time and everything newer,
+        so a client can refresh its last bar and append new ones. Requests without `date_to` are
+        sliced from the cached window of the latest bars of the instrument and type.
+        """
+        if since is not None:
+            #the bar open at `since` starts at or before it
+            since = int(bucket_start(np.array([since], dtype=np.int64), type)[0])
+            date_from = max(date_from, since) if date_from is not None else since
+        if date_to is None:
+            bars = ChartService._from_window(symbol, type, limit, date_from)
+            if bars is not None:
+                return bars
+        return ChartService._build_bars(symbol, type, limit, date_from, date_to)
+
+    @staticmethod
+    def _from_window(symbol, type, limit, date_from=None):
+        """
+        Bars of the cached window of the latest CHART_CACHE_BARS bars of (symbol, type), None when
+        the request reaches past it
+        """
+        key = (symbol, type)
+        window = ChartService.cache.get(key)
+        if window is None:
+            window = ChartService._build_bars(symbol, type, getattr(settings, 'CHART_CACHE_BARS', 1000))
+            ChartService.cache.set(key, window)
+        first = 0
+        if date_from is not None:
+            if type != base_type_for(type):
+                #as _build_bars, the whole first period
+                date_from = int(bucket_start(np.array([date_from], dtype=np.int64), type)[0])
+            first = np.searchsorted(window.date, date_from)
+        if len(window.date) - first >= limit:
+            return Bars(*[column[len(window.date) - limit:] for column in window])
+        #fewer bars than asked are all there are only when the window starts at or before date_from
+        if date_from is not None and len(window.date) and window.date[0] <= date_from:
+            return Bars(*[column[first:] for column in window])
+        return None
+
+    @staticmethod
+    def _build_bars(symbol, type, limit, date_from=None, date_to=None):
+        base_type = base_type_for(type)
+        if type == base_type:
+            return ChartService._load_base_bars(symbol, base_type, limit, date_from, date_to)
+        if date_from is not None:
+            #include the whole first period so its open is not taken from the middle
+            date_from = int(bucket_start(np.array([date_from], dtype=np.int64), type)[0])
+        #one extra period to make up for the oldest bucket, dropped below when the load was cut inside it
+        ratio = TYPE_SECONDS[type] // TYPE_SECONDS[base_type]
+        base_limit = min(ratio * (limit + 1), getattr(settings, 'CHART_MAX_BASE_BARS', 50000))
+        base = ChartService._load_base_bars(symbol, base_type, base_limit, date_from, date_to)
+        bars = resample(base, type)
+        if len(base.date) == base_limit:
+            #older base bars exist, so the oldest bucket may lack its open and part of its range
+            bars = Bars(*[column[1:] for column in bars])
+        return Bars(*[column[-limit:] for column in bars])
+
+    @staticmethod
+    def _load_base_bars(symbol, type, limit, date_from=None, date_to=None):
+        ChartService.connect()
+        filters = {'instrument': symbol, 'type': type}
+        if date_from is not None:
+            filters['date__gte'] = datetime.utcfromtimestamp(date_from)
+        if date_to is not None:
+            filters['date__lte'] = datetime.utcfromtimestamp(date_to)
+        rows = list(ChartHistory.objects(**filters).order_by('-date').only(
+            'date', 'open', 'high', 'low', 'close', 'volume'
+        ).limit(limit).as_pymongo())
+        if not rows:
+            return empty_bars()
+        rows.reverse()
+        return Bars(
+            date=np.array([row['date'] for row in rows], dtype='datetime64[s]').astype(np.int64),
+            open=np.array([row['open'] for row in rows], dtype=np.float64),
+            high=np.array([row['high'] for row in rows], dtype=np.float64),
+            low=np.array([row['low'] for row in rows], dtype=np.float64),
+            close=np.array([row['close'] for row in rows], dtype=np.float64),
+            volume=np.array([row.get('volume', 0) for row in rows], dtype=np.int64),
+        )
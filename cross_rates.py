@@ -0,0 +1,160 @@
+"""
+Currency conversion from a matrix of cross rates held in memory. Every currency is priced against
+CROSS_RATE_BASE from the mid rates of the currency pair instruments in the rates cache, the cache the
+rates stream writes on every tick, and every other pair is triangulated through the base. A process
+refreshes the matrix from the cache at most every CROSS_RATE_REFRESH_INTERVAL seconds, so a conversion
+is an array lookup instead of a call to CurrencyService. Without a CROSS_RATE_BASE currency no
+currency is priced and every conversion goes to CurrencyService.
+"""
+import logging
+import time
+from decimal import Decimal
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import cache
+
+from currency.models import Currency
+from currency.service import CurrencyService
+from .lru_cache import LRUCache
+from .models import Instrument
+
+
+logger = logging.getLogger(__name__)
+
+
+class CrossRates(object):
+
+    def __init__(self):
+        self.index = None
+        self.base = None
+        self.pairs = []
+        self.to_base = None
+        self.direct = None
+        self.matrix = None
+        self.refreshed = 0
+        self.loaded = 0
+        self.user_currencies = LRUCache(
+            max_size=getattr(settings, 'CROSS_RATE_USER_CACHE_SIZE', 10000),
+            ttl=getattr(settings, 'CROSS_RATE_USER_CACHE_TTL', 300)
+        )
+
+    def load(self):
+        """
+        Indexes the currencies and finds the instruments quoting one currency in another
+        """
+        #instruments name their base asset by the currency code
+        codes = dict(Currency.objects.values_list('code', 'pk'))
+        self.index = dict((pk, row) for row, pk in enumerate(sorted(codes.values())))
+        base_code = getattr(settings, 'CROSS_RATE_BASE', 'USD')
+        if base_code in codes:
+            self.base = self.index[codes[base_code]]
+        else:
+            logger.warning('Cross rate base currency %s does not exist, converting through CurrencyService', base_code)
+            self.base = None
+        self.pairs = [
+            (slug, self.index[codes[base_asset]], self.index[quote_asset_id])
+            for slug, base_asset, quote_asset_id in Instrument.objects.values_list('url_slug', 'base_asset', 'quote_asset_id')
+            if base_asset in codes and codes[base_asset] != quote_asset_id
+        ]
+        size = len(self.index)
+        self.to_base = np.full(size, np.nan)
+        self.direct = np.zeros(size, dtype=bool)
+        if self.base is not None:
+            self.to_base[self.base] = 1.0
+            self.direct[self.base] = True
+        self.matrix = np.full((size, size), np.nan)
+        np.fill_diagonal(self.matrix, 1.0)
+
+    def refresh(self, force=False):
+        now = time.time()
+        #new currencies and instruments are picked up on reload
+        if self.index is None or now - self.loaded > getattr(settings, 'CROSS_RATE_RELOAD_INTERVAL', 3600):
+            self.load()
+            self.loaded = now
+        elif not force and now - self.refreshed < getattr(settings, 'CROSS_RATE_REFRESH_INTERVAL', 1):
+            return
+        self.refreshed = now
+        rates = cache.get_many(['rates_%s' % slug for slug, base, quote in self.pairs])
+        crosses = []
+        for slug, base, quote in self.pairs:
+            rate = rates.get('rates_%s' % slug)
+            if not rate or not rate['sell'] or not rate['buy']:
+                continue
+            mid = (float(rate['sell']) + float(rate['buy'])) / 2
+            #one unit of `base` is `mid` units of `quote`
+            if quote == self.base:
+                self.to_base[base] = mid
+                self.direct[base] = True
+            elif base == self.base:
+                self.to_base[quote] = 1 / mid
+                self.direct[quote] = True
+            else:
+                crosses.append((base, quote, mid))
+        #currencies without a pair against the base are priced through a pair with a priced one,
+        #pass after pass until a pass prices nothing new, so chains of crosses resolve in any order
+        priced = self.direct.copy()
+        while crosses:
+            pending = []
+            for base, quote, mid in crosses:
+                if priced[quote] and not priced[base]:
+                    self.to_base[base] = mid * self.to_base[quote]
+                    priced[base] = True
+                elif priced[base] and not priced[quote]:
+                    self.to_base[quote] = self.to_base[base] / mid
+                    priced[quote] = True
+                elif not priced[base]:
+                    pending.append((base, quote, mid))
+            if len(pending) == len(crosses):
+                break
+            crosses = pending
+        #matrix[i, j] is the amount of currency j one unit of currency i is worth
+        np.divide.outer(self.to_base, self.to_base, out=self.matrix)
+
+    def rate(self, source, target):
+        """
+        Rate from one currency to another by currency id, NaN when either currency is not priced
+        """
+        self.refresh()
+        if source == target:
+            return 1.0
+        try:
+            return self.matrix[self.index[source], self.index[target]]
+        except KeyError:
+            return np.nan
+
+    def convert_value(self, source, target, value):
+        """
+        Converts a Decimal between Currency objects, falls back on CurrencyService for unpriced currencies
+        """
+        rate = self.rate(source.pk, target.pk)
+        if np.isnan(rate):
+            return CurrencyService.convert_value(source, target, value)
+        return target.quantize_value_down(value * Decimal(repr(rate)))
+
+    def convert_many(self, amounts, sources, target):
+        """
+        Converts an array of amounts in the currencies of the `sources` ids to the `target` id
+        """
+        self.refresh()
+        rows = np.array([self.index.get(source, -1) for source in sources])
+        column = self.index.get(target)
+        if column is None:
+            return np.full(len(rows), np.nan)
+        converted = np.asarray(amounts, dtype=np.float64) * self.matrix[rows, column]
+        converted[rows < 0] = np.nan
+        return converted
+
+    def user_currency(self, user):
+        """
+        Currency of the user profile, kept in memory so fills do not load the profile
+        """
+        currency = self.user_currencies.get(user.pk)
+        if currency is None:
+            currency = user.profile.currency
+            self.user_currencies.set(user.pk, currency)
+        return currency
+
+
+cross_rates = CrossRates()
@@ -0,0 +1,121 @@
+"""
+Read replica routing. Reads are sent to a replica only inside `replica_reads`, used by the
+read only viewsets, the history views and reporting code, everything else stays on the primary.
+After a trade or order write a user sticks to the primary for DB_STICKY_SECONDS so their
+own fills are visible despite the replication lag.
+
+Locally, two aliases of the same database are enough to exercise it:
+
+    DATABASES = {'default': {...}, 'replica': dict(DATABASES['default'], TEST_MIRROR='default')}
+    DATABASE_REPLICAS = ['replica']
+    DATABASE_ROUTERS = ['trade.db_router.ReplicaRouter']
+"""
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+
+_state = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def sticky_key(user_id):
+    return 'db_primary_%s' % user_id
+
+
+def stick_to_primary(user_id):
+    """
+    Keeps the reads of the user on the primary for DB_STICKY_SECONDS, call after their writes
+    """
+    if user_id is not None and replicas():
+        cache.set(sticky_key(user_id), True, getattr(settings, 'DB_STICKY_SECONDS', 5))
+
+
+def is_sticky(user_id):
+    return user_id is not None and bool(cache.get(sticky_key(user_id)))
+
+
+@contextmanager
+def replica_reads(user_id=None):
+    """
+    Routes the reads of the block to a replica, unless `user_id` wrote recently
+    """
+    previous = getattr(_state, 'alias', None)
+    aliases = replicas()
+    if aliases and not is_sticky(user_id):
+        _state.alias = random.choice(aliases)
+    try:
+        yield
+    finally:
+        _state.alias = previous
+
+
+def replica_view(view):
+    """
+    Serves the GET requests of a function view from a replica
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        with replica_reads(request.user.pk):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaReadMixin(object):
+    """
+    Serves the safe methods of a viewset from a replica, other methods make the user stick to the primary
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ReplicaReadMixin, self).dispatch(request, *args, **kwargs)
+        finally:
+            _state.alias = None
+
+    def initial(self, request, *args, **kwargs):
+        #the user is known only once the request is authenticated
+        super(ReplicaReadMixin, self).initial(request, *args, **kwargs)
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            aliases = replicas()
+            if aliases and not is_sticky(request.user.pk):
+                _state.alias = random.choice(aliases)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            stick_to_primary(request.user.pk)
+        return super(ReplicaReadMixin, self).finalize_response(request, response, *args, **kwargs)
+
+
+class ReplicaRouter(object):
+    """
+    Writes always go to the primary, reads too unless a replica was chosen for the current thread
+    """
+
+    def db_for_read(self, model, **hints):
+        return getattr(_state, 'alias', None) or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        #objects read from a replica are saved to the primary too
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        #replicas mirror the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        if db in replicas():
+            return False
+        return None
+
+    def allow_migrate(self, db, model):
+        return self.allow_syncdb(db, model)
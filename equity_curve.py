@@ -0,0 +1,244 @@
+"""
+Daily equity curves. Equity at the end of a day is the trading capital plus the PnL realized so far
+plus the open positions marked at that day's EndOfDayRate, all in the user currency: the PnL of
+each instrument is converted from its quote currency at the current cross rates. Curves are built
+with array operations over the client trades and kept in the cache with the open exposure of the
+last day, so a new day is appended from that day's trades only.
+"""
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+
+from currency.service import CurrencyService
+from trade import consts
+from wallet.service import WalletService
+from .cross_rates import cross_rates
+from .models import ClientTrade, ArchivedClientTrade, EndOfDayRate, Position, ArchivedPosition, Instrument
+
+
+TRADE_FIELDS = ('time', 'instrument_id', 'side', 'amount', 'rate', 'position__side', 'position__open_rate')
+
+
+def forward_fill(values):
+    """
+    Replaces NaNs with the last value before them, leading NaNs stay
+    """
+    mask = ~np.isnan(values)
+    index = np.where(mask, np.arange(len(values)), 0)
+    np.maximum.accumulate(index, out=index)
+    filled = values[index]
+    filled[:np.argmax(mask) if mask.any() else len(values)] = np.nan
+    return filled
+
+
+class EquityCurveService(object):
+
+    @staticmethod
+    def cache_key(user_id, currency_id):
+        return 'equity_curve_%s_%s' % (user_id, currency_id)
+
+    @staticmethod
+    def get_curve(user):
+        """
+        Returns the curve up to yesterday, the last complete EOD day, extending the cached one
+        """
+        last_day = timezone.localtime(timezone.now()).date() - timedelta(days=1)
+        currency = cross_rates.user_currency(user)
+        key = EquityCurveService.cache_key(user.pk, currency.pk)
+        state = cache.get(key)
+        if state is None:
+            state = EquityCurveService._initial_state(user, currency)
+            if state is None:
+                return None
+        if state['last_day'] < last_day.toordinal():
+            EquityCurveService._extend(user, currency, state, last_day.toordinal())
+            cache.set(key, state, getattr(settings, 'EQUITY_CURVE_CACHE_TTL', 7 * 24 * 3600))
+        return EquityCurveService._as_result(state)
+
+    @staticmethod
+    def _trades(user, first_day, last_day):
+        rows = []
+        for model in (ClientTrade, ArchivedClientTrade):
+            rows.extend(model.objects.filter(
+                user=user,
+                success=True,
+                time__gte=EquityCurveService._day_start(first_day),
+                time__lt=EquityCurveService._day_start(last_day + 1)
+            ).values_list(*TRADE_FIELDS))
+        return rows
+
+    @staticmethod
+    def _day_start(ordinal):
+        return timezone.make_aware(datetime.combine(date.fromordinal(ordinal), time.min), timezone.get_current_timezone())
+
+    @staticmethod
+    def _factors(instrument_ids, currency):
+        """
+        Rate from the quote currency of each instrument to `currency` by instrument id, from the
+        cross rates or CurrencyService for currencies they do not price
+        """
+        instruments = list(Instrument.objects.filter(pk__in=instrument_ids).select_related('quote_asset'))
+        rates = cross_rates.convert_many(
+            np.ones(len(instruments)),
+            [instrument.quote_asset_id for instrument in instruments],
+            currency.pk
+        )
+        factors = {}
+        for instrument, rate in zip(instruments, rates.tolist()):
+            if np.isnan(rate):
+                #a million units, so the rate survives the quantization of the target currency
+                rate = float(CurrencyService.convert_value(instrument.quote_asset, currency, Decimal(10 ** 6))) / 10 ** 6
+            factors[instrument.pk] = rate
+        return factors
+
+    @staticmethod
+    def _sum_by_instrument(queryset, field):
+        return dict(
+            (row['instrument_id'], row['total'] or 0)
+            for row in queryset.values('instrument_id').annotate(total=Sum(field))
+        )
+
+    @staticmethod
+    def _initial_state(user, currency):
+        first = ClientTrade.objects.filter(user=user, success=True).order_by('time').values_list('time', flat=True)[:1]
+        archived = ArchivedClientTrade.objects.filter(user=user, success=True).order_by('time').values_list('time', flat=True)[:1]
+        times = list(first) + list(archived)
+        if not times:
+            return None
+        start = timezone.localtime(min(times)).date().toordinal()
+        #no deposits ledger in this app, the capital is backed out of the current balance once,
+        #the realized PnL and margin are summed per instrument in its quote currency
+        realized = [
+            EquityCurveService._sum_by_instrument(model.objects.filter(user=user), 'pnl')
+            for model in (Position, ArchivedPosition)
+        ]
+        margin = EquityCurveService._sum_by_instrument(Position.objects.filter(
+            user=user,
+            state__in=(consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED)
+        ), 'current_margin')
+        factors = EquityCurveService._factors(set(margin).union(*realized), currency)
+        capital = float(WalletService(user).get_useful_balance())
+        capital += sum(float(value) * factors[instrument_id] for instrument_id, value in margin.items())
+        for totals in realized:
+            capital -= sum(float(value) * factors[instrument_id] for instrument_id, value in totals.items())
+        return {
+            'start': start,
+            'last_day': start - 1,
+            'capital': capital,
+            'realized': 0.0,
+            #instrument id -> [signed open amount, signed open cost]
+            'exposure': {},
+            'equity': [],
+        }
+
+    @staticmethod
+    def _extend(user, currency, state, last_day):
+        first_day = state['last_day'] + 1
+        days = last_day - first_day + 1
+        rows = EquityCurveService._trades(user, first_day, last_day)
+
+        realized_daily = np.zeros(days)
+        upnl = np.zeros(days)
+        exposure = state['exposure']
+        instrument_ids = set(exposure)
+        if rows:
+            times, instrument, side, amount, rate, position_side, open_rate = zip(*rows)
+            day = np.array([timezone.localtime(t).date().toordinal() - first_day for t in times])
+            instrument = np.array(instrument)
+            amount = np.array(amount, dtype=np.float64)
+            rate = np.array(rate, dtype=np.float64)
+            open_rate = np.array([value or 0 for value in open_rate], dtype=np.float64)
+            position_side = np.array(position_side)
+            sign = np.where(position_side == consts.TYPE_BUY, 1.0, -1.0)
+            opening = np.array(side) == position_side
+            #opening trades add to the exposure at their rate, closing ones remove it at the open rate
+            amount_delta = np.where(opening, sign * amount, -sign * amount)
+            cost_delta = np.where(opening, sign * amount * rate, -sign * amount * open_rate)
+            instrument_ids.update(instrument.tolist())
+        factors = EquityCurveService._factors(instrument_ids, currency)
+        if rows:
+            #realized PnL in the user currency
+            factor = np.array([factors[instrument_id] for instrument_id in instrument.tolist()])
+            realized = np.where(opening, 0.0, sign * (rate - open_rate) * amount) * factor
+            realized_daily = np.bincount(day, weights=realized, minlength=days)
+
+        marks = EquityCurveService._marks(instrument_ids, first_day, last_day)
+        for instrument_id in instrument_ids:
+            held = exposure.get(instrument_id, [0.0, 0.0])
+            amounts = np.full(days, held[0])
+            costs = np.full(days, held[1])
+            if rows:
+                mask = instrument == instrument_id
+                amounts += np.cumsum(np.bincount(day[mask], weights=amount_delta[mask], minlength=days))
+                costs += np.cumsum(np.bincount(day[mask], weights=cost_delta[mask], minlength=days))
+            mark = marks[instrument_id]
+            #without a mark yet the exposure is valued at cost
+            upnl += np.where(np.isnan(mark), 0.0, np.nan_to_num(mark) * amounts - costs) * factors[instrument_id]
+            if abs(amounts[-1]) < 1e-9:
+                exposure.pop(instrument_id, None)
+            else:
+                exposure[instrument_id] = [float(amounts[-1]), float(costs[-1])]
+
+        equity = state['capital'] + state['realized'] + np.cumsum(realized_daily) + upnl
+        state['realized'] += float(realized_daily.sum())
+        state['equity'].extend(np.round(equity, 2).tolist())
+        state['last_day'] = last_day
+
+    @staticmethod
+    def _marks(instrument_ids, first_day, last_day):
+        """
+        EOD rates per instrument over the days, carried over days without a snapshot
+        """
+        days = last_day - first_day + 1
+        #look back for the mark in effect on the first day
+        lookback = getattr(settings, 'EOD_RATE_LOOKBACK_DAYS', 10)
+        marks = dict((instrument_id, np.full(days + lookback, np.nan)) for instrument_id in instrument_ids)
+        for instrument_id, day, rate in EquityCurveService._eod_rates(instrument_ids, first_day - lookback, last_day):
+            marks[instrument_id][day.toordinal() - first_day + lookback] = float(rate)
+        return dict((instrument_id, forward_fill(values)[lookback:]) for instrument_id, values in marks.items())
+
+    @staticmethod
+    def _eod_rates(instrument_ids, first_day, last_day):
+        return EndOfDayRate.objects.filter(
+            instrument_id__in=instrument_ids,
+            date__gte=date.fromordinal(first_day),
+            date__lte=date.fromordinal(last_day)
+        ).values_list('instrument_id', 'date', 'rate')
+
+    @staticmethod
+    def _as_result(state):
+        equity = np.array(state['equity'])
+        peak = np.maximum.accumulate(equity)
+        drawdown = np.where(peak > 0, equity / np.where(peak > 0, peak, 1) - 1, 0.0)
+        previous = equity[:-1]
+        returns = np.where(previous > 0, np.diff(equity) / np.where(previous > 0, previous, 1), 0.0)
+        return {
+            'start': date.fromordinal(state['start']),
+            'capital': round(state['capital'], 2),
+            'equity': state['equity'],
+            'returns': np.round(returns, 6).tolist(),
+            'drawdown': np.round(drawdown, 6).tolist(),
+            'max_drawdown': round(float(drawdown.min()), 6) if len(drawdown) else 0.0,
+        }
+
+
+def update_equity_curves():
+    """
+    Appends yesterday's point to the curves of users holding positions or trading yesterday,
+    meant to run after the EOD snapshot so the curve requests find them up to date
+    """
+    since = EquityCurveService._day_start(timezone.localtime(timezone.now()).date().toordinal() - 1)
+    user_ids = set(Position.objects.filter(
+        state__in=(consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED)
+    ).values_list('user_id', flat=True).distinct())
+    user_ids.update(ClientTrade.objects.filter(time__gte=since).values_list('user_id', flat=True).distinct())
+    for user in User.objects.filter(pk__in=user_ids):
+        EquityCurveService.get_curve(user)
+    return len(user_ids)
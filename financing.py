@@ -0,0 +1,221 @@
+"""
+Nightly overnight financing. Open positions are streamed in primary key chunks and each chunk is
+charged in one go: the charges of the whole chunk are computed on int64 arrays and stored with
+one bulk insert, then the stored charges are posted to the wallets as one entry per user and
+currency. A position is charged at most once per business date and a charge posted once, so the
+job can be rerun for a date after a failure. Positions of instruments without an EOD rate are
+skipped and logged.
+
+Business dates follow a rollover calendar: weekends and FINANCING_HOLIDAYS are not charged, the
+business date before them charges the days up to the next business date.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+
+from trade import consts
+from wallet.service import WalletService
+from .models import Position, Instrument, EndOfDayRate, FinancingCharge
+from .pricing import to_units, RATE_DECIMALS
+
+
+logger = logging.getLogger(__name__)
+
+#charges are cents of the quote currency, the product of rate, interest and side factor units
+#has 18 decimals
+CENTS_DIVISOR = 10 ** (3 * RATE_DECIMALS - 2)
+#the rest of a unit cost below a cent is split in two parts of this size so amount products fit int64
+SPLIT = 10 ** 8
+
+
+def is_business_date(day):
+    return day.weekday() not in getattr(settings, 'FINANCING_WEEKEND', (5, 6)) and \
+        day not in getattr(settings, 'FINANCING_HOLIDAYS', ())
+
+
+def rollover_days(business_date):
+    """
+    Days of financing charged on the date: 0 on weekends and holidays, else the days up to the next business date
+    """
+    if not is_business_date(business_date):
+        return 0
+    days = 1
+    while not is_business_date(business_date + timedelta(days=days)):
+        days += 1
+    return days
+
+
+def unit_cost(rate, interest, side, days):
+    """
+    Financing of one unit of amount over `days` as parts for `compute_charges`: whole cents, then
+    the rest below a cent in 10**-10 and 10**-18 cents. The cost is an exact Python int of 18 decimals.
+    """
+    factors = getattr(settings, 'FINANCING_SIDE_FACTORS', {consts.TYPE_BUY: 1, consts.TYPE_SELL: 1})
+    cost = rate * interest * to_units(str(factors[side]), RATE_DECIMALS) * days
+    cents, rest = divmod(cost, CENTS_DIVISOR)
+    high, low = divmod(rest, SPLIT)
+    return cents, high, low
+
+
+def eod_rates(business_date):
+    """
+    Latest EOD rate on or before the business date of every instrument, as rate units
+    """
+    lookback = getattr(settings, 'EOD_RATE_LOOKBACK_DAYS', 10)
+    #ordered by date, so the latest rate of each instrument wins
+    return dict(
+        (instrument_id, to_units(rate, RATE_DECIMALS)) for instrument_id, rate in EndOfDayRate.objects.filter(
+            date__gt=business_date - timedelta(days=lookback),
+            date__lte=business_date
+        ).order_by('date').values_list('instrument_id', 'rate')
+    )
+
+
+def compute_charges(amounts, cents, high, low):
+    """
+    Charges in cents for int64 arrays of position amounts and of the unit cost parts of `unit_cost`,
+    rounded down in favour of the client. floor(amount * cost / CENTS_DIVISOR) is
+    amount * cents + (amount * high + amount * low // SPLIT) // SPLIT, exact as long as the products
+    fit int64, which is checked; bigger amounts fall back to Python ints.
+    """
+    if len(amounts) and int(amounts.max()) * max(int(np.abs(cents).max()), SPLIT) >= 2 ** 63:
+        costs = (cents.astype(object) * SPLIT + high) * SPLIT + low
+        return amounts.astype(object) * costs // CENTS_DIVISOR
+    return amounts * cents + (amounts * high + amounts * low // SPLIT) // SPLIT
+
+
+def accrue_chunk(business_date, rows, instruments, rates, days=1):
+    """
+    Stores the charges of one chunk of (position id, user id, instrument id, side, amount) rows not
+    yet charged for the date, returns the number of positions charged
+    """
+    done = set(FinancingCharge.objects.filter(
+        business_date=business_date,
+        position_id__in=[row[0] for row in rows]
+    ).values_list('position_id', flat=True))
+    rows = [row for row in rows if row[0] not in done]
+    unrated = [row for row in rows if not rates.get(row[2])]
+    if unrated:
+        logger.warning(
+            'Financing of %s positions for %s skipped, no EOD rate of instruments %s',
+            len(unrated), business_date, sorted(set(row[2] for row in unrated))
+        )
+        rows = [row for row in rows if rates.get(row[2])]
+    if not rows:
+        return 0
+
+    #the cost of a unit only depends on the instrument and the side
+    costs = {}
+    for instrument_id, side in set((row[2], row[3]) for row in rows):
+        costs[instrument_id, side] = unit_cost(rates[instrument_id], instruments[instrument_id][0], side, days)
+    cents, high, low = [np.array(column, dtype=np.int64) for column in zip(*[costs[row[2], row[3]] for row in rows])]
+    charges = compute_charges(np.array([row[4] for row in rows], dtype=np.int64), cents, high, low)
+
+    objects = [
+        FinancingCharge(
+            position_id=position_id,
+            user_id=user_id,
+            instrument_id=instrument_id,
+            business_date=business_date,
+            days=days,
+            side=side,
+            amount=amount,
+            rate=Decimal(rates[instrument_id]).scaleb(-RATE_DECIMALS),
+            interest=Decimal(instruments[instrument_id][0]).scaleb(-RATE_DECIMALS),
+            charge=Decimal(charge).scaleb(-2),
+            #nothing to post for a zero charge
+            posted=charge == 0
+        ) for (position_id, user_id, instrument_id, side, amount), charge in zip(rows, charges.tolist())
+    ]
+    try:
+        with transaction.atomic():
+            FinancingCharge.objects.bulk_create(objects)
+    except IntegrityError:
+        #another run charged some of them meanwhile, insert the rest one by one
+        created = 0
+        for charge in objects:
+            try:
+                with transaction.atomic():
+                    charge.save()
+                created += 1
+            except IntegrityError:
+                pass
+        return created
+    return len(rows)
+
+
+def post_charges(business_date, instruments):
+    """
+    Posts the stored charges of the date not posted yet to the wallets, one entry per user and currency.
+    Only the charges of the user being posted are locked. Returns the number of users posted.
+    """
+    user_ids = set(FinancingCharge.objects.filter(
+        business_date=business_date,
+        posted=False
+    ).values_list('user_id', flat=True))
+    users = User.objects.in_bulk(user_ids)
+    for user_id, user in users.items():
+        with transaction.atomic():
+            charges = list(FinancingCharge.objects.select_for_update().filter(
+                business_date=business_date,
+                user_id=user_id,
+                posted=False
+            ).values_list('pk', 'instrument_id', 'charge'))
+            totals = defaultdict(Decimal)
+            for pk, instrument_id, charge in charges:
+                totals[instruments[instrument_id][1]] += charge
+            wallet = WalletService(user)
+            for currency, charge in totals.items():
+                if hasattr(wallet, 'apply_financing'):
+                    wallet.apply_financing(-charge, currency, business_date)
+                else:
+                    #booked like a PnL entry without a trade where the wallet has no financing entry type
+                    wallet.apply_pnl(-charge, currency, None)
+            FinancingCharge.objects.filter(pk__in=[charge[0] for charge in charges]).update(posted=True)
+    return len(users)
+
+
+def accrue_financing(business_date=None, chunk_size=None):
+    """
+    Charges the financing of every position open at the end of the business date, today by default,
+    so it runs after the EOD snapshots of the day. Returns the number of positions charged.
+    """
+    business_date = business_date or timezone.localtime(timezone.now()).date()
+    chunk_size = chunk_size or getattr(settings, 'FINANCING_CHUNK_SIZE', 5000)
+    days = rollover_days(business_date)
+    if not days:
+        return 0
+    day_end = timezone.make_aware(datetime.combine(business_date + timedelta(days=1), time.min), timezone.get_current_timezone())
+    instruments = dict(
+        (instrument.pk, (to_units(instrument.interest, RATE_DECIMALS), instrument.quote_asset))
+        for instrument in Instrument.objects.select_related('quote_asset')
+    )
+    rates = eod_rates(business_date)
+
+    positions = Position.objects.filter(
+        state__in=(consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED),
+        open_date__lt=day_end
+    ).order_by('pk')
+    charged = 0
+    last = 0
+    while True:
+        #positions are not locked, the unique charge per position and date keeps reruns and
+        #concurrent runs from charging twice
+        rows = list(positions.filter(pk__gt=last).values_list(
+            'pk', 'user_id', 'instrument_id', 'side', 'amount'
+        )[:chunk_size])
+        if not rows:
+            break
+        last = rows[-1][0]
+        charged += accrue_chunk(business_date, rows, instruments, rates, days)
+    #also posts the charges a failed run stored but did not post
+    post_charges(business_date, instruments)
+    return charged
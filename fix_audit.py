@@ -0,0 +1,94 @@
+import calendar
+from datetime import datetime
+
+import mongoengine
+from bson import ObjectId
+
+from django.conf import settings
+
+from .mongo_models import FixTradeMsg
+
+
+class WrongCursor(Exception):
+    pass
+
+
+class FixAuditService(object):
+    """
+    Lookups over the FIX messages audit trail, every filter is served by an index and pages are
+    walked newest first with a (date, id) cursor instead of skips
+    """
+    connected = False
+    FILTERS = ('position_id', 'house_trade_id', 'cl_ord_id', 'order_id', 'exec_id', 'symbol')
+
+    @staticmethod
+    def connect():
+        if not FixAuditService.connected:
+            mongoengine.connect(**settings.MONGO_DATABASES['fix_trades'])
+            FixAuditService.connected = True
+
+    @staticmethod
+    def encode_cursor(msg):
+        return '%d_%s' % (calendar.timegm(msg.date.utctimetuple()) * 1000000 + msg.date.microsecond, msg.id)
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            micros, id = cursor.split('_')
+            micros = int(micros)
+            return datetime.utcfromtimestamp(micros // 1000000).replace(microsecond=micros % 1000000), ObjectId(id)
+        except Exception:
+            raise WrongCursor
+
+    @staticmethod
+    def find(date_from=None, date_to=None, cursor=None, limit=None, **filters):
+        """
+        Returns up to `limit` messages matching the `FILTERS` and date range, newest first,
+        and the cursor of the next page or None on the last one
+        """
+        limit = max(1, min(limit or 100, getattr(settings, 'FIX_AUDIT_MAX_PAGE', 500)))
+        query = mongoengine.Q(**dict((key, value) for key, value in filters.items() if key in FixAuditService.FILTERS and value is not None))
+        if date_from is not None:
+            query &= mongoengine.Q(date__gte=date_from)
+        if date_to is not None:
+            query &= mongoengine.Q(date__lt=date_to)
+        if cursor is not None:
+            date, id = FixAuditService.decode_cursor(cursor)
+            query &= mongoengine.Q(date__lt=date) | mongoengine.Q(date=date, id__lt=id)
+
+        FixAuditService.connect()
+        messages = list(FixTradeMsg.objects(query).order_by('-date', '-id').limit(limit + 1))
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = FixAuditService.encode_cursor(messages[-1])
+        return messages, next_cursor
+
+    @staticmethod
+    def backfill(batch_size=1000):
+        """
+        Extracts the lookup fields of the messages saved before they were indexed, walking the
+        collection in _id order. Returns the number of messages updated.
+        """
+        FixAuditService.connect()
+        collection = FixTradeMsg._get_collection()
+        fields = ('message',) + FixAuditService.FILTERS
+        updated = 0
+        last_id = None
+        while True:
+            spec = {} if last_id is None else {'_id': {'$gt': last_id}}
+            rows = list(collection.find(spec, dict((field, 1) for field in fields)).sort('_id', 1).limit(batch_size))
+            if not rows:
+                return updated
+            last_id = rows[-1]['_id']
+            bulk = None
+            for row in rows:
+                if any(field in row for field in FixAuditService.FILTERS):
+                    continue
+                keys = FixTradeMsg.extract_keys(row.get('message') or {})
+                if keys:
+                    bulk = bulk or collection.initialize_unordered_bulk_op()
+                    bulk.find({'_id': row['_id']}).update({'$set': keys})
+                    updated += 1
+            if bulk is not None:
+                bulk.execute()
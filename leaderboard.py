@@ -0,0 +1,227 @@
+"""
+Trader rankings kept in Redis sorted sets, so top N and rank queries are O(log n) instead of
+sorting Profitability on every request. Boards are overall, per asset class and per instrument,
+each ranked by PnL converted to the CROSS_RATE_BASE currency and by win rate. Every full close
+updates the boards of its position from a task, once the close committed, and a periodic
+reconciliation rebuilds them from the database.
+"""
+import math
+from collections import defaultdict
+from decimal import Decimal
+
+import redis
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Count
+
+from accounts.models import Profitability
+from currency.models import Currency
+from currency.service import CurrencyService
+from trade import consts
+from .cross_rates import cross_rates
+from .models import Instrument, Position, ArchivedPosition
+
+
+METRIC_PNL = 'pnl'
+METRIC_WIN_RATE = 'win_rate'
+METRICS = (METRIC_PNL, METRIC_WIN_RATE)
+OVERALL = 'overall'
+
+#KEYS: pnl set, win rate set, stats hash; ARGV: user id, pnl, won, minimum positions
+RECORD_CLOSE = """
+redis.call('ZINCRBY', KEYS[1], ARGV[2], ARGV[1])
+local positions = redis.call('HINCRBY', KEYS[3], ARGV[1] .. ':positions', 1)
+local wins = redis.call('HINCRBY', KEYS[3], ARGV[1] .. ':wins', ARGV[3])
+if positions >= tonumber(ARGV[4]) then
+    redis.call('ZADD', KEYS[2], wins / positions, ARGV[1])
+end
+"""
+
+
+def asset_class_board(asset_class):
+    return 'asset:%s' % asset_class
+
+
+def instrument_board(instrument_id):
+    return 'instrument:%s' % instrument_id
+
+
+class Leaderboard(object):
+    connection = None
+    record_script = None
+    board_currency = None
+
+    @staticmethod
+    def redis():
+        if Leaderboard.connection is None:
+            Leaderboard.connection = redis.StrictRedis.from_url(getattr(settings, 'LEADERBOARD_REDIS_URL', 'redis://localhost:6379/0'))
+            Leaderboard.record_script = Leaderboard.connection.register_script(RECORD_CLOSE)
+        return Leaderboard.connection
+
+    @staticmethod
+    def key(board, metric):
+        return 'leaderboard:%s:%s' % (board, metric)
+
+    @staticmethod
+    def min_positions():
+        #a single lucky trade should not top the win rate boards
+        return getattr(settings, 'LEADERBOARD_MIN_POSITIONS', 10)
+
+    @staticmethod
+    def boards(instrument):
+        return OVERALL, asset_class_board(instrument.asset_class), instrument_board(instrument.pk)
+
+    @staticmethod
+    def currency():
+        """
+        The currency all PnL boards are ranked in
+        """
+        if Leaderboard.board_currency is None:
+            Leaderboard.board_currency = Currency.objects.get(code=getattr(settings, 'CROSS_RATE_BASE', 'USD'))
+        return Leaderboard.board_currency
+
+    @staticmethod
+    def factor(currency):
+        """
+        Rate from a currency to the board currency, from CurrencyService when the cross rates do not price it
+        """
+        board_currency = Leaderboard.currency()
+        rate = cross_rates.rate(currency.pk, board_currency.pk)
+        if math.isnan(rate):
+            #a million units, so the rate survives the quantization of the board currency
+            rate = float(CurrencyService.convert_value(currency, board_currency, Decimal(10 ** 6))) / 10 ** 6
+        return rate
+
+    @staticmethod
+    def record_close(position):
+        """
+        Queues the count of a fully closed position with its PnL in the board currency. The task
+        runs once the close had time to commit, a close rolled back in the meantime is not counted.
+        """
+        from .tasks import record_leaderboard_close
+        score = float(position.pnl) * Leaderboard.factor(position.instrument.quote_asset)
+        record_leaderboard_close.apply_async(
+            (position.pk, score),
+            countdown=getattr(settings, 'LEADERBOARD_RECORD_DELAY', 5)
+        )
+
+    @staticmethod
+    def record_committed_close(position_id, score):
+        """
+        Counts a position the database shows as closed, at most once. Returns False when it was not counted.
+        """
+        try:
+            position = Position.objects.select_related('instrument').get(pk=position_id, state=consts.STATE_CLOSED)
+        except Position.DoesNotExist:
+            return False
+        client = Leaderboard.redis()
+        #a retried close or task must not count the position twice, reconcile outlives the marker
+        if not client.set('leaderboard:recorded:%s' % position_id, 1, nx=True, ex=7 * 24 * 3600):
+            return False
+        won = 1 if position.pnl > 0 else 0
+        pipe = client.pipeline()
+        for board in Leaderboard.boards(position.instrument):
+            Leaderboard.record_script(
+                keys=[Leaderboard.key(board, METRIC_PNL), Leaderboard.key(board, METRIC_WIN_RATE), Leaderboard.key(board, 'stats')],
+                args=[position.user_id, score, won, Leaderboard.min_positions()],
+                client=pipe
+            )
+        pipe.execute()
+        return True
+
+    @staticmethod
+    def top(board=OVERALL, metric=METRIC_PNL, limit=10, offset=0):
+        """
+        Returns [(user id, score)] of the best ranked users
+        """
+        rows = Leaderboard.redis().zrevrange(Leaderboard.key(board, metric), offset, offset + limit - 1, withscores=True)
+        return [(int(user_id), score) for user_id, score in rows]
+
+    @staticmethod
+    def rank(user_id, board=OVERALL, metric=METRIC_PNL):
+        """
+        Returns (1 based rank, score) of the user or None when the user is not ranked on the board
+        """
+        key = Leaderboard.key(board, metric)
+        pipe = Leaderboard.redis().pipeline()
+        pipe.zrevrank(key, user_id)
+        pipe.zscore(key, user_id)
+        rank, score = pipe.execute()
+        if rank is None:
+            return None
+        return rank + 1, score
+
+    @staticmethod
+    def size(board=OVERALL, metric=METRIC_PNL):
+        return Leaderboard.redis().zcard(Leaderboard.key(board, metric))
+
+    @staticmethod
+    def reconcile():
+        """
+        Rebuilds every board from Profitability and the closed positions. Boards are written under
+        temporary keys and renamed over the live ones, so readers never see a partial board.
+        Returns the number of boards written.
+        """
+        asset_classes = dict(Instrument.objects.values_list('pk', 'asset_class'))
+        pnl = defaultdict(dict)
+        positions = defaultdict(lambda: defaultdict(int))
+        wins = defaultdict(lambda: defaultdict(int))
+
+        rows = list(Profitability.objects.values_list('user_id', 'asset_class', 'instrument_id', 'pnl', 'positions'))
+        #Profitability is in the currency of each user, the boards in the board currency
+        currencies = dict(
+            (user_id, cross_rates.user_currency(user))
+            for user_id, user in User.objects.in_bulk(set(row[0] for row in rows)).items()
+        )
+        factors = dict(
+            (currency.pk, Leaderboard.factor(currency))
+            for currency in dict((currency.pk, currency) for currency in currencies.values()).values()
+        )
+        for user_id, asset_class, instrument_id, value, count in rows:
+            if instrument_id is not None:
+                board = instrument_board(instrument_id)
+            elif asset_class is not None:
+                board = asset_class_board(asset_class)
+            else:
+                board = OVERALL
+            pnl[board][user_id] = float(value) * factors[currencies[user_id].pk]
+            positions[board][user_id] = count
+
+        #Profitability has no win counts, they come from the closed positions
+        for model in (Position, ArchivedPosition):
+            for row in model.objects.filter(
+                state=consts.STATE_CLOSED,
+                pnl__gt=0
+            ).values('user_id', 'instrument_id').annotate(wins=Count('pk')):
+                for board in (OVERALL, asset_class_board(asset_classes[row['instrument_id']]), instrument_board(row['instrument_id'])):
+                    wins[board][row['user_id']] += row['wins']
+
+        client = Leaderboard.redis()
+        live = set(key.split(':', 1)[1].rsplit(':', 1)[0] for key in client.scan_iter('leaderboard:*:stats'))
+        minimum = Leaderboard.min_positions()
+        for board in set(pnl) | live:
+            temporary = dict((name, Leaderboard.key(board, name) + ':rebuild') for name in METRICS + ('stats', ))
+            pipe = client.pipeline()
+            pipe.delete(*temporary.values())
+            rates = {}
+            if pnl[board]:
+                stats = {}
+                for user_id, count in positions[board].items():
+                    won = wins[board][user_id]
+                    stats['%s:positions' % user_id] = count
+                    stats['%s:wins' % user_id] = won
+                    if count >= minimum:
+                        rates[str(user_id)] = float(won) / count
+                pipe.zadd(temporary[METRIC_PNL], **dict((str(user_id), value) for user_id, value in pnl[board].items()))
+                pipe.hmset(temporary['stats'], stats)
+                if rates:
+                    pipe.zadd(temporary[METRIC_WIN_RATE], **rates)
+            for name, key in temporary.items():
+                #renaming a missing key fails, boards left empty are dropped instead
+                if not pnl[board] or (name == METRIC_WIN_RATE and not rates):
+                    pipe.delete(Leaderboard.key(board, name))
+                else:
+                    pipe.rename(key, Leaderboard.key(board, name))
+            pipe.execute()
+        return len(set(pnl) | live)
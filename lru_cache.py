@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Small in-process LRU cache with an optional per-entry time to live
+    """
+
+    def __init__(self, max_size=128, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            return default
+        if expires is not None and expires < time.time():
+            return default
+        #re-insert to mark as most recently used
+        self._data[key] = (value, expires)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        self._data.pop(key, None)
+        self._data[key] = (value, expires)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
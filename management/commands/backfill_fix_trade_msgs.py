@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from trade.fix_audit import FixAuditService
+
+
+class Command(BaseCommand):
+    help = 'Extracts the indexed lookup fields of FIX messages saved before they existed'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Updated %d messages' % FixAuditService.backfill())
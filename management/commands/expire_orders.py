@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from trade.order_expiry import OrderExpiryWorker
+
+
+class Command(BaseCommand):
+    help = 'Expires good-till-time and good-for-day conditional orders'
+
+    def handle(self, *args, **options):
+        OrderExpiryWorker().run()
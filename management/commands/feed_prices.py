@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.pubsub import Connection, Consumer
+from utils.pubsub_conf import PUBSUB_RATES_CONFIG
+
+from trade.tick_ring import PriceFeeder
+
+
+class Command(BaseCommand):
+    help = 'Consumes the rates once per host and feeds the socket workers through the shared memory tick ring'
+
+    def handle(self, *args, **options):
+        feeder = PriceFeeder()
+        with Connection(settings.PUBSUB_URL) as conn:
+            Consumer(conn, PUBSUB_RATES_CONFIG, callback=feeder.on_tick).run()
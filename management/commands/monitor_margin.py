@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.pubsub import Connection, Consumer
+from utils.pubsub_conf import PUBSUB_RATES_CONFIG
+
+from trade.margin_monitor import MarginMonitor
+
+
+class Command(BaseCommand):
+    help = 'Liquidates accounts whose equity falls below the maintenance margin level'
+
+    def handle(self, *args, **options):
+        monitor = MarginMonitor()
+        monitor.refresh()
+        with Connection(settings.PUBSUB_URL) as conn:
+            Consumer(conn, PUBSUB_RATES_CONFIG, callback=monitor.on_rates).run()
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.pubsub import Connection, Consumer
+from utils.pubsub_conf import PUBSUB_RATES_CONFIG
+
+from trade.tick_recorder import TickRecorder
+
+
+class Command(BaseCommand):
+    help = 'Records the raw rates ticks into memory mapped segment files'
+
+    def handle(self, *args, **options):
+        recorder = TickRecorder()
+        try:
+            with Connection(settings.PUBSUB_URL) as conn:
+                Consumer(conn, PUBSUB_RATES_CONFIG, callback=recorder.record).run()
+        finally:
+            recorder.close()
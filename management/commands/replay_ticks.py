@@ -0,0 +1,61 @@
+import calendar
+from datetime import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from trade.tick_recorder import TickReplayer
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return calendar.timegm(datetime.strptime(value, '%Y-%m-%d %H:%M:%S').utctimetuple())
+
+
+class Command(BaseCommand):
+    help = 'Replays recorded rates ticks in process through the socket broadcast or to the replay pubsub channel'
+    option_list = BaseCommand.option_list + (
+        make_option('--from', dest='date_from', help='Epoch seconds or "YYYY-MM-DD HH:MM:SS" UTC'),
+        make_option('--to', dest='date_to', help='Epoch seconds or "YYYY-MM-DD HH:MM:SS" UTC'),
+        make_option('--speed', dest='speed', type='float', default=1.0,
+                    help='Pace multiplier, 0 replays as fast as possible'),
+        make_option('--target', dest='target', default='local', choices=('local', 'pubsub'),
+                    help='local calls InstrumentsPriceNamespace.broadcast_message without writing the rates '
+                         'cache or the candles, pubsub publishes to PUBSUB_REPLAY_RATES_CONFIG, never to the '
+                         'live rates channel'),
+        make_option('--directory', dest='directory', help='Segments directory, TICK_RECORD_DIR by default'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            date_from = parse_time(options['date_from'])
+            date_to = parse_time(options['date_to'])
+        except ValueError:
+            raise CommandError('Wrong time, use epoch seconds or "YYYY-MM-DD HH:MM:SS"')
+        replayer = TickReplayer(options['directory'])
+
+        if options['target'] == 'local':
+            from trade.socketio_namespaces import InstrumentsPriceNamespace, candle_builder
+            #the live rates and chart history stay untouched, order triggers, the margin monitor and
+            #fills read them
+            InstrumentsPriceNamespace.store_rates = False
+            candle_builder.persist_types = frozenset()
+            replayed = replayer.replay(InstrumentsPriceNamespace.broadcast_message, date_from, date_to, options['speed'])
+        else:
+            from utils import pubsub_conf
+            from utils.pubsub import Connection, Publisher
+            #replayed ticks must not reach the live consumers, they go to a channel of their own
+            config = getattr(pubsub_conf, 'PUBSUB_REPLAY_RATES_CONFIG', None)
+            if config is None:
+                raise CommandError('PUBSUB_REPLAY_RATES_CONFIG is not configured')
+            if config == getattr(pubsub_conf, 'PUBSUB_RATES_CONFIG', None):
+                raise CommandError('PUBSUB_REPLAY_RATES_CONFIG must not be the live rates channel')
+            with Connection(settings.PUBSUB_URL) as conn:
+                publisher = Publisher(conn, config)
+                replayed = replayer.replay(publisher.publish, date_from, date_to, options['speed'])
+        self.stdout.write('Replayed %d ticks' % replayed)
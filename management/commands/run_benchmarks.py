@@ -0,0 +1,61 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.runner import DiscoverRunner
+
+from trade import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Runs the pricing, serializer and broadcast micro-benchmarks and compares them with the baseline of this host'
+    option_list = BaseCommand.option_list + (
+        make_option('--baseline', dest='baseline', help='Baseline file, BENCHMARK_BASELINE or benchmarks_baseline.json next to this command by default'),
+        make_option('--save', dest='save', action='store_true', default=False,
+                    help='Stores the results as the new baseline of this host'),
+        make_option('--threshold', dest='threshold', type='float', default=10.0,
+                    help='Percent drop in ops/sec reported as a regression'),
+        make_option('--min-time', dest='min_time', type='float', default=0.2,
+                    help='Seconds each timed run lasts at least'),
+        make_option('--repeat', dest='repeat', type='int', default=5, help='Timed runs, the best one is kept'),
+        make_option('--only', dest='only', action='append', help='Runs only the named benchmark, repeatable'),
+    )
+
+    def handle(self, *args, **options):
+        engine = settings.DATABASES['default']['ENGINE']
+        if not engine.endswith('sqlite3'):
+            self.stderr.write('Database engine is %s, numbers are only comparable on the in-memory sqlite test database' % engine)
+        #never the real databases, the serializer path queries the test ones
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            results = benchmarks.run(options['min_time'], options['repeat'], options['only'])
+        finally:
+            runner.teardown_databases(old_config)
+
+        baseline_host, baseline = benchmarks.load_baseline(options['baseline'])
+        if baseline_host is not None and baseline_host != benchmarks.host():
+            self.stderr.write('No baseline of %s yet, comparing with the one of %s' % (benchmarks.host(), baseline_host))
+        regressions = []
+        self.stdout.write('reference workload: %.1f ops/sec, changes are relative to it' % results[benchmarks.REFERENCE]['ops'])
+        self.stdout.write('%-36s %14s %14s %9s %8s %8s' % ('benchmark', 'ops/sec', 'baseline', 'change', 'retained', 'rss kb'))
+        for name, ops, previous, change, regressed in benchmarks.compare(results, baseline, options['threshold']):
+            self.stdout.write('%-36s %14.1f %14s %9s %8d %8d%s' % (
+                name,
+                ops,
+                '%.1f' % previous if previous else '-',
+                '%+.1f%%' % change if change is not None else '-',
+                results[name]['retained'],
+                results[name]['max_rss_kb'],
+                '  REGRESSION' if regressed else ''
+            ))
+            if regressed:
+                regressions.append(name)
+
+        if options['save']:
+            benchmarks.save_baseline(results, options['baseline'])
+            self.stdout.write('Baseline saved')
+        elif regressions:
+            raise CommandError('%d benchmarks regressed over %.0f%%: %s' % (
+                len(regressions), options['threshold'], ', '.join(regressions)
+            ))
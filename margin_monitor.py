@@ -0,0 +1,205 @@
+import logging
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from trade import consts
+from wallet.service import WalletService
+from .cross_rates import cross_rates
+from .models import Instrument, Position
+from .pricing import PriceScale, to_units, FACTOR_DECIMALS
+from .service import TradeService
+from .spread_tiers import spread_tiers
+
+
+logger = logging.getLogger(__name__)
+
+OPEN_STATES = (consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED)
+
+
+class Account(object):
+    """
+    Equity inputs of one user. Exposure per instrument is kept as
+    [long amount, long cost, short amount, short cost, upnl, margin, converted margin,
+    converted upnl, unpriced] so the upnl of an instrument is re-evaluated in O(1) whatever the
+    number of positions in it. Costs, upnl and margin are in the quote currency of the instrument,
+    the converted ones and the account totals in the currency of the user. Money and rates are
+    fixed point ints of the pricing units, upnl is valued on the quotes of the user spread tier.
+    """
+    __slots__ = ('cash', 'currency', 'tier', 'margin', 'upnl', 'unpriced', 'exposures')
+
+    def __init__(self, cash, currency, tier):
+        self.cash = cash
+        self.currency = currency
+        self.tier = tier
+        self.margin = 0
+        self.upnl = 0
+        #exposures whose quote currency has no cross rate to the user currency
+        self.unpriced = 0
+        self.exposures = {}
+
+    def equity(self):
+        return self.cash + self.margin + self.upnl
+
+
+class MarginMonitor(object):
+    """
+    Watches account equity on every tick and liquidates accounts that fall below the
+    maintenance level. Only the holders of the ticked instrument are re-evaluated, their margin and
+    upnl in it converted to the user currency with the cross rates. Accounts with an exposure
+    that cannot be converted are not liquidated.
+    """
+
+    def __init__(self, maintenance_level=None, refresh_interval=None):
+        if maintenance_level is None:
+            maintenance_level = getattr(settings, 'MARGIN_MAINTENANCE_LEVEL', '0.5')
+        #hundredths, so the check stays in ints
+        self.maintenance_level = to_units(str(maintenance_level), FACTOR_DECIMALS)
+        self.refresh_interval = refresh_interval or getattr(settings, 'MARGIN_MONITOR_REFRESH_INTERVAL', 5)
+        #closes are asynchronous, do not liquidate the same account again until they had time to fill
+        self.liquidation_cooldown = timedelta(seconds=getattr(settings, 'MARGIN_LIQUIDATION_COOLDOWN', 30))
+        self.liquidations = {}
+        self.accounts = {}
+        self.holders = defaultdict(set)
+        #instrument id -> {tier: (sell, buy)}
+        self.rates = {}
+        self.instrument_ids = {}
+        self.quote_assets = {}
+        self.scales = {}
+        self.load_instruments()
+        self.last_refresh = None
+
+    def load_instruments(self):
+        instruments = list(Instrument.objects.all())
+        self.instrument_ids = dict((instrument.url_slug, instrument.pk) for instrument in instruments)
+        self.quote_assets = dict((instrument.pk, instrument.quote_asset_id) for instrument in instruments)
+        self.scales = dict((instrument.pk, PriceScale.of(instrument)) for instrument in instruments)
+
+    def load_accounts(self, user_ids=None):
+        """
+        (Re)builds the aggregates of the given users, of every user holding open positions if None
+        """
+        positions = Position.objects.filter(state__in=OPEN_STATES)
+        if user_ids is not None:
+            positions = positions.filter(user_id__in=user_ids)
+            for user_id in user_ids:
+                self._drop_account(user_id)
+        rows = list(positions.values_list('user_id', 'instrument_id', 'side', 'amount', 'open_rate', 'current_margin'))
+
+        users = User.objects.in_bulk(set(row[0] for row in rows))
+        for user_id, user in users.items():
+            self.accounts[user_id] = Account(
+                to_units(WalletService(user).get_useful_balance()),
+                cross_rates.user_currency(user).pk,
+                spread_tiers.tier_of(user)
+            )
+        for user_id, instrument_id, side, amount, open_rate, current_margin in rows:
+            account = self.accounts[user_id]
+            open_rate = to_units(open_rate)
+            exposure = account.exposures.get(instrument_id)
+            if exposure is None:
+                exposure = account.exposures[instrument_id] = [0, 0, 0, 0, 0, 0, 0, 0, False]
+                self.holders[instrument_id].add(user_id)
+            exposure[5] += to_units(current_margin)
+            if side == consts.TYPE_BUY:
+                exposure[0] += amount
+                exposure[1] += amount * open_rate
+            else:
+                exposure[2] += amount
+                exposure[3] += amount * open_rate
+        for user_id in users:
+            account = self.accounts[user_id]
+            for instrument_id in account.exposures:
+                self._revalue(account, instrument_id)
+            if account.unpriced:
+                logger.warning('Account of user %s has positions without a cross rate to its currency, not monitored', user_id)
+
+    def refresh(self):
+        """
+        Reloads the accounts whose positions changed since the previous refresh
+        """
+        now = timezone.now()
+        #instruments added since the previous refresh are monitored too
+        self.load_instruments()
+        if self.last_refresh is None:
+            self.load_accounts()
+        else:
+            #overlap the previous refresh so rows committed late are not missed
+            user_ids = set(Position.objects.filter(
+                last_modified__gte=self.last_refresh - timedelta(seconds=self.refresh_interval)
+            ).values_list('user_id', flat=True))
+            if user_ids:
+                self.load_accounts(user_ids)
+        self.last_refresh = now
+
+    def on_rates(self, msg):
+        instrument_id = self.instrument_ids.get(msg['asset'])
+        if instrument_id is not None:
+            #the raw rates quoted like the socket workers quote every tier
+            scale = self.scales[instrument_id]
+            self.rates[instrument_id] = dict(
+                (tier, (quotes['sell'], quotes['buy']))
+                for tier, quotes in spread_tiers.tier_units(scale, scale.quote_units(msg)).items()
+            )
+            for user_id in list(self.holders.get(instrument_id, ())):
+                account = self.accounts[user_id]
+                self._revalue(account, instrument_id)
+                if self.is_below_maintenance(account) and not self.is_liquidating(user_id):
+                    self.liquidate(user_id)
+
+        if self.last_refresh is None or timezone.now() - self.last_refresh > timedelta(seconds=self.refresh_interval):
+            self.refresh()
+
+    def is_below_maintenance(self, account):
+        if account.unpriced or account.margin <= 0:
+            return False
+        return account.equity() * 10 ** FACTOR_DECIMALS < account.margin * self.maintenance_level
+
+    def is_liquidating(self, user_id):
+        started = self.liquidations.get(user_id)
+        if started is None:
+            return False
+        if timezone.now() - started > self.liquidation_cooldown:
+            del self.liquidations[user_id]
+            return False
+        return True
+
+    def liquidate(self, user_id):
+        #recheck against fresh positions and balance before closing anything
+        self.load_accounts([user_id])
+        account = self.accounts.get(user_id)
+        if account is None or not self.is_below_maintenance(account):
+            return
+        self.liquidations[user_id] = timezone.now()
+        positions = Position.objects.filter(
+            user_id=user_id,
+            state__in=OPEN_STATES
+        ).select_related('instrument', 'user')
+        for position in positions:
+            TradeService.close_position(position, position.amount)
+
+    def _revalue(self, account, instrument_id):
+        exposure = account.exposures[instrument_id]
+        rates = self.rates.get(instrument_id)
+        if rates is not None:
+            sell, buy = rates[account.tier]
+            #longs close on the sell rate, shorts on the buy rate
+            exposure[4] = sell * exposure[0] - exposure[1] + exposure[3] - buy * exposure[2]
+        rate = cross_rates.rate(self.quote_assets.get(instrument_id), account.currency)
+        unpriced = math.isnan(rate)
+        margin = 0 if unpriced else int(exposure[5] * rate)
+        upnl = 0 if unpriced else int(exposure[4] * rate)
+        account.margin += margin - exposure[6]
+        account.upnl += upnl - exposure[7]
+        account.unpriced += unpriced - exposure[8]
+        exposure[6:] = margin, upnl, unpriced
+
+    def _drop_account(self, user_id):
+        account = self.accounts.pop(user_id, None)
+        if account is not None:
+            for instrument_id in account.exposures:
+                self.holders[instrument_id].discard(user_id)
@@ -1,7 +1,6 @@
-from datetime import timedelta
-from decimal import Decimal, ROUND_DOWN, ROUND_UP
+from datetime import datetime, timedelta
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.db.utils import IntegrityError
 from django.utils import timezone
@@ -11,6 +10,7 @@ from timezone_field import TimeZoneField
 from easy_thumbnails.fields import ThumbnailerImageField
 
 from tc_instruments import models as instruments_models
+from .pricing import PriceScale
 
 from currency.models import Currency
 import consts
@@ -23,6 +23,16 @@ class OpenTimeGroup(models.Model):
     def __unicode__(self):
         return "%s (%s)" % (self.name, self.timezone)
 
+    def close_time(self, now=None):
+        """
+        Returns the end of the last open time range of the local day, None if there is no trading that day
+        """
+        local_now = timezone.localtime(now or timezone.now(), self.timezone)
+        closes = [r.time_to for r in self.opentimerange_set.all() if r.weekday == local_now.weekday()]
+        if not closes:
+            return None
+        return self.timezone.localize(datetime.combine(local_now.date(), max(closes)))
+
 
 class OpenTimeRange(models.Model):
     weekday     = models.SmallIntegerField(choices=consts.DAYS_OF_WEEK)
@@ -118,10 +128,10 @@ class Instrument(instruments_models.BaseInstrument):
         return str(self.minimum_margin) + '%'
 
     def quantize_price_down(self, value):
-        return Decimal(value).quantize(self.display_tick_size.normalize(), rounding=ROUND_DOWN)
+        return PriceScale.of(self).round_down(value)
 
     def quantize_price_up(self, value):
-        return Decimal(value).quantize(self.display_tick_size.normalize(), rounding=ROUND_UP)
+        return PriceScale.of(self).round_up(value)
 
 
 class Position(models.Model):
@@ -143,7 +153,7 @@ class Position(models.Model):
     pnl            = models.DecimalField(max_digits=25, decimal_places=2, default=0)
     open_date      = models.DateTimeField(auto_now_add=True)
     close_date      = models.DateTimeField(null=True, blank=True)
-    last_modified  = models.DateTimeField(auto_now=True)
+    last_modified  = models.DateTimeField(auto_now=True, db_index=True)
 
     def __unicode__(self):
         return "position %d" % self.pk
@@ -178,7 +188,26 @@ class Position(models.Model):
             return 0
 
 
+class OrderGroup(models.Model):
+    """
+    Linked orders submitted together, the first leg to execute cancels the others
+    """
+    user = models.ForeignKey(User, related_name='order_groups')
+    date = models.DateTimeField(auto_now_add=True)
+
+
 class Order(models.Model):
+    TIME_IN_FORCE_GTC = 0
+    TIME_IN_FORCE_GTT = 1
+    TIME_IN_FORCE_GFD = 2
+    TIMES_IN_FORCE = (
+        (TIME_IN_FORCE_GTC, 'Good till cancelled'),
+        (TIME_IN_FORCE_GTT, 'Good till time'),
+        (TIME_IN_FORCE_GFD, 'Good for day'),
+    )
+    #claimed by an execution worker while its position opens, outside the consts.ORDER_STATES values
+    STATE_EXECUTING = -1
+
     user                 = models.ForeignKey(User, related_name='orders')
     instrument           = models.ForeignKey(Instrument, related_name='orders')
     amount               = models.IntegerField(default=0)
@@ -187,8 +216,11 @@ class Order(models.Model):
     take_profit_distance = models.DecimalField(max_digits=25, decimal_places=2, null=True, blank=True)
     expected_rate        = models.DecimalField(max_digits=25, decimal_places=6)
     position             = models.OneToOneField(Position, related_name='order', null=True, blank=True)
-    state                = models.SmallIntegerField(choices=consts.ORDER_STATES)
-    open_date            = models.DateTimeField(auto_now_add=True)
+    state                = models.SmallIntegerField(choices=tuple(consts.ORDER_STATES) + ((STATE_EXECUTING, 'Executing'), ))
+    group                = models.ForeignKey(OrderGroup, related_name='orders', null=True, blank=True)
+    time_in_force        = models.SmallIntegerField(choices=TIMES_IN_FORCE, default=TIME_IN_FORCE_GTC)
+    expiry_date          = models.DateTimeField(null=True, blank=True)
+    open_date            = models.DateTimeField(auto_now_add=True, db_index=True)
     last_modified        = models.DateTimeField(auto_now=True)
 
 
@@ -222,6 +254,99 @@ class ClientTrade(models.Model):
     time           = models.DateTimeField(auto_now_add=True)
     channel        = models.SmallIntegerField(choices=consts.CHANNELS, default=consts.CHANNEL_WEB)
     house_trade    = models.ForeignKey(HouseTrade, null=True, blank=True)
+    #filled by the house and waiting for the next netting batch, older unhedged trades are never netted
+    netting_pending = models.BooleanField(default=False, db_index=True)
+
+    def get_position_state(self):
+        return dict(consts.POSITION_STATES)[self.position_state]
+
+    def get_side(self):
+        return dict(consts.SIDES)[self.side]
+
+
+class ArchivedPosition(models.Model):
+    """
+    Closed position moved out of the hot table once past the retention horizon, keeps its id.
+    Mirrors the Position columns so rows are moved with INSERT ... SELECT.
+    """
+    id             = models.IntegerField(primary_key=True)
+    user           = models.ForeignKey(User, related_name='archived_positions')
+    instrument     = models.ForeignKey(Instrument, related_name='+')
+    marketplace    = models.ForeignKey(Marketplace, related_name='+')
+    opening_amount = models.IntegerField(default=0)
+    amount         = models.IntegerField(default=0)
+    asked_rate     = models.DecimalField(max_digits=25, decimal_places=6)
+    open_rate      = models.DecimalField(max_digits=25, decimal_places=6, null=True, blank=True)
+    close_rate     = models.DecimalField(max_digits=25, decimal_places=6, null=True, blank=True)
+    side           = models.SmallIntegerField(choices=consts.SIDES)
+    stop_loss      = models.DecimalField(max_digits=25, decimal_places=6)
+    asked_stop_distance = models.DecimalField(max_digits=25, decimal_places=2, default=0)
+    take_profit    = models.DecimalField(max_digits=25, decimal_places=6, null=True, blank=True)
+    state          = models.SmallIntegerField(choices=consts.POSITION_STATES)
+    current_margin = models.DecimalField(max_digits=25, decimal_places=2)
+    pnl            = models.DecimalField(max_digits=25, decimal_places=2, default=0)
+    open_date      = models.DateTimeField()
+    close_date     = models.DateTimeField(null=True, blank=True)
+    last_modified  = models.DateTimeField()
+    #the order link is dropped from the hot order row, the id is kept here
+    order_id       = models.IntegerField(null=True, blank=True)
+    archive_date   = models.DateTimeField()
+
+    def __unicode__(self):
+        return "archived position %d" % self.pk
+
+    def is_open(self):
+        return False
+
+    def is_pending(self):
+        return False
+
+    def get_side(self):
+        return dict(consts.SIDES)[self.side]
+
+    def get_state(self):
+        return dict(consts.POSITION_STATES)[self.state]
+
+    def get_upnl(self):
+        return 0
+
+
+class ArchivedHouseTrade(models.Model):
+    id          = models.IntegerField(primary_key=True)
+    instrument  = models.ForeignKey(Instrument, related_name='+')
+    marketplace = models.ForeignKey(Marketplace, related_name='+')
+    rate        = models.DecimalField(max_digits=25, decimal_places=5)
+    amount      = models.IntegerField(default=0)
+    success     = models.BooleanField()
+    side        = models.SmallIntegerField(choices=consts.SIDES)
+    time        = models.DateTimeField()
+    archive_date = models.DateTimeField()
+
+    def __unicode__(self):
+        return "archived HouseTrade %d" % self.pk
+
+    def get_side(self):
+        return dict(consts.SIDES)[self.side]
+
+
+class ArchivedClientTrade(models.Model):
+    id             = models.IntegerField(primary_key=True)
+    user           = models.ForeignKey(User, related_name='archived_trades')
+    instrument     = models.ForeignKey(Instrument, related_name='+')
+    #same accessor as on Position so position serializers work on both
+    position       = models.ForeignKey(ArchivedPosition, related_name='clienttrade_set')
+    asked_rate     = models.DecimalField(max_digits=25, decimal_places=5)
+    rate           = models.DecimalField(max_digits=25, decimal_places=5)
+    amount         = models.IntegerField(default=0)
+    position_state = models.SmallIntegerField(choices=consts.POSITION_STATES)
+    success        = models.BooleanField()
+    side           = models.SmallIntegerField(choices=consts.SIDES)
+    time           = models.DateTimeField()
+    channel        = models.SmallIntegerField(choices=consts.CHANNELS, default=consts.CHANNEL_WEB)
+    #the house trade may still be hot or archived already
+    house_trade_id = models.IntegerField(null=True, blank=True)
+    netting_pending = models.BooleanField(default=False)
+    archive_date   = models.DateTimeField()
 
     def get_position_state(self):
         return dict(consts.POSITION_STATES)[self.position_state]
@@ -230,7 +355,25 @@ class ClientTrade(models.Model):
         return dict(consts.SIDES)[self.side]
 
 
+class ArchivedReference(models.Model):
+    """
+    Link of a row in another table listed in ARCHIVE_CLEARED_LINKS to an archived position or trade.
+    The foreign key of the row is cleared when its target is archived, the target keeps its id.
+    """
+    model        = models.CharField(max_length=100)
+    field        = models.CharField(max_length=100)
+    row_id       = models.IntegerField()
+    target_id    = models.IntegerField()
+    archive_date = models.DateTimeField()
+
+    class Meta:
+        index_together = (('model', 'field', 'row_id'), )
+
+
 class FavoriteInstrument(models.Model):
+    #positions are sparse ordering keys, moving an instrument rewrites only its own row
+    POSITION_GAP = 1024
+
     user = models.ForeignKey(User)
     instrument = models.ForeignKey(Instrument)
 
@@ -241,17 +384,12 @@ class FavoriteInstrument(models.Model):
         if not self.instrument.active:
             return None
 
-        #Get instruments count for current user
-        try:
+        #New record goes to the end of the list
+        if not self.pk:
             max_position = FavoriteInstrument.objects.filter(
-                user_id=self.user.id
-            ).order_by('-position')[0].position
-        except IndexError:
-            max_position = 0
-
-        #For new record or if position out of range will compute it
-        if not self.pk or self.position > max_position:
-            self.position = max_position + 1
+                user_id=self.user_id
+            ).aggregate(max_position=models.Max('position'))['max_position'] or 0
+            self.position = max_position + self.POSITION_GAP
 
         #It is needed because this instrument might be already in favorites
         #than exception will be raised
@@ -260,13 +398,56 @@ class FavoriteInstrument(models.Model):
         except IntegrityError:
             return None
 
-    def delete(self, *args, **kwargs):
-        super(FavoriteInstrument, self).delete(*args, **kwargs)
-        #Normalize positions
-        FavoriteInstrument.objects.filter(
-            user_id=self.user_id,
-            position__gt=self.position
-        ).update(position=models.F('position')-1)
+    def move_to(self, index):
+        """
+        Moves the instrument to the 1-based `index` in the user favorites
+        """
+        index = max(index, 1)
+        others = FavoriteInstrument.objects.filter(
+            user_id=self.user_id
+        ).exclude(pk=self.pk).order_by('position')
+        neighbours = list(others.values_list('position', flat=True)[max(index - 2, 0):index])
+
+        if index == 1:
+            before, after = 0, neighbours[0] if neighbours else None
+        elif len(neighbours) == 2:
+            before, after = neighbours
+        else:
+            #moving to the end
+            before = others.aggregate(max_position=models.Max('position'))['max_position'] or 0
+            after = None
+
+        if after is None:
+            position = before + self.POSITION_GAP
+        elif after - before > 1:
+            position = (before + after) // 2
+        else:
+            #keys are exhausted around the target, spread the whole list again
+            ordered = list(others.values_list('instrument_id', flat=True))
+            ordered.insert(index - 1, self.instrument_id)
+            FavoriteInstrument.reorder(self.user_id, ordered)
+            return
+
+        FavoriteInstrument.objects.filter(pk=self.pk).update(position=position)
+        self.position = position
+
+    @classmethod
+    def reorder(cls, user_id, instrument_ids):
+        """
+        Applies a full new ordering of the user favorites in one transaction,
+        favorites missing from `instrument_ids` keep their relative order at the end
+        """
+        with transaction.atomic():
+            current = dict(cls.objects.select_for_update().filter(
+                user_id=user_id
+            ).values_list('instrument_id', 'position'))
+            ordered = [i for i in instrument_ids if i in current]
+            seen = set(ordered)
+            ordered += [i for i, p in sorted(current.items(), key=lambda item: item[1]) if i not in seen]
+            for index, instrument_id in enumerate(ordered, 1):
+                position = index * cls.POSITION_GAP
+                if current[instrument_id] != position:
+                    cls.objects.filter(user_id=user_id, instrument_id=instrument_id).update(position=position)
 
     def __unicode__(self):
         return '%s in %s favorites' % (self.instrument.name, self.user.username)
@@ -275,6 +456,7 @@ class FavoriteInstrument(models.Model):
         unique_together = ('instrument', 'user')
         index_together = [
             ['instrument', 'user'],
+            ['user', 'position'],
         ]
 
 
@@ -287,4 +469,45 @@ class EndOfDayRate(models.Model):
         unique_together = ('instrument', 'date')
 
 
+class UserSpreadTier(models.Model):
+    """
+    Spread tier a user is quoted at, users without one get the retail tier
+    """
+    RETAIL = 'retail'
+    VIP = 'vip'
+    INTRODUCING_BROKER = 'ib'
+    TIERS = (
+        (RETAIL, 'Retail'),
+        (VIP, 'VIP'),
+        (INTRODUCING_BROKER, 'Introducing broker'),
+    )
+
+    user = models.OneToOneField(User, related_name='spread_tier')
+    tier = models.CharField(max_length=16, choices=TIERS, default=RETAIL)
+
+
+class FinancingCharge(models.Model):
+    """
+    Overnight financing charged on an open position for one business date
+    """
+    #plain id, the charges stay when the position is archived
+    position_id   = models.IntegerField()
+    user          = models.ForeignKey(User, related_name='financing_charges')
+    instrument    = models.ForeignKey(Instrument, related_name='+')
+    business_date = models.DateField(db_index=True)
+    #days up to the next business date, more than one before weekends and holidays
+    days          = models.SmallIntegerField(default=1)
+    side          = models.SmallIntegerField(choices=consts.SIDES)
+    amount        = models.IntegerField()
+    rate          = models.DecimalField(max_digits=25, decimal_places=6)
+    interest      = models.DecimalField(max_digits=25, decimal_places=6)
+    charge        = models.DecimalField(max_digits=25, decimal_places=2)
+    #posted to the wallet
+    posted        = models.BooleanField(default=False)
+    created       = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('position_id', 'business_date')
+
+
 from .signals import *
\ No newline at end of file
@@ -8,11 +8,93 @@ class FixTradeMsg(mongoengine.Document):
         (WAY_IN, 'In'),
         (WAY_OUT, 'Out')
     )
+    #message keys the lookup fields are extracted from, by FIX field name or tag number
+    KEY_FIELDS = {
+        'cl_ord_id': ('ClOrdID', '11'),
+        'order_id': ('OrderID', '37'),
+        'exec_id': ('ExecID', '17'),
+        'symbol': ('Symbol', '55'),
+    }
+    #ClOrdIDs carry the kind of the id they are made of, position trades and house hedges are
+    #numbered apart. Untagged numeric ClOrdIDs were sent for positions before the tags.
+    CL_ORD_ID_KINDS = {
+        'P': 'position_id',
+        'H': 'house_trade_id',
+    }
+    CL_ORD_ID_FIELDS = ('ClOrdID', '11')
+
     way = mongoengine.IntField(choices=DIRECTIONS)
     name = mongoengine.StringField()
     body = mongoengine.StringField()
     message = mongoengine.DictField()
     date = mongoengine.DateTimeField()
+    position_id = mongoengine.IntField()
+    house_trade_id = mongoengine.IntField()
+    cl_ord_id = mongoengine.StringField()
+    order_id = mongoengine.StringField()
+    exec_id = mongoengine.StringField()
+    symbol = mongoengine.StringField()
+
+    meta = {
+        'indexes': [
+            #pages are walked on (date, id), the id breaks ties of messages logged in the same instant
+            ('-date', '-id'),
+            {'fields': ('position_id', '-date', '-id'), 'sparse': True},
+            {'fields': ('house_trade_id', '-date', '-id'), 'sparse': True},
+            {'fields': ('cl_ord_id', '-date', '-id'), 'sparse': True},
+            {'fields': ('order_id', '-date', '-id'), 'sparse': True},
+            {'fields': ('exec_id',), 'sparse': True},
+            {'fields': ('symbol', '-date', '-id'), 'sparse': True},
+        ]
+    }
+
+    @staticmethod
+    def make_cl_ord_id(field, id):
+        """
+        ClOrdID of a position trade or a house hedge, `field` is position_id or house_trade_id
+        """
+        for kind, kind_field in FixTradeMsg.CL_ORD_ID_KINDS.items():
+            if kind_field == field:
+                return '%s%d' % (kind, id)
+        raise ValueError(field)
+
+    @staticmethod
+    def parse_cl_ord_id(cl_ord_id):
+        """
+        Returns (field, id) of a ClOrdID or None when it carries no id
+        """
+        cl_ord_id = unicode(cl_ord_id)
+        if cl_ord_id.isdigit():
+            return 'position_id', int(cl_ord_id)
+        field = FixTradeMsg.CL_ORD_ID_KINDS.get(cl_ord_id[:1])
+        if field is not None and cl_ord_id[1:].isdigit():
+            return field, int(cl_ord_id[1:])
+        return None
+
+    @staticmethod
+    def extract_keys(message):
+        """
+        Returns the indexed lookup fields found in a FIX message dict
+        """
+        keys = {}
+        for field, names in FixTradeMsg.KEY_FIELDS.items():
+            for name in names:
+                if message.get(name) not in (None, ''):
+                    keys[field] = unicode(message[name])
+                    break
+        for name in FixTradeMsg.CL_ORD_ID_FIELDS:
+            if message.get(name) not in (None, ''):
+                parsed = FixTradeMsg.parse_cl_ord_id(message[name])
+                if parsed is not None:
+                    keys[parsed[0]] = parsed[1]
+                break
+        #the explicit fields of our own requests win over the ClOrdID
+        for field in FixTradeMsg.CL_ORD_ID_KINDS.values():
+            try:
+                keys[field] = int(message[field])
+            except (KeyError, TypeError, ValueError):
+                pass
+        return keys
 
 
 class ChartHistory(mongoengine.Document):
@@ -43,4 +125,11 @@ class ChartHistory(mongoengine.Document):
     high = mongoengine.FloatField()
     low = mongoengine.FloatField()
     close = mongoengine.FloatField()
-    date = mongoengine.DateTimeField()
\ No newline at end of file
+    volume = mongoengine.IntField(default=0)
+    date = mongoengine.DateTimeField()
+
+    meta = {
+        'indexes': [
+            ('instrument', 'type', '-date'),
+        ]
+    }
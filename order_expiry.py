@@ -0,0 +1,58 @@
+import calendar
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from trade import consts
+from .models import Order
+from .service import TradeService
+from .timing_wheel import TimingWheel
+
+
+def to_timestamp(value):
+    return calendar.timegm(value.utctimetuple())
+
+
+class OrderExpiryWorker(object):
+    """
+    Keeps the deadlines of pending good-till-time and good-for-day orders in a timing wheel
+    and expires them in batches. Orders cancelled or executed meanwhile stay in the wheel
+    until their deadline and are skipped by the pending state check on expiry.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or getattr(settings, 'ORDER_EXPIRY_BATCH_SIZE', 1000)
+        self.wheel = TimingWheel(start=time.time())
+        self.last_poll = None
+
+    def load_orders(self):
+        """
+        Schedules the pending orders with a deadline placed since the last poll, all of them on the first run
+        """
+        now = timezone.now()
+        orders = Order.objects.filter(state=consts.STATE_PENDING, expiry_date__isnull=False)
+        if self.last_poll is not None:
+            #overlap the previous poll so orders committed late are not missed
+            orders = orders.filter(open_date__gte=self.last_poll - timedelta(minutes=1))
+        self.last_poll = now
+        scheduled = 0
+        for order_id, expiry_date in orders.values_list('pk', 'expiry_date').iterator():
+            if order_id not in self.wheel:
+                self.wheel.schedule(order_id, to_timestamp(expiry_date))
+                scheduled += 1
+        return scheduled
+
+    def run_once(self, now=None):
+        self.load_orders()
+        expired = self.wheel.advance(time.time() if now is None else now)
+        result = []
+        for i in range(0, len(expired), self.batch_size):
+            result.extend(TradeService.expire_orders(expired[i:i + self.batch_size]))
+        return result
+
+    def run(self, interval=1):
+        while True:
+            self.run_once()
+            time.sleep(interval)
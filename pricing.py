@@ -0,0 +1,283 @@
+"""
+Fixed point price math. Rates are ints of 10**-PRICE_DECIMALS, distances are ints of
+hundredths of a tick and percentages ints of hundredths of a percent, so the pricing
+and margin formulas run on plain ints. Decimals are only built at the persistence and
+API edges with `from_units` and `PriceScale.to_decimal`. The Decimal functions at the end
+give the same results as the Decimal formulas they replaced, falling back on those formulas
+where the fixed point ones cannot be exact.
+"""
+from decimal import Decimal
+
+from trade import consts
+
+
+#enough to keep 6 decimal rates offset by percentages and tick distances with 2 decimals exact
+PRICE_DECIMALS = 12
+PRICE_SCALE = 10 ** PRICE_DECIMALS
+#rates are stored with 6 decimals
+RATE_DECIMALS = 6
+#distances and percentages are stored with 2 decimals
+FACTOR_DECIMALS = 2
+#margin cash carries two percentage factors on top of the price decimals
+CASH_DECIMALS = PRICE_DECIMALS + 4 * FACTOR_DECIMALS
+
+RATE_KEYS = ('sell', 'buy', 'low', 'high')
+
+
+def to_units(value, decimals=PRICE_DECIMALS, away_from_zero=False):
+    """
+    Converts a number to an int of 10**-decimals, extra digits are truncated toward zero or,
+    with `away_from_zero`, rounded away from it
+    """
+    if isinstance(value, (int, long)):
+        return value * 10 ** decimals
+    if isinstance(value, basestring) and 'e' not in value and 'E' not in value:
+        value = value.strip()
+        negative = value.startswith('-')
+        whole, dot, fraction = value.lstrip('+-').partition('.')
+        units = int(whole or 0) * 10 ** decimals + int((fraction + '0' * decimals)[:decimals] or 0)
+        rest = fraction[decimals:].strip('0')
+    else:
+        #from the digits, Decimal.scaleb would round to the context precision first
+        negative, digits, exponent = Decimal(value).as_tuple()
+        units = int(''.join(map(str, digits)))
+        if exponent + decimals >= 0:
+            units, rest = units * 10 ** (exponent + decimals), 0
+        else:
+            units, rest = divmod(units, 10 ** -(exponent + decimals))
+    if away_from_zero and rest:
+        units += 1
+    return -units if negative else units
+
+
+def fits(value, decimals=PRICE_DECIMALS):
+    """
+    True when the number has no more than `decimals` decimals, so `to_units` is exact
+    """
+    return isinstance(value, (int, long)) or Decimal(value).as_tuple().exponent >= -decimals
+
+
+def from_units(units, decimals=PRICE_DECIMALS):
+    return Decimal(units).scaleb(-decimals)
+
+
+def to_rate_decimal(units):
+    """
+    Units as a Decimal with the decimals of the stored rates
+    """
+    return from_units(units // 10 ** (PRICE_DECIMALS - RATE_DECIMALS), RATE_DECIMALS)
+
+
+def side_multiplier(side, is_take_profit=False):
+    if side == consts.TYPE_BUY:
+        multiplier = 1
+    else:
+        multiplier = -1
+    if is_take_profit:
+        multiplier *= -1
+    return multiplier
+
+
+class PriceScale(object):
+    """
+    Integer constants of one instrument, built once per instrument object
+    """
+    __slots__ = ('exponent', 'quantum', 'tick', 'minimum_stop_distance', 'stop_distance_absolute',
+                 'minimum_margin', 'minimum_margin_absolute', 'slippage', 'slippage_absolute', 'exact_stops')
+
+    def __init__(self, instrument):
+        #quantize uses only the exponent of the normalized display tick size
+        self.exponent = instrument.display_tick_size.normalize().as_tuple().exponent
+        self.quantum = 10 ** (PRICE_DECIMALS + self.exponent)
+        self.tick = to_units(instrument.tick_size)
+        self.minimum_stop_distance = to_units(instrument.minimum_stop_distance, FACTOR_DECIMALS)
+        self.stop_distance_absolute = instrument.stop_distance_absolute
+        self.minimum_margin = to_units(instrument.minimum_margin, FACTOR_DECIMALS)
+        self.minimum_margin_absolute = instrument.minimum_margin_absolute
+        self.slippage = to_units(instrument.slippage, FACTOR_DECIMALS)
+        self.slippage_absolute = instrument.slippage_absolute
+        #a relative minimum stop in ticks only terminates when the tick size has no prime factors
+        #but 2 and 5, on ticks like 0.03 the Decimal formula rounds it and the ints cannot follow
+        tick = self.tick
+        for factor in (2, 5):
+            while tick and tick % factor == 0:
+                tick //= factor
+        self.exact_stops = self.stop_distance_absolute or tick == 1
+
+    @staticmethod
+    def of(instrument):
+        scale = instrument.__dict__.get('_price_scale')
+        if scale is None:
+            scale = instrument.__dict__['_price_scale'] = PriceScale(instrument)
+        return scale
+
+    def quantize_down(self, units):
+        if units >= 0:
+            return units // self.quantum * self.quantum
+        return -(-units // self.quantum * self.quantum)
+
+    def quantize_up(self, units):
+        if units >= 0:
+            return -(-units // self.quantum) * self.quantum
+        return -((-units + self.quantum - 1) // self.quantum * self.quantum)
+
+    def to_decimal(self, units):
+        """
+        Quantized units as a Decimal with the display exponent
+        """
+        return Decimal(units // self.quantum).scaleb(self.exponent)
+
+    def round_down(self, value):
+        """
+        Number quantized down to the display tick size as a Decimal
+        """
+        return self.to_decimal(self.quantize_down(to_units(value)))
+
+    def round_up(self, value):
+        """
+        Number quantized up to the display tick size as a Decimal
+        """
+        return self.to_decimal(self.quantize_up(to_units(value, away_from_zero=True)))
+
+    def quote_units(self, rates):
+        return dict((key, self.quantize_down(to_units(rates[key]))) for key in RATE_KEYS)
+
+    def quote(self, rates):
+        return dict((key, self.to_decimal(units)) for key, units in self.quote_units(rates).items())
+
+    def distance_to_rate(self, side, distance, rate, is_take_profit=False):
+        """
+        `distance` in hundredths of a tick, `rate` and result in units
+        """
+        return rate - distance * self.tick // 10 ** FACTOR_DECIMALS * side_multiplier(side, is_take_profit)
+
+    def rate_to_distance(self, side, distance_rate, open_rate, is_take_profit=False):
+        """
+        Returns the distance in ticks as a numerator and denominator pair
+        """
+        return (open_rate - distance_rate) * side_multiplier(side, is_take_profit), self.tick
+
+    def minimum_stop_offset(self, rate):
+        """
+        Minimum stop distance as a rate offset in units
+        """
+        if self.stop_distance_absolute:
+            return self.minimum_stop_distance * self.tick // 10 ** FACTOR_DECIMALS
+        return self.minimum_stop_distance * rate // 10 ** (2 * FACTOR_DECIMALS)
+
+    def stoploss_rate(self, side, distance, rate):
+        offset = max(distance * self.tick // 10 ** FACTOR_DECIMALS, self.minimum_stop_offset(rate))
+        return rate - offset * side_multiplier(side)
+
+    def margin(self, stop_loss_rate, amount, rate):
+        """
+        Cash required for margin in ints of 10**-CASH_DECIMALS
+        """
+        to_cash = 10 ** (CASH_DECIMALS - PRICE_DECIMALS)
+        if self.minimum_margin_absolute:
+            minimum_margin = self.minimum_margin * self.tick * to_cash // 10 ** FACTOR_DECIMALS
+        else:
+            minimum_margin = self.minimum_margin * rate * to_cash // 10 ** (2 * FACTOR_DECIMALS)
+
+        stop_distance = abs(rate - stop_loss_rate) * to_cash
+
+        if self.slippage_absolute:
+            slippage = self.slippage * self.tick * to_cash // 10 ** FACTOR_DECIMALS
+        else:
+            slippage = self.slippage * minimum_margin // 10 ** (2 * FACTOR_DECIMALS)
+
+        return (max(stop_distance, minimum_margin) + slippage) * amount
+
+
+def pnl(side, amount, open_rate, close_rate):
+    return side_multiplier(side) * (close_rate - open_rate) * amount
+
+
+def minimum_stop_distance(instrument, rate):
+    """
+    Minimum stop distance of the instrument in ticks at a Decimal rate
+    """
+    if not fits(rate, PRICE_DECIMALS - 2 * FACTOR_DECIMALS):
+        if instrument.stop_distance_absolute:
+            return instrument.minimum_stop_distance
+        return Decimal(instrument.minimum_stop_distance) / 100 * rate / instrument.tick_size
+    scale = PriceScale.of(instrument)
+    return Decimal(scale.minimum_stop_offset(to_units(rate))) / Decimal(scale.tick)
+
+
+def stoploss_rate(instrument, distance, rate, side):
+    """
+    Stop loss rate at `distance` ticks from a Decimal rate, at least the minimum stop distance away
+    """
+    scale = PriceScale.of(instrument)
+    if scale.exact_stops and fits(distance, FACTOR_DECIMALS) and fits(rate, PRICE_DECIMALS - 2 * FACTOR_DECIMALS):
+        return from_units(scale.stoploss_rate(side, to_units(distance, FACTOR_DECIMALS), to_units(rate)))
+    minimum = minimum_stop_distance(instrument, rate)
+    if distance < minimum:
+        distance = minimum
+    return Decimal(rate) - Decimal(distance) * instrument.tick_size * side_multiplier(side)
+
+
+def distance_to_rate(instrument, side, distance, rate, is_take_profit=False):
+    if fits(distance, FACTOR_DECIMALS) and fits(rate):
+        return from_units(PriceScale.of(instrument).distance_to_rate(
+            side,
+            to_units(distance, FACTOR_DECIMALS),
+            to_units(rate),
+            is_take_profit
+        ))
+    return Decimal(rate) - Decimal(distance) * instrument.tick_size * side_multiplier(side, is_take_profit)
+
+
+def rate_to_distance(instrument, side, distance_rate, open_rate, is_take_profit=False):
+    if fits(distance_rate) and fits(open_rate):
+        numerator, denominator = PriceScale.of(instrument).rate_to_distance(
+            side,
+            to_units(distance_rate),
+            to_units(open_rate),
+            is_take_profit
+        )
+        return Decimal(numerator) / Decimal(denominator)
+    return (Decimal(open_rate) - Decimal(distance_rate)) / instrument.tick_size / side_multiplier(side, is_take_profit)
+
+
+def open_levels(instrument, side, stop_distance, amount, rate, take_profit_distance=None):
+    """
+    Stop loss rate, take profit rate or None and margin cash of a position opening at a Decimal rate,
+    the rate converted to units once for all three, as `stoploss_rate`, `distance_to_rate` and `margin_cash` give them
+    """
+    scale = PriceScale.of(instrument)
+    if not (scale.exact_stops and fits(stop_distance, FACTOR_DECIMALS) and fits(rate, PRICE_DECIMALS - 2 * FACTOR_DECIMALS)
+            and (take_profit_distance is None or fits(take_profit_distance, FACTOR_DECIMALS))):
+        stop_loss_rate = stoploss_rate(instrument, stop_distance, rate, side)
+        if take_profit_distance is None:
+            take_profit_rate = None
+        else:
+            take_profit_rate = distance_to_rate(instrument, side, take_profit_distance, rate, True)
+        return stop_loss_rate, take_profit_rate, margin_cash(instrument, stop_loss_rate, amount, rate)
+    rate = to_units(rate)
+    stop_loss_rate = scale.stoploss_rate(side, to_units(stop_distance, FACTOR_DECIMALS), rate)
+    if take_profit_distance is None:
+        take_profit_rate = None
+    else:
+        take_profit_rate = from_units(scale.distance_to_rate(side, to_units(take_profit_distance, FACTOR_DECIMALS), rate, True))
+    return from_units(stop_loss_rate), take_profit_rate, from_units(scale.margin(stop_loss_rate, amount, rate), CASH_DECIMALS)
+
+
+def margin_cash(instrument, stop_loss_rate, amount, rate):
+    """
+    Cash required for margin as a Decimal, not yet quantized to the quote currency
+    """
+    if fits(stop_loss_rate) and fits(rate):
+        #from_units rounds to the context precision like the Decimal product did
+        return from_units(PriceScale.of(instrument).margin(to_units(stop_loss_rate), amount, to_units(rate)), CASH_DECIMALS)
+    if instrument.minimum_margin_absolute:
+        minimum_margin = instrument.minimum_margin * instrument.tick_size
+    else:
+        minimum_margin = Decimal(instrument.minimum_margin) / 100 * Decimal(rate)
+    stop_distance = abs(rate - stop_loss_rate)
+    if instrument.slippage_absolute:
+        slippage_rate = Decimal(instrument.slippage) * instrument.tick_size
+    else:
+        slippage_rate = Decimal(instrument.slippage) / 100 * Decimal(minimum_margin)
+    return (Decimal(max(stop_distance, minimum_margin)) + slippage_rate) * Decimal(amount)
@@ -15,12 +15,14 @@ class InstrumentSerializer(serializers.ModelSerializer):
         super(InstrumentSerializer, self).__init__(*args, **kwargs)
 
         #Prefetch user favorites, for prevent db deluge
+        #positions are sparse keys, the API exposes the 1-based rank
         favorites = FavoriteInstrument.objects.filter(
             user_id=self.context.get('request').user.id
-        )
+        ).order_by('position').values_list('instrument_id', flat=True)
+        positions = dict((instrument_id, index) for index, instrument_id in enumerate(favorites, 1))
         self.favorite = {
-            'instruments': favorites.values_list('instrument_id', flat=True),
-            'positions': dict(favorites.values_list('instrument_id', 'position'))
+            'instruments': positions,
+            'positions': positions
         }
 
     def get_favorite_position(self, obj):
@@ -34,6 +36,22 @@ class InstrumentSerializer(serializers.ModelSerializer):
         fields = ('name', 'symbol', 'asset_class', 'favorite', 'favorite_position')
 
 
+class FavoriteReorderSerializer(serializers.Serializer):
+    instruments = serializers.WritableField()
+
+    def validate_instruments(self, attrs, source):
+        value = attrs[source]
+        if not isinstance(value, list) or not all(isinstance(symbol, basestring) for symbol in value):
+            raise serializers.ValidationError("Should be a list of instrument symbols")
+        return attrs
+
+    def save(self):
+        symbols = self.object['instruments']
+        ids = dict(Instrument.objects.filter(symbol__in=symbols).values_list('symbol', 'id'))
+        self.object['instrument_ids'] = [ids[symbol] for symbol in symbols if symbol in ids]
+        return self.object
+
+
 class PositionCloseSerializer(serializers.Serializer):
     position = serializers.IntegerField()
     amount   = serializers.IntegerField()
@@ -116,7 +134,7 @@ class OrderSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Order
-        fields = ('id', 'instrument', 'amount', 'side', 'expected_rate', )
+        fields = ('id', 'instrument', 'amount', 'side', 'expected_rate', 'time_in_force', 'expiry_date', )
 
 
 class PlaceOrderSerializer(serializers.Serializer):
@@ -126,6 +144,8 @@ class PlaceOrderSerializer(serializers.Serializer):
     stop_loss_distance   = serializers.DecimalField()
     take_profit_distance = serializers.DecimalField(required=False)
     expected_rate        = serializers.DecimalField(max_digits=25, decimal_places=6)
+    time_in_force        = serializers.ChoiceField(choices=Order.TIMES_IN_FORCE, required=False)
+    expiry_date          = serializers.DateTimeField(required=False)
 
     def __init__(self, *args, **kwargs):
         self.base_fields['instrument'].choices = [(i.url_slug, i.url_slug) for i in Instrument.objects.filter(active=True)]
@@ -134,6 +154,12 @@ class PlaceOrderSerializer(serializers.Serializer):
     def save(self):
         self.object['instrument'] = Instrument.objects.get(url_slug=self.object['instrument'])
         self.object['side'] = int(self.object['side'])
+        if self.object.get('time_in_force') not in (None, ''):
+            self.object['time_in_force'] = int(self.object['time_in_force'])
+        else:
+            self.object.pop('time_in_force', None)
+        if self.object.get('expiry_date') is None:
+            self.object.pop('expiry_date', None)
         return self.object
 
 
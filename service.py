@@ -1,17 +1,35 @@
+import logging
+from datetime import timedelta
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 from activity.models import Post
 from trade import consts
 from wallet.service import WalletService, Overdraft
-from currency.service import CurrencyService
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from django.db.models import F
 from django.utils import timezone
 import celery
 
 from apps.utils.mixpanel_tasks import track_user
-from .models import Position, ClientTrade, HouseTrade, EndOfDayRate, Marketplace, Order
+from utils.pubsub import Connection, Publisher
+from utils import pubsub_conf
+from .cross_rates import cross_rates
+from .db_router import stick_to_primary
+from .leaderboard import Leaderboard
+from .lru_cache import LRUCache
+from .spread_tiers import spread_tiers, rates_key
+from . import pricing
+from .pricing import PriceScale, to_units, from_units, pnl, side_multiplier
+from .models import Position, ClientTrade, HouseTrade, EndOfDayRate, Marketplace, Order, OrderGroup, Instrument, OpenTimeGroup
 from accounts.models import Profitability
 
 
+logger = logging.getLogger(__name__)
+
+
 class WrongAmount(Exception):
     pass
 
@@ -24,40 +42,25 @@ class ZeroRate(Exception):
     pass
 
 
+class WrongExpiry(Exception):
+    pass
+
+
 class TradeService(object):
     client = None
+    positions_publisher = None
+    #process level copy of the EOD rates, keyed by date
+    eod_rates = LRUCache(max_size=2, ttl=60)
 
     @staticmethod
     def open_position(user, instrument, rate, amount, side, stop_loss_distance, take_profit_distance=None, order=None):
         if instrument.is_position_openable(side=side):
             if instrument.is_amount_tradable(amount):
-                #calculate and check the stop loss rate
-                stop_loss_rate = TradeService._get_stoploss_rate(
-                    instrument=instrument,
-                    stop_loss_distance=stop_loss_distance,
-                    rate=rate,
-                    side=side
-                )
-
-                #calculate and check the take profit
-                if not take_profit_distance is None:
-                    take_profit_rate = TradeService._distance_to_rate_convert(
-                        side=side,
-                        distance=take_profit_distance,
-                        rate=rate,
-                        instrument=instrument,
-                        is_take_profit=True)
-                else:
-                    take_profit_rate = None
-
-                #calculate cash required for margin - pretrade validation
-                cash_to_margin = TradeService._calculate_margin(
-                    side=side,
-                    instrument=instrument,
-                    stop_loss_rate=stop_loss_rate,
-                    amount=amount,
-                    rate=rate,
+                #calculate and check the stop loss rate, the take profit and the cash required for margin - pretrade validation
+                stop_loss_rate, take_profit_rate, cash = pricing.open_levels(
+                    instrument, side, stop_loss_distance, amount, rate, take_profit_distance
                 )
+                cash_to_margin = TradeService._quantize_margin(instrument, cash)
 
                 print '%d -- %d '%(cash_to_margin, WalletService(user).get_useful_balance())
                 #check wallet for cash required for margin
@@ -79,10 +82,11 @@ class TradeService(object):
 
                     #issue trade
                     position.save()
-                    TradeService.issue_trade(position, rate, amount, side)
+                    #link the order first, the trade result looks it up to settle its group
                     if order is not None:
                         order.position = position
                         order.save()
+                    TradeService.issue_trade(position, rate, amount, side)
                     return position.id
                 else:
                     raise Overdraft
@@ -93,7 +97,8 @@ class TradeService(object):
 
     #region Orders
     @staticmethod
-    def place_conditional_order(user, instrument, expected_rate, amount, side, stop_loss_distance, take_profit_distance=None):
+    def place_conditional_order(user, instrument, expected_rate, amount, side, stop_loss_distance, take_profit_distance=None,
+                                time_in_force=Order.TIME_IN_FORCE_GTC, expiry_date=None):
         order = Order.objects.create(
             user=user,
             instrument=instrument,
@@ -102,13 +107,212 @@ class TradeService(object):
             asked_stop_distance=stop_loss_distance,
             take_profit_distance=take_profit_distance,
             expected_rate=expected_rate,
-            state=consts.STATE_PENDING
+            state=consts.STATE_PENDING,
+            time_in_force=time_in_force,
+            expiry_date=TradeService._order_expiry(instrument, time_in_force, expiry_date)
         )
 
+        stick_to_primary(user.pk)
         #set the execution worker on condition reach
         TradeService.client.place_order(order)
         return order.id
 
+    @staticmethod
+    def place_order_group(user, legs):
+        """
+        Creates linked orders in one transaction and registers them with the client in one call.
+        `legs` are dicts with the place_conditional_order arguments, returns the group and order ids.
+        """
+        #sessions of the good-for-day legs loaded once for the group
+        open_time_groups = TradeService._open_time_groups(
+            [leg['instrument'] for leg in legs if leg.get('time_in_force') == Order.TIME_IN_FORCE_GFD]
+        )
+        with transaction.atomic():
+            group = OrderGroup.objects.create(user=user)
+            Order.objects.bulk_create([
+                Order(
+                    user=user,
+                    instrument=leg['instrument'],
+                    amount=leg['amount'],
+                    side=leg['side'],
+                    asked_stop_distance=leg['stop_loss_distance'],
+                    take_profit_distance=leg.get('take_profit_distance'),
+                    expected_rate=leg['expected_rate'],
+                    state=consts.STATE_PENDING,
+                    group=group,
+                    time_in_force=leg.get('time_in_force', Order.TIME_IN_FORCE_GTC),
+                    expiry_date=TradeService._order_expiry(
+                        leg['instrument'],
+                        leg.get('time_in_force', Order.TIME_IN_FORCE_GTC),
+                        leg.get('expiry_date'),
+                        open_time_groups
+                    )
+                ) for leg in legs
+            ])
+            orders = list(group.orders.select_related('instrument').order_by('id'))
+        stick_to_primary(user.pk)
+
+        #set the execution workers on condition reach
+        TradeService.client.place_orders(orders)
+        return group.id, [order.id for order in orders]
+
+    @staticmethod
+    def _open_time_groups(instruments):
+        """
+        Open time groups of the instruments by id with their ranges prefetched, so close_time does not query
+        """
+        if not instruments:
+            return {}
+        return OpenTimeGroup.objects.prefetch_related('opentimerange_set').in_bulk(
+            set(instrument.open_time_group_id for instrument in instruments)
+        )
+
+    @staticmethod
+    def _order_expiry(instrument, time_in_force, expiry_date=None, open_time_groups=None):
+        now = timezone.now()
+        if time_in_force == Order.TIME_IN_FORCE_GTT:
+            if expiry_date is None or expiry_date <= now:
+                raise WrongExpiry
+            return expiry_date
+        if time_in_force == Order.TIME_IN_FORCE_GFD:
+            if open_time_groups is None:
+                open_time_groups = TradeService._open_time_groups([instrument])
+            open_time_group = open_time_groups[instrument.open_time_group_id]
+            #the current session close, or the next one if the market is already closed
+            for days in range(8):
+                close = open_time_group.close_time(now + timedelta(days=days))
+                if close is not None and close > now:
+                    return close
+            raise WrongExpiry
+        return None
+
+    @staticmethod
+    def expire_orders(order_ids):
+        """
+        Cancels the orders that are still pending, returns the ids that were expired
+        """
+        with transaction.atomic():
+            expired = list(Order.objects.select_for_update().filter(
+                pk__in=order_ids,
+                state=consts.STATE_PENDING
+            ).values_list('pk', flat=True))
+            Order.objects.filter(pk__in=expired).update(state=consts.STATE_CANCELED)
+        TradeService.client.cancel_orders(expired)
+        return expired
+
+    @staticmethod
+    def execute_order(order):
+        """
+        Opens the position of a triggered order, returns False if the order is no longer pending.
+        The order is executed and its siblings canceled once the trade result opens the position.
+        """
+        if not TradeService.claim_order(order):
+            return False
+        try:
+            TradeService.open_position(
+                user=order.user,
+                instrument=order.instrument,
+                rate=order.expected_rate,
+                amount=order.amount,
+                side=order.side,
+                stop_loss_distance=order.asked_stop_distance,
+                take_profit_distance=order.take_profit_distance,
+                order=order
+            )
+        except Exception:
+            #nothing was opened, the siblings are still pending and the order waits for its condition again
+            Order.objects.filter(pk=order.pk, state=Order.STATE_EXECUTING).update(state=consts.STATE_PENDING)
+            order.state = consts.STATE_PENDING
+            raise
+        stick_to_primary(order.user_id)
+        return True
+
+    @staticmethod
+    def _client_rate(position, side, rate):
+        """
+        Rate a market fill at `rate` is booked at for the client, widened by the markup of the user tier
+        """
+        scale = PriceScale.of(position.instrument)
+        units = to_units(rate)
+        filled = spread_tiers.fill_units(scale, spread_tiers.tier_of(position.user), side, units)
+        return rate if filled == units else scale.to_decimal(filled)
+
+    @staticmethod
+    def _settle_order(position):
+        """
+        Executes the order that opened a position and cancels its siblings, or puts it back to pending
+        with its siblings untouched when the position failed to open
+        """
+        order = Order.objects.filter(position=position, state=Order.STATE_EXECUTING).first()
+        if order is None:
+            return
+        if position.state == consts.STATE_OPENED:
+            order.state = consts.STATE_EXECUTED
+            order.save()
+            TradeService.cancel_siblings(order)
+        else:
+            Order.objects.filter(pk=order.pk).update(state=consts.STATE_PENDING, position=None)
+
+    @staticmethod
+    def execute_orders(order_ids):
+        """
+        Executes triggered orders with their users and instruments loaded once for the batch.
+        A failing order does not stop the others, returns the executed and the failed ids.
+        """
+        orders = list(Order.objects.filter(pk__in=order_ids, state=consts.STATE_PENDING).order_by('id'))
+        users = User.objects.in_bulk(set(order.user_id for order in orders))
+        instruments = Instrument.objects.select_related('open_time_group', 'quote_asset').in_bulk(
+            set(order.instrument_id for order in orders)
+        )
+        executed = []
+        failed = []
+        for order in orders:
+            #share one instance per instrument so its price scale is built once
+            order.user = users[order.user_id]
+            order.instrument = instruments[order.instrument_id]
+            try:
+                if TradeService.execute_order(order):
+                    executed.append(order.pk)
+            except Exception:
+                logger.exception('Execution of order %s failed', order.pk)
+                failed.append(order.pk)
+        return executed, failed
+
+    @staticmethod
+    def claim_order(order):
+        """
+        Marks an order that is about to execute as executing, a linked order only while no other leg
+        of its group is executing or executed. Returns False if the order is no longer pending or
+        a sibling claimed the group first.
+        """
+        with transaction.atomic():
+            if order.group_id is None:
+                legs = list(Order.objects.select_for_update().filter(pk=order.pk))
+            else:
+                legs = list(Order.objects.select_for_update().filter(group_id=order.group_id))
+            if not any(leg.pk == order.pk and leg.state == consts.STATE_PENDING for leg in legs):
+                return False
+            if any(leg.state in (Order.STATE_EXECUTING, consts.STATE_EXECUTED) for leg in legs):
+                return False
+            Order.objects.filter(pk=order.pk).update(state=Order.STATE_EXECUTING)
+        order.state = Order.STATE_EXECUTING
+        return True
+
+    @staticmethod
+    def cancel_siblings(order):
+        """
+        Cancels the pending siblings of a linked order once it executed
+        """
+        if order.group_id is None:
+            return
+        with transaction.atomic():
+            siblings = list(Order.objects.select_for_update().filter(
+                group_id=order.group_id,
+                state=consts.STATE_PENDING
+            ).exclude(pk=order.pk).values_list('pk', flat=True))
+            Order.objects.filter(pk__in=siblings).update(state=consts.STATE_CANCELED)
+        TradeService.client.cancel_orders(siblings)
+
     @staticmethod
     def cancel_order(order):
         if isinstance(order, int):
@@ -118,6 +322,7 @@ class TradeService(object):
         #find the execution worker and remove task
         TradeService.client.cancel_order(order.id)
         order.save()
+        stick_to_primary(order.user_id)
     #endregion Orders
 
     #region Close Position
@@ -147,6 +352,7 @@ class TradeService(object):
 
     @staticmethod
     def issue_trade(position, rate, amount, side, close_reason=None):
+        stick_to_primary(position.user_id)
         TradeService._trade_request(position, rate, amount, side, close_reason)
 
     @staticmethod
@@ -183,87 +389,61 @@ class TradeService(object):
         position.current_margin = new_margin
         position.save()
 
+    #region Pricing
+    #Decimal wrappers of the fixed point formulas in trade.pricing for the API and persistence edges,
+    #tests.test_pricing checks them against the Decimal formulas they replaced
     @staticmethod
     def _get_stoploss_rate(instrument, stop_loss_distance, rate, side):
         #calculate and check the stop loss rate
-        instrument_distance = TradeService._get_instrument_min_distance(instrument, rate)
-        if stop_loss_distance < instrument_distance:
-            stop_loss_distance = instrument_distance
-        stop_loss_rate = TradeService._distance_to_rate_convert(
-            side=side,
-            distance=stop_loss_distance,
-            rate=rate,
-            instrument=instrument)
-        return stop_loss_rate
+        return pricing.stoploss_rate(instrument, stop_loss_distance, rate, side)
 
     @staticmethod
     def _get_instrument_min_distance(instrument, rate):
         """
             Returns the instrument min distance in absolute values
         """
-        if instrument.stop_distance_absolute:
-            return instrument.minimum_stop_distance
-        else:
-            #todo: ask Stefan if we should round it
-            return Decimal(instrument.minimum_stop_distance) / 100 * rate / instrument.tick_size
+        return pricing.minimum_stop_distance(instrument, rate)
 
     @staticmethod
     def _distance_to_rate_convert(side, distance, rate, instrument, is_take_profit=False):
-        if side == consts.TYPE_BUY:
-            multiplier = 1
-        else:
-            multiplier = -1
-        if is_take_profit:
-            multiplier *= -1
-        return Decimal(rate) - Decimal(distance) * instrument.tick_size * multiplier
-
+        return pricing.distance_to_rate(instrument, side, distance, rate, is_take_profit)
 
     @staticmethod
     def _rate_to_distance_convert(side, distance_rate, open_rate, instrument, is_take_profit=False):
-        if side == consts.TYPE_BUY:
-            multiplier = 1
-        else:
-            multiplier = -1
-        if is_take_profit:
-            multiplier *= -1
-        return (Decimal(open_rate) - Decimal(distance_rate)) / instrument.tick_size / multiplier
+        return pricing.rate_to_distance(instrument, side, distance_rate, open_rate, is_take_profit)
 
     @staticmethod
     def _calculate_margin(side, instrument, stop_loss_rate, amount, rate):
-        if side == consts.TYPE_BUY:
-            multiplier = 1
-        else:
-            multiplier = -1
-
-        #first calculate the minimum margin in cash (todo:how?)
-        if instrument.minimum_margin_absolute:
-            minimum_margin = instrument.minimum_margin * instrument.tick_size
-            # test_trade_formulas._absolute_minimum_margin
-        else:
-            minimum_margin = Decimal(instrument.minimum_margin) / 100 * Decimal(rate)
-            # test_trade_formulas._relative_minimum_margin
-
-        stop_distance = abs(rate - stop_loss_rate)
-
-        #calculate slippage for a margin purpose aligned with rate
-        if instrument.slippage_absolute:
-            slippage_rate = Decimal(instrument.slippage) * instrument.tick_size
-            # test_trade_formulas._absolute_slippage
-        else:
-            slippage_rate = Decimal(instrument.slippage) / 100 * Decimal(minimum_margin)
-            # test_trade_formulas._relative_slippage
-
-        cash = (Decimal(max(stop_distance, minimum_margin)) + slippage_rate) * Decimal(amount)
-        #todo: calculations of slippage/minimum_margin/etc should be placed in separate function to improve maintainability
+        # test_trade_formulas._absolute_minimum_margin, _relative_minimum_margin,
+        # _absolute_slippage and _relative_slippage cover trade.pricing.margin_cash
+        return TradeService._quantize_margin(instrument, pricing.margin_cash(instrument, stop_loss_rate, amount, rate))
 
+    @staticmethod
+    def _quantize_margin(instrument, cash):
         if cash > 0:
             return instrument.quote_asset.quantize_value_up(cash)
         else:
             return 0
+    #endregion Pricing
 
     @staticmethod
     def _trade_request(position, rate, amount, side, close_reason=None):
-        #todo: here we should decide if we are creating the hedge trade
+        if NettingService.enabled():
+            #the house takes the client side at its own quote and hedges the net flow in batches
+            fill_rate = NettingService.fill_rate(position, rate, side)
+            #the house quote of the user tier already carries the markup
+            TradeService._trade_callback(
+                position.pk,
+                fill_rate is not None,
+                position.instrument.symbol,
+                amount,
+                side,
+                rate if fill_rate is None else fill_rate,
+                False,
+                close_reason,
+                markup=False
+            )
+            return
         TradeService.client.trade_request(
             position.pk,
             position.instrument.symbol,
@@ -274,11 +454,40 @@ class TradeService(object):
         )
 
     @staticmethod
-    def _trade_callback(position_pk, success, symbol, amount, side, rate, hedged=False, close_reason=None):
+    def _trade_callback(position_pk, success, symbol, amount, side, rate, hedged=False, close_reason=None, markup=True):
         # print "------------"
         # print position_pk, success, symbol, amount, side, rate, hedged
         position = Position.objects.get(pk=position_pk)
+        TradeService._apply_trade(position, success, symbol, amount, side, rate, hedged, close_reason, markup)
+
+    @staticmethod
+    def _trade_callbacks(results):
+        """
+        Applies a batch of trade results, each a (position id, success, symbol, amount, side, rate,
+        hedged, close reason) list with the rate as a string. Positions are loaded in one query and
+        a failing result does not stop the others, returns the position ids that failed.
+        """
+        positions = Position.objects.select_related('user', 'instrument__quote_asset', 'marketplace').in_bulk(
+            set(result[0] for result in results)
+        )
+        failed = []
+        for position_pk, success, symbol, amount, side, rate, hedged, close_reason in results:
+            try:
+                position = positions.get(position_pk)
+                if position is None:
+                    raise Position.DoesNotExist('Position %s does not exist' % position_pk)
+                #results of the same position are applied in order on the same instance
+                TradeService._apply_trade(position, success, symbol, amount, side, Decimal(rate), hedged, close_reason)
+            except Exception:
+                logger.exception('Trade result of position %s failed', position_pk)
+                failed.append(position_pk)
+        return failed
+
+    @staticmethod
+    def _apply_trade(position, success, symbol, amount, side, rate, hedged=False, close_reason=None, markup=True):
         #todo: should check if the trade is done according to position amount, instrument etc and if no - undo
+        #the market fill is the house rate, the client is filled with the markup of its tier
+        client_rate = TradeService._client_rate(position, side, rate) if markup and success else rate
         if hedged:
             house_trade = HouseTrade.objects.create(
                 instrument=position.instrument,
@@ -293,7 +502,7 @@ class TradeService(object):
                 instrument=position.instrument,
                 position=position,
                 asked_rate=position.asked_rate,
-                rate=rate,
+                rate=client_rate,
                 amount=amount,
                 position_state=position.state,
                 success=success,
@@ -306,11 +515,12 @@ class TradeService(object):
                 instrument=position.instrument,
                 position=position,
                 asked_rate=position.asked_rate,
-                rate=rate,
+                rate=client_rate,
                 amount=amount,
                 position_state=position.state,
                 success=success,
-                side=side
+                side=side,
+                netting_pending=success and NettingService.enabled()
             )
         #if successful continue else create failed position
         if position.state == consts.STATE_PENDING:
@@ -318,19 +528,14 @@ class TradeService(object):
                 position.open_rate = trade.rate
                 #reserve cash
                 try:
-                    stop_loss_rate = TradeService._get_stoploss_rate(
-                        instrument=position.instrument,
-                        stop_loss_distance=position.asked_stop_distance,
-                        rate=trade.rate,
-                        side=position.side
-                    )
-                    cash_to_margin = TradeService._calculate_margin(
-                        side=position.side,
-                        instrument=position.instrument,
-                        stop_loss_rate=stop_loss_rate,
-                        amount=position.amount,
-                        rate=position.open_rate,
+                    stop_loss_rate, _, cash = pricing.open_levels(
+                        position.instrument,
+                        position.side,
+                        position.asked_stop_distance,
+                        position.amount,
+                        trade.rate
                     )
+                    cash_to_margin = TradeService._quantize_margin(position.instrument, cash)
                     WalletService(position.user).reserve_margin(
                         amount=cash_to_margin,
                         currency=position.instrument.quote_asset,
@@ -348,6 +553,7 @@ class TradeService(object):
                 position.state = consts.STATE_OPEN_FAILED
 
             position.save()
+            TradeService._settle_order(position)
             track_user.delay(
                 position.user,
                 'Position Opened',
@@ -358,11 +564,6 @@ class TradeService(object):
             )
             TradeService._post_position_update(position, trade)
         elif position.state in (consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED):
-            #count PnL multiplier
-            if position.side == consts.TYPE_BUY:
-                pnl_multiplier = 1
-            else:
-                pnl_multiplier = -1
             if success:
                 if position.amount > trade.amount:
                     position.state = consts.STATE_PARTIALLY_CLOSED
@@ -387,7 +588,7 @@ class TradeService(object):
 
                     position.save()
                     #apply PnL on traded account
-                    pnl_value = Decimal(trade.amount) * (Decimal(trade.rate) - position.open_rate) * pnl_multiplier
+                    pnl_value = from_units(pnl(position.side, trade.amount, to_units(position.open_rate), to_units(trade.rate)))
                     TradeService._process_pnl(pnl_value, position, trade)
 
                     #todo: post a post
@@ -418,7 +619,7 @@ class TradeService(object):
                     position.current_margin = 0
                     position.save()
                     #apply PnL on traded account
-                    pnl_value = Decimal(trade.amount) * (Decimal(trade.rate) - position.open_rate) * pnl_multiplier
+                    pnl_value = from_units(pnl(position.side, trade.amount, to_units(position.open_rate), to_units(trade.rate)))
                     TradeService._process_pnl(pnl_value, position, trade)
                     #todo: post a post
                     TradeService._post_position_update(position, trade)
@@ -432,6 +633,48 @@ class TradeService(object):
                     )
         trade.position_state = position.state
         trade.save()
+        stick_to_primary(position.user_id)
+        TradeService._publish_position(position)
+        if trade.netting_pending:
+            NettingService.add(trade)
+
+    @staticmethod
+    def _publish_position(position):
+        """
+        Pushes the position state to the owner sockets through PositionsNamespace, nothing is
+        pushed on deployments without PUBSUB_POSITIONS_CONFIG
+        """
+        config = getattr(pubsub_conf, 'PUBSUB_POSITIONS_CONFIG', None)
+        if config is None:
+            return
+        #the trade is stored already, a failed push only leaves the sockets waiting for the next one
+        try:
+            if TradeService.positions_publisher is None:
+                TradeService.positions_publisher = Publisher(Connection(settings.PUBSUB_URL), config)
+            TradeService.positions_publisher.publish({
+                'user_id': position.user_id,
+                'position': {
+                    'id': position.pk,
+                    'slug': position.instrument.url_slug,
+                    'state': position.state,
+                    'side': position.side,
+                    'amount': position.amount,
+                    'open_rate': str(position.open_rate),
+                    'close_rate': position.close_rate and str(position.close_rate),
+                    'stop_loss': str(position.stop_loss),
+                    'take_profit': position.take_profit and str(position.take_profit),
+                    'current_margin': str(position.current_margin),
+                    'pnl': str(position.pnl),
+                }
+            })
+        except Exception:
+            #reconnect on the next push
+            TradeService.positions_publisher = None
+            logger.exception('Publishing position %s failed', position.pk)
+
+    @staticmethod
+    def _hedge_callback(house_trade_pk, success, rate):
+        HouseTrade.objects.filter(pk=house_trade_pk).update(success=success, rate=rate)
 
     @staticmethod
     def _process_pnl(pnl_value, position, trade):
@@ -466,9 +709,9 @@ class TradeService(object):
         #todo: should decide if all profitability update should occur on position close or on apply pnl
         #todo: recount the profitability in single currency
         if position.state == consts.STATE_CLOSED:
-            user_base_currency_value = CurrencyService.convert_value(
+            user_base_currency_value = cross_rates.convert_value(
                                        position.instrument.quote_asset,
-                                       position.user.profile.currency,
+                                       cross_rates.user_currency(position.user),
                                        position.pnl)
             profit_by_asset = Profitability.objects.get_or_create(
                 user=position.user,
@@ -497,6 +740,12 @@ class TradeService(object):
             profit_by_instrument.save()
             profit_by_positions.save()
 
+            try:
+                Leaderboard.record_close(position)
+            except Exception:
+                #the periodic reconciliation catches the boards up
+                logger.exception('Leaderboard update of position %s failed', position.pk)
+
     @staticmethod
     def _post_position_update(position, trade):
         Post.objects.create_trade_post(
@@ -512,19 +761,286 @@ class TradeService(object):
         # for type, rate in client_rates.items():
         #     if rate == 0:
         #         raise ZeroRate
+        return PriceScale.of(instrument).quote(client_rates)
+
+    @staticmethod
+    def get_rates_many(instruments, user):
+        """
+        Rates of several instruments keyed by instrument id, fetched from the client in one lookup
+        """
+        client_rates = TradeService.client.get_rates_many(instruments, user)
+        return dict(
+            (instrument.pk, PriceScale.of(instrument).quote(client_rates[instrument.pk])) for instrument in instruments
+        )
+
+    @staticmethod
+    def get_account_snapshot(user):
+        """
+        Open positions with their uPnL, pending orders, margin totals and the PnL realized today,
+        built with three queries, one batched rates lookup and one balance read.
+        Position figures are in their quote currency, totals in the user currency.
+        """
+        currency = cross_rates.user_currency(user)
+        positions = list(Position.objects.filter(
+            user=user,
+            state__in=(consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED)
+        ).select_related('instrument__quote_asset').order_by('-open_date'))
+        orders = list(Order.objects.filter(
+            user=user,
+            state=consts.STATE_PENDING
+        ).select_related('instrument').order_by('-open_date'))
+        day_start = timezone.localtime(timezone.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        #closing trades are the ones on the opposite side of their position
+        closing_trades = ClientTrade.objects.filter(
+            user=user,
+            success=True,
+            time__gte=day_start
+        ).exclude(side=F('position__side')).select_related('position', 'instrument__quote_asset')
+
+        instruments = {}
+        for position in positions:
+            position.instrument = instruments.setdefault(position.instrument_id, position.instrument)
+        rates = TradeService.get_rates_many(instruments.values(), user)
+
+        margin_used = Decimal(0)
+        upnl_total = Decimal(0)
+        open_positions = []
+        for position in positions:
+            #longs close on the sell rate, shorts on the buy rate
+            close_rate = rates[position.instrument_id]['sell' if position.side == consts.TYPE_BUY else 'buy']
+            upnl = position.instrument.quote_asset.quantize_value_down(
+                from_units(pnl(position.side, position.amount, to_units(position.open_rate), to_units(close_rate)))
+            )
+            margin_used += cross_rates.convert_value(position.instrument.quote_asset, currency, position.current_margin)
+            upnl_total += cross_rates.convert_value(position.instrument.quote_asset, currency, upnl)
+            open_positions.append({
+                'id': position.pk,
+                'slug': position.instrument.url_slug,
+                'side': position.side,
+                'state': position.state,
+                'amount': position.amount,
+                'open_rate': position.open_rate,
+                'stop_loss': position.stop_loss,
+                'take_profit': position.take_profit,
+                'current_margin': position.current_margin,
+                'open_date': position.open_date,
+                'upnl': upnl,
+            })
+
+        realized_today = Decimal(0)
+        for trade in closing_trades:
+            realized = trade.instrument.quote_asset.quantize_value_down(from_units(
+                pnl(trade.position.side, trade.amount, to_units(trade.position.open_rate), to_units(trade.rate))
+            ))
+            realized_today += cross_rates.convert_value(trade.instrument.quote_asset, currency, realized)
+
+        balance = WalletService(user).get_useful_balance()
         return {
-            'sell': instrument.quantize_price_down(Decimal(client_rates['sell'])),
-            'buy': instrument.quantize_price_down(Decimal(client_rates['buy'])),
-            'low': instrument.quantize_price_down(Decimal(client_rates['low'])),
-            'high': instrument.quantize_price_down(Decimal(client_rates['high'])),
+            'positions': open_positions,
+            'orders': [{
+                'id': order.pk,
+                'slug': order.instrument.url_slug,
+                'side': order.side,
+                'amount': order.amount,
+                'expected_rate': order.expected_rate,
+                'time_in_force': order.time_in_force,
+                'expiry_date': order.expiry_date,
+                'group': order.group_id,
+            } for order in orders],
+            'balance': balance,
+            'margin_used': margin_used,
+            'upnl': upnl_total,
+            'equity': balance + margin_used + upnl_total,
+            'free_margin': balance + upnl_total,
+            'realized_pnl_today': realized_today,
         }
 
     @staticmethod
     def get_eod_rate(instrument):
-        try:
-            return EndOfDayRate.objects.filter(instrument=instrument).order_by('-date')[0].rate
-        except:
+        """
+        Latest EOD rate of the instrument stored in the last EOD_RATE_LOOKBACK_DAYS (10 by default)
+        days, so after holidays or missed snapshots it can be up to 10 days old.
+        Without one in that window 0 is returned and logged.
+        """
+        rate = TradeService.get_eod_rates().get(instrument.pk)
+        if rate is None:
+            logger.warning('No EOD rate of %s in the last %s days, using 0',
+                           instrument.pk, getattr(settings, 'EOD_RATE_LOOKBACK_DAYS', 10))
             return Decimal('0.0')
+        return rate
+
+    @staticmethod
+    def get_eod_rates():
+        """
+        Returns the latest EOD rate of every instrument by instrument id, loaded once per day
+        """
+        today = timezone.now().date()
+        key = 'eod_rates_%s' % today
+        rates = TradeService.eod_rates.get(key)
+        if rates is None:
+            rates = cache.get(key)
+            if rates is None:
+                lookback = getattr(settings, 'EOD_RATE_LOOKBACK_DAYS', 10)
+                #ordered by date, so the latest rate of each instrument wins
+                rates = dict(EndOfDayRate.objects.filter(
+                    date__gte=today - timedelta(days=lookback)
+                ).order_by('date').values_list('instrument_id', 'rate'))
+                cache.set(key, rates, 24 * 60 * 60)
+            TradeService.eod_rates.set(key, rates)
+        return rates
+
+    @staticmethod
+    def snapshot_eod_rates(now=None):
+        """
+        Stores the live rate of every instrument whose open time group has closed for the day.
+        Should be scheduled every few minutes, groups already stored for their date are skipped.
+        """
+        if now is None:
+            now = timezone.now()
+        due_dates = {}
+        for group in OpenTimeGroup.objects.prefetch_related('opentimerange_set'):
+            close = group.close_time(now)
+            if close is not None and now >= close:
+                due_dates[group.pk] = close.date()
+        if not due_dates:
+            return 0
+
+        instruments = list(Instrument.objects.filter(
+            active=True,
+            open_time_group__in=due_dates.keys()
+        ).values_list('pk', 'url_slug', 'open_time_group_id'))
+        stored = set(EndOfDayRate.objects.filter(
+            date__in=set(due_dates.values()),
+            instrument__in=[pk for pk, slug, group_id in instruments]
+        ).values_list('instrument_id', 'date'))
+        live_rates = cache.get_many(['rates_%s' % slug for pk, slug, group_id in instruments])
+
+        eod_rates = []
+        for pk, slug, group_id in instruments:
+            date = due_dates[group_id]
+            rate = live_rates.get('rates_%s' % slug)
+            if (pk, date) in stored or not rate or not rate['sell']:
+                continue
+            eod_rates.append(EndOfDayRate(instrument_id=pk, date=date, rate=rate['sell']))
+        created = len(eod_rates)
+        try:
+            with transaction.atomic():
+                EndOfDayRate.objects.bulk_create(eod_rates)
+        except IntegrityError:
+            #a concurrent run stored some of them first, keep its rates and store the rest
+            created = 0
+            for eod_rate in eod_rates:
+                created += EndOfDayRate.objects.get_or_create(
+                    instrument_id=eod_rate.instrument_id,
+                    date=eod_rate.date,
+                    defaults={'rate': eod_rate.rate}
+                )[1]
+
+        if created:
+            key = 'eod_rates_%s' % timezone.now().date()
+            cache.delete(key)
+            TradeService.eod_rates.delete(key)
+        return created
+
+
+class NettingService(object):
+    """
+    Nets the client flow per instrument and hedges only the net amount, with one HouseTrade per batch.
+    Client trades are filled at the house quote. A batch is flushed by the periodic flush_netting
+    task, queued early for an instrument whose net exposure reaches NETTING_MAX_EXPOSURE.
+    """
+
+    @staticmethod
+    def enabled():
+        return getattr(settings, 'TRADE_NETTING', False)
+
+    @staticmethod
+    def fill_rate(position, requested_rate, side):
+        """
+        Rate the house fills a client trade at: its quote of the user tier, buy for buys and sell for
+        sells. The requested rate only bounds the slippage, None when there is no quote or it is more
+        than NETTING_SLIPPAGE_TICKS ticks worse than the requested rate.
+        """
+        rates = TradeService.get_rates(position.instrument, position.user)
+        rate = rates['buy'] if side == consts.TYPE_BUY else rates['sell']
+        if not rate:
+            return None
+        if requested_rate:
+            slippage = getattr(settings, 'NETTING_SLIPPAGE_TICKS', 0) * position.instrument.tick_size
+            if (rate - Decimal(requested_rate)) * side_multiplier(side) > slippage:
+                return None
+        return rate
+
+    @staticmethod
+    def add(trade):
+        #running totals are only a hint for the threshold, the flush nets the stored trades
+        key = 'netting_%s_%s' % (trade.instrument_id, trade.side)
+        cache.add(key, 0, None)
+        cache.incr(key, trade.amount)
+        buys, sells = NettingService._counters(trade.instrument_id)
+        if abs(buys - sells) >= getattr(settings, 'NETTING_MAX_EXPOSURE', 1000):
+            #hedged by a worker, not in the request of the fill
+            from .tasks import flush_netting
+            flush_netting.delay([trade.instrument_id])
+
+    @staticmethod
+    def flush(instrument_ids=None):
+        """
+        Hedges the net client flow of the given instruments waiting for netting, of all of them if None.
+        Returns the created house trades.
+        """
+        house_trades = []
+        with transaction.atomic():
+            trades = ClientTrade.objects.select_for_update().filter(netting_pending=True)
+            if instrument_ids is not None:
+                trades = trades.filter(instrument_id__in=instrument_ids)
+            rows = list(trades.values_list('pk', 'instrument_id', 'side', 'amount', 'rate'))
+
+            batches = {}
+            for pk, instrument_id, side, amount, rate in rows:
+                batch = batches.setdefault(instrument_id, {'ids': [], 'net': 0, 'volume': 0, 'value': 0})
+                batch['ids'].append(pk)
+                batch['net'] += amount if side == consts.TYPE_BUY else -amount
+                batch['volume'] += amount
+                batch['value'] += amount * to_units(rate)
+            instruments = Instrument.objects.in_bulk(batches.keys())
+
+            for instrument_id, batch in batches.items():
+                scale = PriceScale.of(instruments[instrument_id])
+                house_trade = HouseTrade.objects.create(
+                    instrument_id=instrument_id,
+                    marketplace_id=settings.DEFAULT_MARKETPLACE,
+                    #volume weighted client rate on the tick grid until the hedge result arrives
+                    rate=scale.to_decimal(scale.quantize_down(batch['value'] // batch['volume'])),
+                    amount=abs(batch['net']),
+                    #a fully offset batch needs no hedge
+                    success=batch['net'] == 0,
+                    side=consts.TYPE_BUY if batch['net'] >= 0 else consts.TYPE_SELL
+                )
+                ClientTrade.objects.filter(pk__in=batch['ids']).update(house_trade=house_trade, netting_pending=False)
+                house_trades.append(house_trade)
+                cache.set_many({
+                    'netting_%s_%s' % (instrument_id, consts.TYPE_BUY): 0,
+                    'netting_%s_%s' % (instrument_id, consts.TYPE_SELL): 0,
+                }, None)
+
+        hedges = [house_trade for house_trade in house_trades if house_trade.amount]
+        if hedges:
+            for house_trade in hedges:
+                TradeService.client.hedge_request(
+                    house_trade.pk,
+                    instruments[house_trade.instrument_id].symbol,
+                    house_trade.rate,
+                    house_trade.amount,
+                    house_trade.side
+                )
+        return house_trades
+
+    @staticmethod
+    def _counters(instrument_id):
+        keys = ['netting_%s_%s' % (instrument_id, side) for side in (consts.TYPE_BUY, consts.TYPE_SELL)]
+        counters = cache.get_many(keys)
+        return [counters.get(key, 0) for key in keys]
 
 
 class DummyClient():
@@ -557,17 +1073,31 @@ class DummyClient():
         else:
             TradeService._trade_callback(position_pk, success, symbol, amount, side, rate, True)
 
+    def hedge_request(self, house_trade_pk, instrument_symbol, requested_rate, amount, side):
+        TradeService._hedge_callback(house_trade_pk, True, requested_rate)
+
     def place_order(self, order):
         self.on_order_condition_match(order.id)
 
+    def place_orders(self, orders):
+        self.on_orders_condition_match([order.id for order in orders])
+
     def cancel_order(self, order_id):
         #remove order from queue
         pass
 
+    def cancel_orders(self, order_ids):
+        for order_id in order_ids:
+            self.cancel_order(order_id)
+
     def on_order_condition_match(self, order_id):
         from .tasks import execute_order
         execute_order(order_id)
 
+    def on_orders_condition_match(self, order_ids):
+        from .tasks import execute_orders
+        execute_orders(order_ids)
+
     def get_rates(self, instrument, user):
         return {
             'sell': 1400.00,
@@ -576,6 +1106,9 @@ class DummyClient():
             'low': 1399.00
         }
 
+    def get_rates_many(self, instruments, user):
+        return dict((instrument.pk, self.get_rates(instrument, user)) for instrument in instruments)
+
 
 
 
@@ -605,14 +1138,24 @@ class Dummy2Client():
     def place_order(self, order):
         self.on_order_condition_match(order.id)
 
+    def place_orders(self, orders):
+        self.on_orders_condition_match([order.id for order in orders])
+
     def cancel_order(self, order_id):
         #remove order from queue
         pass
 
+    def cancel_orders(self, order_ids):
+        for order_id in order_ids:
+            self.cancel_order(order_id)
+
     def on_order_condition_match(self, order_id):
         from .tasks import execute_order
         execute_order.delay(order_id)
 
+    def on_orders_condition_match(self, order_ids):
+        dispatch_order_batches(order_ids)
+
     def on_trade_result(self, position_pk, success, symbol, amount, side, rate, close_reason=None):
         position = Position.objects.get(pk=position_pk)
         from .tasks import trade_result_from_client
@@ -632,6 +1175,10 @@ class Dummy2Client():
                 countdown=5)
             # TradeService._trade_callback(position_pk, success, symbol, amount, side, rate, True)
 
+    def hedge_request(self, house_trade_pk, instrument_symbol, requested_rate, amount, side):
+        from .tasks import hedge_result_from_client
+        hedge_result_from_client.apply_async((house_trade_pk, True, requested_rate), countdown=5)
+
     def get_rates(self, instrument, user):
         return {
             'sell': 1300.00,
@@ -640,11 +1187,15 @@ class Dummy2Client():
             'low': 1299.00
         }
 
+    def get_rates_many(self, instruments, user):
+        return dict((instrument.pk, self.get_rates(instrument, user)) for instrument in instruments)
+
 from django.conf import settings
 from django.core.cache import cache
 
 from utils.pubsub import Connection, Publisher
 from utils.pubsub_conf import PUBSUB_SEND_TRADES_CONFIG
+from .mongo_models import FixTradeMsg
 
 
 class TradeClient(object):
@@ -655,18 +1206,34 @@ class TradeClient(object):
         self.publisher = Publisher(conn, PUBSUB_SEND_TRADES_CONFIG)
 
     def get_rates(self, instrument, user):
-        return cache.get('rates_%s' % instrument.url_slug, default={
-            'sell': 0,
-            'buy': 0,
-            'high': 0,
-            'low': 0
-        })
+        return self.get_rates_many([instrument], user)[instrument.pk]
+
+    def get_rates_many(self, instruments, user):
+        #quotes of the user tier, the raw rates until the tier quotes of an instrument are stored
+        tier = spread_tiers.tier_of(user)
+        keys = [rates_key(instrument.url_slug, tier) for instrument in instruments]
+        cached = cache.get_many(keys + [rates_key(instrument.url_slug) for instrument in instruments])
+        default = {'sell': 0, 'buy': 0, 'high': 0, 'low': 0}
+        rates = {}
+        for instrument, key in zip(instruments, keys):
+            quotes = cached.get(key)
+            raw = cached.get(rates_key(instrument.url_slug))
+            if quotes is None and raw is not None:
+                #the tier quotes are derived from the raw rates, never the raw rates themselves
+                scale = PriceScale.of(instrument)
+                quotes = dict(
+                    (name, scale.to_decimal(units))
+                    for name, units in spread_tiers.tier_units(scale, scale.quote_units(raw))[tier].items()
+                )
+            rates[instrument.pk] = quotes or default
+        return rates
 
     def trade_request(self, position_pk, instrument_symbol, requested_rate, amount, side,
                       market_or_limit_type="Market"):
         self.publisher.publish({
             'event': 'trade',
             'position_id': position_pk,
+            'cl_ord_id': FixTradeMsg.make_cl_ord_id('position_id', position_pk),
             'symbol': instrument_symbol,
             'rate': str(requested_rate),
             'amount': amount,
@@ -674,22 +1241,61 @@ class TradeClient(object):
             'type': market_or_limit_type
         })
 
+    def hedge_request(self, house_trade_pk, instrument_symbol, requested_rate, amount, side):
+        self.publisher.publish({
+            'event': 'hedge',
+            'house_trade_id': house_trade_pk,
+            'cl_ord_id': FixTradeMsg.make_cl_ord_id('house_trade_id', house_trade_pk),
+            'symbol': instrument_symbol,
+            'rate': str(requested_rate),
+            'amount': amount,
+            'side': side,
+            'type': 'Market'
+        })
+
 
     def place_order(self, order):
-        #following is trigger logic
-        if order.side == 0 and self.get_rates(order.instrument, order.user)['buy'] > order.expected_rate:
-            self.on_order_condition_match(order.id)
-        if order.side == 1 and self.get_rates(order.instrument, order.user)['sell'] < order.expected_rate:
+        if self.is_triggered(order):
             self.on_order_condition_match(order.id)
 
+    def place_orders(self, orders):
+        #orders triggered together go to the workers as one batch
+        self.on_orders_condition_match([order.id for order in orders if self.is_triggered(order)])
+
+    def is_triggered(self, order):
+        #following is trigger logic, on the quotes of the user tier
+        rates = self.get_rates(order.instrument, order.user)
+        if order.side == 0 and rates['buy'] > order.expected_rate:
+            return True
+        if order.side == 1 and rates['sell'] < order.expected_rate:
+            return True
+        return False
+
     def cancel_order(self, order_id):
         #remove order from queue
         pass
 
+    def cancel_orders(self, order_ids):
+        for order_id in order_ids:
+            self.cancel_order(order_id)
+
     def on_order_condition_match(self, order_id):
         from .tasks import execute_order
         execute_order.delay(order_id)
 
+    def on_orders_condition_match(self, order_ids):
+        dispatch_order_batches(order_ids)
+
+
+def dispatch_order_batches(order_ids):
+    """
+    Queues triggered orders as execute_orders tasks of up to ORDER_EXECUTION_BATCH_SIZE ids
+    """
+    from .tasks import execute_orders
+    batch_size = getattr(settings, 'ORDER_EXECUTION_BATCH_SIZE', 100)
+    for i in range(0, len(order_ids), batch_size):
+        execute_orders.delay(order_ids[i:i + batch_size])
+
 if getattr(settings, 'USE_DUMMY_TRADE_CLIENT', False):
     DUMMY_CLIENTS=[DummyClient, Dummy2Client]
     TradeService.client = DUMMY_CLIENTS[getattr(settings, 'DUMMY_CLIENT_CLASS', 0)]()
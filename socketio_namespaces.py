@@ -1,25 +1,53 @@
-from decimal import Decimal, ROUND_DOWN
+import logging
+import time
+from collections import defaultdict
 
 from socketio.namespace import BaseNamespace
+import gevent
 from gevent.greenlet import Greenlet
 from gevent.event import AsyncResult
 
 from django.conf import settings
 from django.core.cache import cache
 
-from .models import Instrument
+from trade import consts
+from .candles import CandleBuilder
+from .models import Instrument, Position
+from .mongo_models import ChartHistory
+from .pricing import PriceScale, PRICE_SCALE, to_units, to_rate_decimal, pnl
+from .spread_tiers import spread_tiers, rates_key
+from .tick_latency import tick_latency
+from .tick_ring import TickRingReader
 from utils.pubsub import Connection, Consumer
+from utils import pubsub_conf
 from utils.pubsub_conf import PUBSUB_RATES_CONFIG
 
 
+logger = logging.getLogger(__name__)
+
 instruments = Instrument.objects.all()
+instruments_by_slug = {}
+candle_builder = CandleBuilder()
+
+
+def get_instrument(slug):
+    if not instruments_by_slug:
+        instruments_by_slug.update((instrument.url_slug, instrument) for instrument in instruments)
+    return instruments_by_slug.get(slug)
 
 
 class InstrumentsPriceNamespace(BaseNamespace):
     asyncres = AsyncResult()
     greenlet = None
+    tier = None
+    #off in replays, historical ticks must not overwrite the live rates the trading reads
+    store_rates = True
+    #socket sends across all ticks, every TICK_LATENCY_FANOUT_SAMPLE-th one is timed
+    fanout_sends = 0
+    fanout_sample = getattr(settings, 'TICK_LATENCY_FANOUT_SAMPLE', 100)
 
     def recv_connect(self):
+        self.tier = spread_tiers.tier_of(self.request.user)
         self.greenlet = Greenlet.spawn(self.listener)
 
     def recv_disconnect(self):
@@ -28,32 +56,255 @@ class InstrumentsPriceNamespace(BaseNamespace):
 
     def listener(self):
         while True:
-            msg = InstrumentsPriceNamespace.asyncres.get()
-            self.send({msg['asset']: msg}, json=True)
+            msg, messages, dispatched = InstrumentsPriceNamespace.asyncres.get()
+            self.send({msg['asset']: messages.get(self.tier, msg)}, json=True)
+            if tick_latency.enabled:
+                #sampled across the sockets, early and late sends of a tick alike
+                InstrumentsPriceNamespace.fanout_sends += 1
+                if InstrumentsPriceNamespace.fanout_sends % InstrumentsPriceNamespace.fanout_sample == 0:
+                    tick_latency.record('fanout', msg['asset'], time.time() - dispatched)
 
     @staticmethod
     def start_pubsub():
-        Greenlet.spawn(InstrumentsPriceNamespace.pubsub_consumer)
+        if getattr(settings, 'TICK_RING_ENABLED', False):
+            #the per host price feeder consumes, normalizes and persists candles, workers read its ring
+            Greenlet.spawn(InstrumentsPriceNamespace.ring_consumer)
+        else:
+            Greenlet.spawn(InstrumentsPriceNamespace.pubsub_consumer)
+            Greenlet.spawn(InstrumentsPriceNamespace.candle_flusher)
+        #position pushes are optional, TradeService publishes nothing without the config
+        if getattr(pubsub_conf, 'PUBSUB_POSITIONS_CONFIG', None) is not None:
+            Greenlet.spawn(PositionsNamespace.pubsub_consumer)
+
+    @staticmethod
+    def candle_flusher():
+        interval = getattr(settings, 'CANDLE_FLUSH_INTERVAL', 5)
+        while True:
+            gevent.sleep(interval)
+            try:
+                candle_builder.flush()
+            except Exception:
+                #the bars stay queued and are retried on the next run
+                logger.exception('Candle flush failed')
 
     @staticmethod
     def pubsub_consumer():
         with Connection(settings.PUBSUB_URL) as conn:
             Consumer(conn, PUBSUB_RATES_CONFIG, callback=InstrumentsPriceNamespace.broadcast_message).run()
 
+    @staticmethod
+    def open_ring():
+        """
+        Maps the tick ring, waiting with backoff until the price feeder has created it
+        """
+        delay = getattr(settings, 'TICK_RING_RETRY_DELAY', 0.1)
+        while True:
+            try:
+                return TickRingReader()
+            except (IOError, ValueError):
+                logger.warning('Tick ring not available yet, retrying in %ss', delay)
+                gevent.sleep(delay)
+                delay = min(delay * 2, getattr(settings, 'TICK_RING_RETRY_MAX_DELAY', 5))
+
+    @staticmethod
+    def ring_consumer():
+        #candles are persisted by the feeder, here they are only kept to be published
+        candle_builder.persist_types = frozenset()
+        reader = InstrumentsPriceNamespace.open_ring()
+        interval = getattr(settings, 'TICK_RING_POLL_INTERVAL', 0.002)
+        while True:
+            for msg, units, symbol, received in reader.read():
+                candles = candle_builder.update(symbol, float(units['sell']) / PRICE_SCALE)
+                InstrumentsPriceNamespace.publish_tick(msg, units, symbol, candles, received)
+            gevent.sleep(interval)
+
+    @staticmethod
+    def normalize(msg, received):
+        """
+        Quantizes the rates of a tick in place, derives the quotes of every spread tier into
+        msg['tiers'] and writes them all to the rates cache in one call, unless store_rates is off.
+        Returns the instrument and the raw rates in units, None for unknown instruments.
+        """
+        instrument = get_instrument(msg['asset'])
+        if instrument is None:
+            return None
+        # print 'sending', instrument.symbol
+        scale = PriceScale.of(instrument)
+        units = scale.quote_units(msg)
+        rates = dict((key, scale.to_decimal(value)) for key, value in units.items())
+        stored = {rates_key(instrument.url_slug): rates}
+        msg['tiers'] = {}
+        for tier, quotes in spread_tiers.tier_units(scale, units).items():
+            tier_rates = stored[rates_key(instrument.url_slug, tier)] = dict(
+                (key, scale.to_decimal(value)) for key, value in quotes.items()
+            )
+            msg['tiers'][tier] = {'buy': str(tier_rates['buy']), 'sell': str(tier_rates['sell'])}
+        quantized = time.time()
+        if InstrumentsPriceNamespace.store_rates:
+            cache.set_many(stored)
+        msg['buy'] = str(rates['buy'])
+        msg['sell'] = str(rates['sell'])
+        if tick_latency.enabled:
+            tick_latency.record('quantize', instrument.url_slug, quantized - received)
+            tick_latency.record('cache', instrument.url_slug, time.time() - quantized)
+        return instrument, units
+
     @staticmethod
     def broadcast_message(msg):
-        for instrument in instruments:
-            if instrument.url_slug == msg['asset']:
-                # print 'sending', instrument.symbol
-                rates = {
-                    'sell': instrument.quantize_price_down(Decimal(msg['sell'])),
-                    'buy': instrument.quantize_price_down(Decimal(msg['buy'])),
-                    'low': instrument.quantize_price_down(Decimal(msg['low'])),
-                    'high': instrument.quantize_price_down(Decimal(msg['high'])),
-                }
-                cache.set('rates_%s' % instrument.url_slug, rates)
-                msg['buy'] = str(rates['buy'])
-                msg['sell'] = str(rates['sell'])
-
-                InstrumentsPriceNamespace.asyncres.set(msg)
-                InstrumentsPriceNamespace.asyncres = AsyncResult()
+        received = time.time()
+        normalized = InstrumentsPriceNamespace.normalize(msg, received)
+        if normalized is None:
+            return
+        instrument, units = normalized
+        symbol = instrument.chart_code or instrument.url_slug
+        candles = candle_builder.update(symbol, float(units['sell']) / PRICE_SCALE)
+        InstrumentsPriceNamespace.publish_tick(msg, units, symbol, candles, received)
+
+    @staticmethod
+    def publish_tick(msg, units, symbol, candles, received):
+        tiers = msg.pop('tiers', {})
+        PositionsNamespace.rates_updated(msg['asset'], units, tiers)
+        CandlesNamespace.publish(symbol, candles)
+
+        dispatched = time.time()
+        if tick_latency.enabled:
+            tick_latency.record_tick(msg['asset'], msg, received, dispatched)
+        #one message per tier, sockets pick the one of their user
+        messages = dict((tier, dict(msg, **quotes)) for tier, quotes in tiers.items())
+        InstrumentsPriceNamespace.asyncres.set((msg, messages, dispatched))
+        InstrumentsPriceNamespace.asyncres = AsyncResult()
+
+
+class CandlesNamespace(BaseNamespace):
+    """
+    Pushes the in-progress bar of the subscribed instrument and timeframe
+    """
+    asyncres = AsyncResult()
+    greenlet = None
+    symbol = None
+    #position of the subscribed timeframe in the bars of CandleBuilder
+    index = CandleBuilder.TYPES.index(ChartHistory.TYPE_M1)
+
+    def recv_connect(self):
+        self.greenlet = Greenlet.spawn(self.listener)
+
+    def recv_disconnect(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+
+    def on_subscribe(self, symbol, type=ChartHistory.TYPE_M1):
+        try:
+            index = CandleBuilder.TYPES.index(int(type))
+        except (TypeError, ValueError):
+            self.error('invalid_type', 'Unknown chart type %r' % (type, ))
+            return
+        self.symbol = symbol
+        self.index = index
+
+    def listener(self):
+        while True:
+            symbol, candles = CandlesNamespace.asyncres.get()
+            if symbol == self.symbol:
+                self.send({symbol: candles[self.index].as_list()}, json=True)
+
+    @staticmethod
+    def publish(symbol, candles):
+        CandlesNamespace.asyncres.set((symbol, candles))
+        CandlesNamespace.asyncres = AsyncResult()
+
+
+class PositionsNamespace(BaseNamespace):
+    """
+    Pushes the state changes of the user positions as they happen and their uPnL
+    deltas every POSITIONS_PUSH_INTERVAL seconds. Only connected users are indexed.
+    """
+    sessions = defaultdict(set)
+    holders = defaultdict(set)
+    rates = {}
+    greenlet = None
+    user_id = None
+    tier = None
+
+    def recv_connect(self):
+        user = self.request.user
+        if not user.is_authenticated():
+            return
+        self.user_id = user.pk
+        self.tier = spread_tiers.tier_of(user)
+        #position id -> [slug, side, amount, open_rate, last pushed upnl]
+        self.positions = {}
+        self.dirty = set()
+        for pk, slug, side, amount, open_rate in Position.objects.filter(
+            user_id=self.user_id,
+            state__in=(consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED)
+        ).values_list('pk', 'instrument__url_slug', 'side', 'amount', 'open_rate'):
+            self._index(pk, slug, side, amount, to_units(open_rate))
+        PositionsNamespace.sessions[self.user_id].add(self)
+        self.greenlet = Greenlet.spawn(self.pusher)
+
+    def recv_disconnect(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+        if self.user_id is not None:
+            PositionsNamespace.sessions[self.user_id].discard(self)
+            for slug in set(position[0] for position in self.positions.values()):
+                PositionsNamespace.holders[slug].discard(self)
+
+    def pusher(self):
+        interval = getattr(settings, 'POSITIONS_PUSH_INTERVAL', 1)
+        while True:
+            gevent.sleep(interval)
+            deltas = {}
+            for pk in self.dirty:
+                position = self.positions.get(pk)
+                if position is None:
+                    continue
+                upnl = self._upnl(position)
+                if upnl is not None and upnl != position[4]:
+                    position[4] = upnl
+                    deltas[pk] = str(to_rate_decimal(upnl))
+            self.dirty.clear()
+            if deltas:
+                self.send({'upnl': deltas}, json=True)
+
+    def update_position(self, data):
+        pk = data['id']
+        if data['state'] in (consts.STATE_OPENED, consts.STATE_PARTIALLY_CLOSED):
+            self._index(pk, data['slug'], data['side'], data['amount'], to_units(data['open_rate']))
+        elif self.positions.pop(pk, None) is not None:
+            if not any(position[0] == data['slug'] for position in self.positions.values()):
+                PositionsNamespace.holders[data['slug']].discard(self)
+        self.send({'position': data}, json=True)
+
+    def _index(self, pk, slug, side, amount, open_rate):
+        self.positions[pk] = [slug, side, amount, open_rate, None]
+        self.dirty.add(pk)
+        PositionsNamespace.holders[slug].add(self)
+
+    def _upnl(self, position):
+        rates = PositionsNamespace.rates.get(position[0])
+        if rates is None:
+            return None
+        rates = rates[1].get(self.tier, rates[0])
+        if position[1] == consts.TYPE_SELL:
+            return pnl(position[1], position[2], position[3], rates['buy'])
+        return pnl(position[1], position[2], position[3], rates['sell'])
+
+    @staticmethod
+    def rates_updated(slug, rates, tiers):
+        #raw rates and the close rates of every tier, all in units
+        PositionsNamespace.rates[slug] = (rates, dict(
+            (tier, {'sell': to_units(quotes['sell']), 'buy': to_units(quotes['buy'])}) for tier, quotes in tiers.items()
+        ))
+        for session in PositionsNamespace.holders.get(slug, ()):
+            session.dirty.update(pk for pk, position in session.positions.items() if position[0] == slug)
+
+    @staticmethod
+    def pubsub_consumer():
+        with Connection(settings.PUBSUB_URL) as conn:
+            Consumer(conn, pubsub_conf.PUBSUB_POSITIONS_CONFIG, callback=PositionsNamespace.dispatch).run()
+
+    @staticmethod
+    def dispatch(msg):
+        for session in list(PositionsNamespace.sessions.get(msg['user_id'], ())):
+            session.update_position(msg['position'])
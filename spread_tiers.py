@@ -0,0 +1,69 @@
+"""
+Per tier quotes. Each tier widens the raw spread by SPREAD_TIER_MARKUPS hundredths of a tick, the
+quotes of every tier are derived once per tick when the rates arrive and stored next to the raw
+rates under tier keyed cache keys, so quoting a user is a lookup of the user tier.
+"""
+from django.conf import settings
+
+from trade import consts
+from .lru_cache import LRUCache
+from .models import UserSpreadTier
+from .pricing import FACTOR_DECIMALS
+
+
+def rates_key(slug, tier=None):
+    if tier is None:
+        return 'rates_%s' % slug
+    return 'rates_%s_%s' % (slug, tier)
+
+
+class SpreadTierEngine(object):
+
+    def __init__(self):
+        configured = getattr(settings, 'SPREAD_TIER_MARKUPS', {})
+        self.markups = [(tier, configured.get(tier, 0)) for tier, name in UserSpreadTier.TIERS]
+        self.user_tiers = LRUCache(
+            max_size=getattr(settings, 'SPREAD_TIER_USER_CACHE_SIZE', 10000),
+            ttl=getattr(settings, 'SPREAD_TIER_USER_CACHE_TTL', 60)
+        )
+
+    def tier_units(self, scale, units):
+        """
+        Quotes of every tier in units from the raw quantized ones, the markup is split between
+        the sides and the result rounded against the client
+        """
+        tiers = {}
+        for tier, markup in self.markups:
+            widening = markup * scale.tick // 10 ** FACTOR_DECIMALS
+            tiers[tier] = {
+                'sell': scale.quantize_down(units['sell'] - widening // 2),
+                'buy': scale.quantize_up(units['buy'] + widening - widening // 2),
+                'low': units['low'],
+                'high': units['high'],
+            }
+        return tiers
+
+    def fill_units(self, scale, tier, side, units):
+        """
+        Client fill in units of a trade the market filled at `units`, widened like the tier quote
+        of its side, unchanged without a markup
+        """
+        widening = dict(self.markups)[tier] * scale.tick // 10 ** FACTOR_DECIMALS
+        if not widening:
+            return units
+        if side == consts.TYPE_BUY:
+            return scale.quantize_up(units + widening - widening // 2)
+        return scale.quantize_down(units - widening // 2)
+
+    def tier_of(self, user):
+        if user is None or user.pk is None:
+            return UserSpreadTier.RETAIL
+        tier = self.user_tiers.get(user.pk)
+        if tier is None:
+            tiers = list(UserSpreadTier.objects.filter(user_id=user.pk).values_list('tier', flat=True)[:1])
+            tier = tiers[0] if tiers else UserSpreadTier.RETAIL
+            self.user_tiers.set(user.pk, tier)
+        return tier
+
+
+spread_tiers = SpreadTierEngine()
@@ -7,8 +7,9 @@ import mongoengine
 
 from .models import Order
 from .mongo_models import FixTradeMsg
-from .service import TradeService
-from trade import consts
+from . import archive, equity_curve, financing
+from .leaderboard import Leaderboard
+from .service import TradeService, NettingService
 
 
 @celery.task
@@ -16,6 +17,24 @@ def trade_result_from_client(position_id, success, symbol, amount, side, rate, h
     TradeService._trade_callback(position_id, success, symbol, amount, side, rate, hedged, close_reason)
 
 
+@celery.task
+def trade_results_from_client(results):
+    """
+    Batch variant of trade_result_from_client, `results` are lists of its arguments with the rate as a string
+    """
+    return TradeService._trade_callbacks(results)
+
+
+@celery.task
+def hedge_result_from_client(house_trade_id, success, rate):
+    TradeService._hedge_callback(house_trade_id, success, rate)
+
+
+@celery.task
+def flush_netting(instrument_ids=None):
+    NettingService.flush(instrument_ids)
+
+
 @celery.task
 def save_fix_trade_msg(way, name, body, message, date):
     if name == 'HeartBeat':
@@ -28,22 +47,49 @@ def save_fix_trade_msg(way, name, body, message, date):
             if isinstance(message[k], datetime) or isinstance(message[k], datetime_date):
                 message[k] = str(message[k])
         # save the message to MongoDB
-        msg_doc = FixTradeMsg(way=way, name=name, body=body, message=message, date=date)
+        msg_doc = FixTradeMsg(way=way, name=name, body=body, message=message, date=date, **FixTradeMsg.extract_keys(message))
         msg_doc.save(write_concern={'fsync': True})
 
+@celery.task
+def snapshot_eod_rates():
+    TradeService.snapshot_eod_rates()
+
+
+@celery.task
+def archive_history():
+    return archive.archive_history()
+
+
+@celery.task
+def update_equity_curves():
+    return equity_curve.update_equity_curves()
+
+
+@celery.task
+def reconcile_leaderboard():
+    return Leaderboard.reconcile()
+
+
+@celery.task
+def record_leaderboard_close(position_id, score):
+    return Leaderboard.record_committed_close(position_id, score)
+
+
+@celery.task
+def accrue_financing():
+    return financing.accrue_financing()
+
+
 @celery.task
 def execute_order(order):
     if isinstance(order, int):
         order = Order.objects.get(id=order)
-    TradeService.open_position(
-        user=order.user,
-        instrument=order.instrument,
-        rate=order.expected_rate,
-        amount=order.amount,
-        side=order.side,
-        stop_loss_distance=order.asked_stop_distance,
-        take_profit_distance=order.take_profit_distance,
-        order=order
-    )
-    order.state = consts.STATE_EXECUTED
-    order.save()
\ No newline at end of file
+    TradeService.execute_order(order)
+
+
+@celery.task
+def execute_orders(order_ids):
+    """
+    Executes a batch of triggered orders, the payload is the list of order ids
+    """
+    return TradeService.execute_orders(order_ids)
\ No newline at end of file
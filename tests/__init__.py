@@ -0,0 +1,4 @@
+from .test_pricing import *
+from .test_equity_curve import *
+from .test_db_router import *
+from .test_timing_wheel import *
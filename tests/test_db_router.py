@@ -0,0 +1,129 @@
+"""
+Checks the replica routing with a second sqlite alias next to the default one: reads inside
+`replica_reads` go to the replica, writes and recently writing users stay on the primary and
+the viewset mixin drops the replica choice at the end of every request.
+"""
+import unittest
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.test.utils import override_settings
+
+from .. import db_router
+from ..db_router import ReplicaReadMixin, ReplicaRouter, replica_reads, stick_to_primary, sticky_key
+from ..models import Position
+
+
+REPLICA = 'db_router_replica'
+USER_ID = 4242
+
+
+class FakeUser(object):
+    pk = USER_ID
+
+
+class FakeRequest(object):
+    user = FakeUser()
+
+    def __init__(self, method):
+        self.method = method
+
+
+class FakeResponse(object):
+    status_code = 200
+
+
+class BaseView(object):
+    #the parts of a DRF view the mixin hooks into
+
+    def dispatch(self, request, *args, **kwargs):
+        self.initial(request)
+        self.read_from = Position.objects.all().db
+        if getattr(self, 'fail', False):
+            raise ValueError('view failed')
+        return self.finalize_response(request, FakeResponse())
+
+    def initial(self, request, *args, **kwargs):
+        pass
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        return response
+
+
+class View(ReplicaReadMixin, BaseView):
+    pass
+
+
+class ReplicaRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        connections.databases[REPLICA] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults(REPLICA)
+        self.settings = override_settings(DATABASE_REPLICAS=[REPLICA])
+        self.settings.enable()
+        self.routers = router.routers
+        router.routers = [ReplicaRouter()]
+        cache.delete(sticky_key(USER_ID))
+
+    def tearDown(self):
+        cache.delete(sticky_key(USER_ID))
+        router.routers = self.routers
+        self.settings.disable()
+        connections[REPLICA].close()
+        del connections.databases[REPLICA]
+        db_router._state.alias = None
+
+    def test_reads_stay_on_the_primary_by_default(self):
+        self.assertEqual(Position.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_replica_reads(self):
+        with replica_reads(USER_ID):
+            queryset = Position.objects.all()
+            self.assertEqual(queryset.db, REPLICA)
+            self.assertEqual(connections[queryset.db].vendor, 'sqlite')
+            self.assertEqual(router.db_for_write(Position), DEFAULT_DB_ALIAS)
+        self.assertEqual(Position.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_nested_blocks_restore_the_outer_choice(self):
+        with replica_reads():
+            with replica_reads():
+                pass
+            self.assertEqual(User.objects.all().db, REPLICA)
+        self.assertEqual(User.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_sticky_user_reads_the_primary(self):
+        stick_to_primary(USER_ID)
+        with replica_reads(USER_ID):
+            self.assertEqual(Position.objects.all().db, DEFAULT_DB_ALIAS)
+        #other users still read the replica
+        with replica_reads(USER_ID + 1):
+            self.assertEqual(Position.objects.all().db, REPLICA)
+
+    def test_no_replicas_configured(self):
+        with override_settings(DATABASE_REPLICAS=[]):
+            stick_to_primary(USER_ID)
+            self.assertIsNone(cache.get(sticky_key(USER_ID)))
+            with replica_reads(USER_ID):
+                self.assertEqual(Position.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_dispatch_reads_from_the_replica_and_resets(self):
+        view = View()
+        view.dispatch(FakeRequest('GET'))
+        self.assertEqual(view.read_from, REPLICA)
+        self.assertEqual(Position.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_dispatch_resets_after_an_exception(self):
+        view = View()
+        view.fail = True
+        self.assertRaises(ValueError, view.dispatch, FakeRequest('GET'))
+        self.assertEqual(view.read_from, REPLICA)
+        self.assertEqual(Position.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_writes_stick_to_the_primary(self):
+        view = View()
+        view.dispatch(FakeRequest('POST'))
+        self.assertEqual(view.read_from, DEFAULT_DB_ALIAS)
+        view = View()
+        view.dispatch(FakeRequest('GET'))
+        self.assertEqual(view.read_from, DEFAULT_DB_ALIAS)
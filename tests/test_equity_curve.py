@@ -0,0 +1,89 @@
+"""
+Checks the equity curve arrays against a two instrument curve computed by hand: a EURUSD long
+opened and closed inside the window and a USDJPY long carried in, partly closed and marked in yen.
+The user currency is USD and one yen is worth 0.01 of it.
+"""
+import unittest
+from datetime import date, timedelta
+from decimal import Decimal
+
+import numpy as np
+
+from trade import consts
+from ..equity_curve import EquityCurveService, forward_fill
+
+
+EURUSD = 1
+USDJPY = 2
+FIRST_DAY = date(2024, 3, 4).toordinal()
+
+
+class FakeCurrency(object):
+    pk = 1
+
+
+class EquityCurveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patched = dict(
+            (name, EquityCurveService.__dict__[name]) for name in ('_trades', '_factors', '_eod_rates')
+        )
+        EquityCurveService._trades = staticmethod(self.trades)
+        EquityCurveService._factors = staticmethod(lambda instrument_ids, currency: {EURUSD: 1.0, USDJPY: 0.01})
+        EquityCurveService._eod_rates = staticmethod(self.eod_rates)
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(EquityCurveService, name, value)
+
+    def at(self, day):
+        return EquityCurveService._day_start(FIRST_DAY + day) + timedelta(hours=12)
+
+    def trades(self, user, first_day, last_day):
+        rows = [
+            #time, instrument, side, amount, rate, position side, position open rate
+            (self.at(0), EURUSD, consts.TYPE_BUY, 10, Decimal('1.10'), consts.TYPE_BUY, Decimal('1.10')),
+            (self.at(1), USDJPY, consts.TYPE_SELL, 40, Decimal('160'), consts.TYPE_BUY, Decimal('150')),
+            (self.at(2), EURUSD, consts.TYPE_SELL, 10, Decimal('1.30'), consts.TYPE_BUY, Decimal('1.10')),
+        ]
+        return [row for row in rows if first_day <= row[0].date().toordinal() <= last_day]
+
+    def eod_rates(self, instrument_ids, first_day, last_day):
+        rows = [
+            #the EURUSD mark of the first day is carried over from before the window
+            (EURUSD, date.fromordinal(FIRST_DAY - 3), Decimal('1.00')),
+            (EURUSD, date.fromordinal(FIRST_DAY + 1), Decimal('1.20')),
+            (USDJPY, date.fromordinal(FIRST_DAY), Decimal('155')),
+            (USDJPY, date.fromordinal(FIRST_DAY + 3), Decimal('140')),
+        ]
+        return [row for row in rows if row[0] in instrument_ids and first_day <= row[1].toordinal() <= last_day]
+
+    def test_forward_fill(self):
+        filled = forward_fill(np.array([np.nan, 1.0, np.nan, np.nan, 2.0, np.nan]))
+        self.assertTrue(np.isnan(filled[0]))
+        self.assertEqual(filled[1:].tolist(), [1.0, 1.0, 1.0, 2.0, 2.0])
+
+    def test_two_instrument_curve(self):
+        state = {
+            'start': FIRST_DAY,
+            'last_day': FIRST_DAY - 1,
+            'capital': 1000.0,
+            'realized': 0.0,
+            #100 USDJPY bought at 150 before the window
+            'exposure': {USDJPY: [100.0, 15000.0]},
+            'equity': [],
+        }
+        EquityCurveService._extend(None, FakeCurrency(), state, FIRST_DAY + 3)
+        #day 0: EURUSD 10 * 1.00 - 11 = -1, USDJPY 100 * 155 - 15000 = 500 JPY = 5
+        #day 1: realized 40 * (160 - 150) = 400 JPY = 4, EURUSD 12 - 11 = 1, USDJPY 60 * 155 - 9000 = 3
+        #day 2: realized 10 * (1.30 - 1.10) = 2, EURUSD closed, USDJPY still 3
+        #day 3: USDJPY 60 * 140 - 9000 = -600 JPY = -6
+        self.assertEqual(state['equity'], [1004.0, 1008.0, 1009.0, 1000.0])
+        self.assertAlmostEqual(state['realized'], 6.0)
+        self.assertEqual(sorted(state['exposure']), [USDJPY])
+        self.assertEqual(state['exposure'][USDJPY], [60.0, 9000.0])
+
+        #a day without trades or marks carries the exposure and the last mark over
+        EquityCurveService._extend(None, FakeCurrency(), state, FIRST_DAY + 4)
+        self.assertEqual(state['equity'][-1], 1000.0)
+        self.assertEqual(state['last_day'], FIRST_DAY + 4)
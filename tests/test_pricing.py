@@ -0,0 +1,232 @@
+"""
+Checks the fixed point pricing against the Decimal formulas TradeService used before trade.pricing,
+copied here unchanged. Both have to give identical results for every tick size, side and
+absolute/relative flag; rates are stored with 6 decimals and distances with 2.
+"""
+import random
+import unittest
+from decimal import Decimal, ROUND_DOWN, ROUND_UP
+
+from trade import consts
+from .. import pricing
+
+
+TICK_SIZES = ('0.00001', '0.0001', '0.001', '0.01', '0.03', '0.05', '0.07', '0.25', '0.5', '1', '5')
+SIDES = (consts.TYPE_BUY, consts.TYPE_SELL)
+SAMPLES = 200
+
+
+class FakeCurrency(object):
+
+    def quantize_value_up(self, value):
+        return Decimal(value).quantize(Decimal('0.01'), rounding=ROUND_UP)
+
+
+class FakeInstrument(object):
+
+    def __init__(self, tick_size, absolute, minimum_stop_distance, minimum_margin, slippage):
+        self.tick_size = Decimal(tick_size)
+        self.display_tick_size = Decimal(tick_size)
+        self.stop_distance_absolute = absolute
+        self.minimum_stop_distance = Decimal(minimum_stop_distance)
+        self.minimum_margin_absolute = absolute
+        self.minimum_margin = Decimal(minimum_margin)
+        self.slippage_absolute = absolute
+        self.slippage = Decimal(slippage)
+        self.quote_asset = FakeCurrency()
+
+
+#region Decimal formulas
+def quantize_price_down(instrument, value):
+    return Decimal(value).quantize(instrument.display_tick_size.normalize(), rounding=ROUND_DOWN)
+
+
+def quantize_price_up(instrument, value):
+    return Decimal(value).quantize(instrument.display_tick_size.normalize(), rounding=ROUND_UP)
+
+
+def _get_stoploss_rate(instrument, stop_loss_distance, rate, side):
+    instrument_distance = _get_instrument_min_distance(instrument, rate)
+    if stop_loss_distance < instrument_distance:
+        stop_loss_distance = instrument_distance
+    return _distance_to_rate_convert(side, stop_loss_distance, rate, instrument)
+
+
+def _get_instrument_min_distance(instrument, rate):
+    if instrument.stop_distance_absolute:
+        return instrument.minimum_stop_distance
+    else:
+        return Decimal(instrument.minimum_stop_distance) / 100 * rate / instrument.tick_size
+
+
+def _distance_to_rate_convert(side, distance, rate, instrument, is_take_profit=False):
+    if side == consts.TYPE_BUY:
+        multiplier = 1
+    else:
+        multiplier = -1
+    if is_take_profit:
+        multiplier *= -1
+    return Decimal(rate) - Decimal(distance) * instrument.tick_size * multiplier
+
+
+def _rate_to_distance_convert(side, distance_rate, open_rate, instrument, is_take_profit=False):
+    if side == consts.TYPE_BUY:
+        multiplier = 1
+    else:
+        multiplier = -1
+    if is_take_profit:
+        multiplier *= -1
+    return (Decimal(open_rate) - Decimal(distance_rate)) / instrument.tick_size / multiplier
+
+
+def _calculate_margin(side, instrument, stop_loss_rate, amount, rate):
+    if instrument.minimum_margin_absolute:
+        minimum_margin = instrument.minimum_margin * instrument.tick_size
+    else:
+        minimum_margin = Decimal(instrument.minimum_margin) / 100 * Decimal(rate)
+    stop_distance = abs(rate - stop_loss_rate)
+    if instrument.slippage_absolute:
+        slippage_rate = Decimal(instrument.slippage) * instrument.tick_size
+    else:
+        slippage_rate = Decimal(instrument.slippage) / 100 * Decimal(minimum_margin)
+    cash = (Decimal(max(stop_distance, minimum_margin)) + slippage_rate) * Decimal(amount)
+    if cash > 0:
+        return instrument.quote_asset.quantize_value_up(cash)
+    else:
+        return 0
+#endregion Decimal formulas
+
+
+def calculate_margin(instrument, stop_loss_rate, amount, rate):
+    #as TradeService._calculate_margin
+    cash = pricing.margin_cash(instrument, stop_loss_rate, amount, rate)
+    if cash > 0:
+        return instrument.quote_asset.quantize_value_up(cash)
+    else:
+        return 0
+
+
+def factor(rng, low, high):
+    return Decimal(rng.randint(low * 100, high * 100)).scaleb(-2)
+
+
+class PricingEquivalenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(20240611)
+
+    def instruments(self):
+        for tick_size in TICK_SIZES:
+            for absolute in (True, False):
+                yield FakeInstrument(
+                    tick_size,
+                    absolute,
+                    factor(self.rng, 0, 200),
+                    factor(self.rng, 0, 50),
+                    factor(self.rng, 0, 20)
+                )
+
+    def rate(self, instrument):
+        #tick aligned rates and rates with all 6 stored decimals
+        rate = Decimal(self.rng.randint(1, 10 ** 11)).scaleb(-6)
+        if self.rng.random() < 0.5:
+            rate = max(instrument.tick_size, rate.quantize(instrument.tick_size, rounding=ROUND_DOWN))
+        return rate
+
+    def assertSame(self, expected, actual, *args):
+        self.assertEqual(expected, actual, '%s != %s for %r' % (expected, actual, args))
+
+    def test_stoploss_rate(self):
+        for instrument in self.instruments():
+            for _ in xrange(SAMPLES):
+                rate = self.rate(instrument)
+                distance = factor(self.rng, 0, 5000)
+                for side in SIDES:
+                    self.assertSame(
+                        _get_stoploss_rate(instrument, distance, rate, side),
+                        pricing.stoploss_rate(instrument, distance, rate, side),
+                        instrument.tick_size, instrument.stop_distance_absolute, distance, rate, side
+                    )
+
+    def test_minimum_stop_distance(self):
+        for instrument in self.instruments():
+            for _ in xrange(SAMPLES):
+                rate = self.rate(instrument)
+                self.assertSame(
+                    _get_instrument_min_distance(instrument, rate),
+                    pricing.minimum_stop_distance(instrument, rate),
+                    instrument.tick_size, instrument.stop_distance_absolute, rate
+                )
+
+    def test_distance_to_rate(self):
+        for instrument in self.instruments():
+            for _ in xrange(SAMPLES):
+                rate = self.rate(instrument)
+                distance = factor(self.rng, 0, 5000)
+                for side in SIDES:
+                    for is_take_profit in (False, True):
+                        self.assertSame(
+                            _distance_to_rate_convert(side, distance, rate, instrument, is_take_profit),
+                            pricing.distance_to_rate(instrument, side, distance, rate, is_take_profit),
+                            instrument.tick_size, distance, rate, side, is_take_profit
+                        )
+
+    def test_rate_to_distance(self):
+        for instrument in self.instruments():
+            for _ in xrange(SAMPLES):
+                open_rate = self.rate(instrument)
+                distance_rate = self.rate(instrument)
+                for side in SIDES:
+                    for is_take_profit in (False, True):
+                        self.assertSame(
+                            _rate_to_distance_convert(side, distance_rate, open_rate, instrument, is_take_profit),
+                            pricing.rate_to_distance(instrument, side, distance_rate, open_rate, is_take_profit),
+                            instrument.tick_size, distance_rate, open_rate, side, is_take_profit
+                        )
+
+    def test_margin(self):
+        for instrument in self.instruments():
+            for _ in xrange(SAMPLES):
+                rate = self.rate(instrument)
+                amount = self.rng.randint(1, 10 ** 6)
+                distance = factor(self.rng, 0, 5000)
+                for side in SIDES:
+                    #unrounded stop losses as open_position computes them and stored ones
+                    stop_loss_rate = _get_stoploss_rate(instrument, distance, rate, side)
+                    for stop_loss_rate in (stop_loss_rate, stop_loss_rate.quantize(Decimal('0.000001'))):
+                        self.assertSame(
+                            _calculate_margin(side, instrument, stop_loss_rate, amount, rate),
+                            calculate_margin(instrument, stop_loss_rate, amount, rate),
+                            instrument.tick_size, instrument.minimum_margin_absolute, stop_loss_rate, amount, rate
+                        )
+
+    def test_open_levels(self):
+        for instrument in self.instruments():
+            for _ in xrange(SAMPLES):
+                rate = self.rate(instrument)
+                amount = self.rng.randint(1, 10 ** 6)
+                distance = factor(self.rng, 0, 5000)
+                take_profit_distance = self.rng.choice((None, factor(self.rng, 0, 5000)))
+                for side in SIDES:
+                    stop_loss_rate = _get_stoploss_rate(instrument, distance, rate, side)
+                    if take_profit_distance is None:
+                        take_profit_rate = None
+                    else:
+                        take_profit_rate = _distance_to_rate_convert(side, take_profit_distance, rate, instrument, True)
+                    stop_loss, take_profit, cash = pricing.open_levels(instrument, side, distance, amount, rate, take_profit_distance)
+                    self.assertSame(
+                        (stop_loss_rate, take_profit_rate, _calculate_margin(side, instrument, stop_loss_rate, amount, rate)),
+                        (stop_loss, take_profit, instrument.quote_asset.quantize_value_up(cash) if cash > 0 else 0),
+                        instrument.tick_size, instrument.stop_distance_absolute, distance, take_profit_distance, rate, side
+                    )
+
+    def test_quantize(self):
+        for tick_size in TICK_SIZES + ('0.1', '10', '0.000001'):
+            instrument = FakeInstrument(tick_size, False, 0, 0, 0)
+            scale = pricing.PriceScale.of(instrument)
+            for _ in xrange(SAMPLES):
+                digits = self.rng.randint(0, 20)
+                value = Decimal(self.rng.randint(-10 ** (digits + 5), 10 ** (digits + 5))).scaleb(-digits)
+                for value in (value, str(value), float(value)):
+                    self.assertSame(quantize_price_down(instrument, value), scale.round_down(value), tick_size, value)
+                    self.assertSame(quantize_price_up(instrument, value), scale.round_up(value), tick_size, value)
@@ -0,0 +1,82 @@
+"""
+Checks the timing wheel against a sorted list of (expiry tick, key) under random schedules,
+reschedules, cancels and advances, with wheels small enough that deadlines cascade through every
+level and past the horizon.
+"""
+import bisect
+import random
+import unittest
+
+from ..timing_wheel import TimingWheel
+
+
+class SortedListTimer(object):
+    #reference: expiry ticks as the wheel computes them, expired in order
+
+    def __init__(self, start, tick):
+        self.tick = tick
+        self.current = int(start // tick)
+        self.expiries = []
+        self.entries = {}
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        expires = max(int(deadline // self.tick), self.current + 1)
+        bisect.insort(self.expiries, (expires, key))
+        self.entries[key] = expires
+
+    def cancel(self, key):
+        expires = self.entries.pop(key, None)
+        if expires is not None:
+            self.expiries.remove((expires, key))
+
+    def advance(self, now):
+        self.current = max(self.current, int(now // self.tick))
+        count = bisect.bisect_right(self.expiries, (self.current, float('inf')))
+        expired = [key for expires, key in self.expiries[:count]]
+        del self.expiries[:count]
+        for key in expired:
+            del self.entries[key]
+        return expired
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def check(self, seed, tick, slots, levels, horizon, steps=3000):
+        rng = random.Random(seed)
+        start = rng.uniform(0, 10000)
+        wheel = TimingWheel(start, tick, slots, levels)
+        reference = SortedListTimer(start, tick)
+        now = start
+        for step in xrange(steps):
+            action = rng.random()
+            key = rng.randint(0, 200)
+            if action < 0.5:
+                #past deadlines too, they expire on the next tick
+                deadline = now + rng.uniform(-2 * tick, horizon * tick)
+                wheel.schedule(key, deadline)
+                reference.schedule(key, deadline)
+            elif action < 0.65:
+                wheel.cancel(key)
+                reference.cancel(key)
+            else:
+                now += rng.choice((0, tick, rng.uniform(0, 3 * tick), rng.uniform(0, horizon * tick / 4)))
+                self.assertEqual(sorted(wheel.advance(now)), sorted(reference.advance(now)), 'seed %s step %s' % (seed, step))
+            self.assertEqual(len(wheel), len(reference.entries))
+            self.assertEqual(key in wheel, key in reference.entries)
+        #everything still scheduled expires at the right tick
+        now += horizon * tick * 2
+        self.assertEqual(sorted(wheel.advance(now)), sorted(reference.advance(now)))
+        self.assertEqual(len(wheel), 0)
+
+    def test_small_wheel_past_the_horizon(self):
+        #4 ** 3 = 64 ticks of horizon, deadlines up to 300 ticks are parked and re-placed
+        for seed in range(5):
+            self.check(seed, 1, 4, 3, 300)
+
+    def test_fractional_ticks(self):
+        for seed in range(5):
+            self.check(seed, 0.25, 8, 2, 100)
+
+    def test_default_wheel(self):
+        self.check(42, 1, 64, 4, 5000)
@@ -0,0 +1,101 @@
+"""
+Latency of the rates ticks through the socket tier, per stage and per instrument.
+Histograms have power of two microsecond buckets so recording a sample is a couple of int
+operations, cheap enough to run on every tick. Off unless TICK_LATENCY_ENABLED is set.
+"""
+from django.conf import settings
+
+
+#source: LP timestamp to receive, quantize: receive to rates built, cache: rates cache write,
+#dispatch: receive to handed to the listeners, including the tick ring hop when the ring is used,
+#fanout: dispatch to socket send, sampled over TICK_LATENCY_FANOUT_SAMPLE sends
+STAGES = ('source', 'quantize', 'cache', 'dispatch', 'fanout')
+BUCKETS = 32
+
+
+class LatencyHistogram(object):
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, micros):
+        if micros < 0:
+            #clock skew between hosts, counted as zero
+            micros = 0
+        self.counts[min(micros.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, fraction):
+        """
+        Upper bound in microseconds of the bucket holding the `fraction` percentile
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min((1 << bucket) - 1, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total // self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class TickLatency(object):
+    """
+    Histograms per (stage, instrument), the totals of a stage are kept under the '*' instrument
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.enabled = getattr(settings, 'TICK_LATENCY_ENABLED', False)
+        self.echo = getattr(settings, 'TICK_LATENCY_ECHO', False)
+        self.source_key = getattr(settings, 'TICK_LATENCY_SOURCE_KEY', 'timestamp')
+
+    def record(self, stage, symbol, seconds):
+        micros = int(seconds * 1000000)
+        for key in ((stage, symbol), (stage, '*')):
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(micros)
+
+    def record_tick(self, symbol, msg, received, dispatched):
+        source = msg.get(self.source_key)
+        if source is not None:
+            try:
+                self.record('source', symbol, received - float(source))
+            except (TypeError, ValueError):
+                pass
+        self.record('dispatch', symbol, dispatched - received)
+        if self.echo:
+            #server stamps in epoch milliseconds so clients can measure the browser side delay
+            msg['latency'] = {'received': int(received * 1000), 'dispatched': int(dispatched * 1000)}
+
+    def stats(self):
+        result = {}
+        for (stage, symbol), histogram in self.histograms.items():
+            result.setdefault(stage, {})[symbol] = histogram.as_dict()
+        return result
+
+    def reset(self):
+        self.histograms = {}
+
+
+tick_latency = TickLatency()
@@ -0,0 +1,298 @@
+"""
+Raw rates ticks kept in memory mapped segment files, so a market session can be replayed
+against the socket tier and the trading logic.
+
+A segment covers up to TICK_SEGMENT_SECONDS and is laid out as a header, a table of the
+asset slugs seen in it, an index holding the first record of every second and the fixed
+width records themselves. Files are preallocated sparse and records are appended in time order.
+Segments are named by their start second, with a sequence number when a full segment is
+followed by another one starting in the same second.
+"""
+import mmap
+import os
+import struct
+import time
+
+from django.conf import settings
+
+from .pricing import to_units, from_units, RATE_KEYS
+
+
+MAGIC = 'TICKS001'
+#magic, start second, seconds covered, record capacity, record count, symbol count
+HEADER = struct.Struct('<8sqqqqq')
+COUNT_OFFSET = 32
+SYMBOLS_OFFSET = 40
+SYMBOL = struct.Struct('128s')
+MAX_SYMBOLS = 1024
+INDEX = struct.Struct('<I')
+UNINDEXED = 0xffffffff
+#timestamp, symbol number and the rates in pricing units
+RECORD = struct.Struct('<dI4q')
+EXTENSION = '.ticks'
+
+
+class SegmentFull(Exception):
+    pass
+
+
+def tick_directory():
+    return getattr(settings, 'TICK_RECORD_DIR', 'ticks')
+
+
+def segment_path(directory, start, sequence=0):
+    if sequence:
+        return os.path.join(directory, '%d_%d%s' % (start, sequence, EXTENSION))
+    return os.path.join(directory, '%d%s' % (start, EXTENSION))
+
+
+class Segment(object):
+
+    def __init__(self, path, start=None, seconds=None, capacity=None, writable=False):
+        self.path = path
+        if writable and not os.path.exists(path):
+            Segment._create(path, start, seconds, capacity)
+        self.file = open(path, 'r+b' if writable else 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, self.start, self.seconds, self.capacity, count, symbols = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a tick segment' % path)
+        self.index_offset = HEADER.size + SYMBOL.size * MAX_SYMBOLS
+        self.records_offset = self.index_offset + INDEX.size * self.seconds
+        self.symbols = []
+        self.symbol_ids = {}
+        self._load_symbols()
+        #seconds of the index filled so far, the writer resumes after the last record
+        self.indexed = 0
+        if count:
+            self.indexed = int(self.record(count - 1)[0]) - self.start + 1
+
+    @staticmethod
+    def _create(path, start, seconds, capacity):
+        size = HEADER.size + SYMBOL.size * MAX_SYMBOLS + INDEX.size * seconds + RECORD.size * capacity
+        with open(path, 'wb') as f:
+            f.truncate(size)
+            f.write(HEADER.pack(MAGIC, start, seconds, capacity, 0, 0))
+            f.seek(HEADER.size + SYMBOL.size * MAX_SYMBOLS)
+            f.write(INDEX.pack(UNINDEXED) * seconds)
+
+    @staticmethod
+    def is_full(path):
+        segment = Segment(path)
+        try:
+            return segment.count >= segment.capacity
+        finally:
+            segment.close()
+
+    @property
+    def end(self):
+        return self.start + self.seconds
+
+    @property
+    def count(self):
+        return struct.unpack_from('<q', self.map, COUNT_OFFSET)[0]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def _load_symbols(self):
+        total = struct.unpack_from('<q', self.map, SYMBOLS_OFFSET)[0]
+        for i in range(len(self.symbols), total):
+            symbol = SYMBOL.unpack_from(self.map, HEADER.size + SYMBOL.size * i)[0].rstrip('\0')
+            self.symbol_ids[symbol] = i
+            self.symbols.append(symbol)
+
+    def _symbol_id(self, symbol):
+        symbol_id = self.symbol_ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self.symbols)
+            if symbol_id >= MAX_SYMBOLS:
+                raise SegmentFull()
+            SYMBOL.pack_into(self.map, HEADER.size + SYMBOL.size * symbol_id, symbol)
+            struct.pack_into('<q', self.map, SYMBOLS_OFFSET, symbol_id + 1)
+            self.symbol_ids[symbol] = symbol_id
+            self.symbols.append(symbol)
+        return symbol_id
+
+    def append(self, timestamp, symbol, rates):
+        """
+        Appends one tick, `timestamp` must not be older than the previous one
+        """
+        count = self.count
+        if count >= self.capacity:
+            raise SegmentFull()
+        symbol_id = self._symbol_id(symbol)
+        second = int(timestamp) - self.start
+        while self.indexed <= second:
+            INDEX.pack_into(self.map, self.index_offset + INDEX.size * self.indexed, count)
+            self.indexed += 1
+        RECORD.pack_into(self.map, self.records_offset + RECORD.size * count, timestamp, symbol_id, *rates)
+        #publish the record to readers only once it is complete
+        struct.pack_into('<q', self.map, COUNT_OFFSET, count + 1)
+
+    def record(self, position):
+        return RECORD.unpack_from(self.map, self.records_offset + RECORD.size * position)
+
+    def position_at(self, timestamp):
+        """
+        Returns the position of the first record at or after `timestamp`
+        """
+        count = self.count
+        second = int(timestamp) - self.start
+        if second < 0:
+            return 0
+        if second >= self.seconds:
+            return count
+        position = INDEX.unpack_from(self.map, self.index_offset + INDEX.size * second)[0]
+        if position == UNINDEXED:
+            return count
+        while position < count and self.record(position)[0] < timestamp:
+            position += 1
+        return position
+
+    def ticks(self, date_from=None, date_to=None):
+        """
+        Yields (timestamp, symbol, rates) of the records in [date_from, date_to)
+        """
+        position = self.position_at(date_from) if date_from is not None else 0
+        count = self.count
+        while position < count:
+            record = self.record(position)
+            if date_to is not None and record[0] >= date_to:
+                break
+            if record[1] >= len(self.symbols):
+                self._load_symbols()
+            yield record[0], self.symbols[record[1]], record[2:]
+            position += 1
+
+
+class TickRecorder(object):
+    """
+    Appends the ticks of the rates stream to the current segment, rolling to a new
+    one on every segment boundary or when the current one is full
+    """
+
+    def __init__(self, directory=None, segment_seconds=None, capacity=None):
+        self.directory = directory or tick_directory()
+        self.segment_seconds = segment_seconds or getattr(settings, 'TICK_SEGMENT_SECONDS', 3600)
+        self.capacity = capacity or getattr(settings, 'TICK_SEGMENT_CAPACITY', 2 ** 21)
+        self.segment = None
+        self.last = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def record(self, msg, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        symbol = msg['asset'].encode('utf-8')
+        rates = [to_units(msg[key]) for key in RATE_KEYS]
+        if self.segment is None or timestamp >= self.segment.end:
+            self._roll(timestamp)
+        #keep the records ordered when the clock steps back
+        timestamp = max(timestamp, self.last)
+        self.last = timestamp
+        try:
+            self.segment.append(timestamp, symbol, rates)
+        except SegmentFull:
+            self._roll(timestamp, full=True)
+            self.segment.append(timestamp, symbol, rates)
+
+    def _roll(self, timestamp, full=False):
+        if self.segment is not None:
+            self.segment.close()
+        second = int(timestamp)
+        start = second if full else self._resume_start(second)
+        end = (second // self.segment_seconds + 1) * self.segment_seconds
+        sequence = 0
+        path = segment_path(self.directory, start, sequence)
+        #full segments may already start in this second, the next one gets a sequence number
+        while os.path.exists(path) and (full or Segment.is_full(path)):
+            sequence += 1
+            path = segment_path(self.directory, start, sequence)
+        self.segment = Segment(path, start, end - start, self.capacity, writable=True)
+        count = self.segment.count
+        if count:
+            self.last = max(self.last, self.segment.record(count - 1)[0])
+
+    def _resume_start(self, second):
+        """
+        Start of the segment for `second`, the last one of the period is reopened after a restart
+        and a full one is followed by a segment covering only the rest of the period
+        """
+        period_start = second // self.segment_seconds * self.segment_seconds
+        segments = list_segments(self.directory)
+        if not segments or segments[-1][0] < period_start:
+            return period_start
+        return second if Segment.is_full(segments[-1][1]) else segments[-1][0]
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+
+def list_segments(directory=None):
+    """
+    Returns (start second, path) of the recorded segments, oldest first
+    """
+    directory = directory or tick_directory()
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        if name.endswith(EXTENSION):
+            start, _, sequence = name[:-len(EXTENSION)].partition('_')
+            segments.append((int(start), int(sequence or 0), os.path.join(directory, name)))
+    segments.sort()
+    return [(start, path) for start, sequence, path in segments]
+
+
+def format_units(units):
+    return format(from_units(units).normalize(), 'f')
+
+
+class TickReplayer(object):
+    """
+    Feeds recorded ticks as rates messages to a callback, at the recorded pace divided by `speed`
+    or as fast as possible when `speed` is 0
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or tick_directory()
+
+    def messages(self, date_from=None, date_to=None):
+        segments = list_segments(self.directory)
+        for i, (start, path) in enumerate(segments):
+            if date_to is not None and start >= date_to:
+                break
+            #segments never overlap, skip the ones ending before the range, a full one can end
+            #within the start second of the next
+            if date_from is not None and i + 1 < len(segments) and segments[i + 1][0] + 1 <= date_from:
+                continue
+            segment = Segment(path)
+            try:
+                for timestamp, symbol, rates in segment.ticks(date_from, date_to):
+                    msg = dict((key, format_units(value)) for key, value in zip(RATE_KEYS, rates))
+                    msg['asset'] = symbol
+                    yield timestamp, msg
+            finally:
+                segment.close()
+
+    def replay(self, callback, date_from=None, date_to=None, speed=1.0):
+        """
+        Returns the number of ticks replayed
+        """
+        replayed = 0
+        first = None
+        started = time.time()
+        for timestamp, msg in self.messages(date_from, date_to):
+            if speed:
+                if first is None:
+                    first = timestamp
+                delay = (timestamp - first) / speed - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            callback(msg)
+            replayed += 1
+        return replayed
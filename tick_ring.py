@@ -0,0 +1,255 @@
+"""
+Per host fan-out of normalized ticks. One price feeder process consumes the rates channel,
+quantizes each tick once and writes it into a ring of fixed size slots in a shared memory
+mapped file. Every socket worker process maps the same file and copies out only the used
+bytes of each new slot, so broker load and quantization work no longer grow with the number of
+worker processes. The payload part of a slot is TICK_RING_PAYLOAD_SIZE bytes, enough for the
+quotes of every spread tier; ticks that do not fit are dropped, counted and logged.
+
+Slots are guarded by their sequence number: the writer marks a slot as being written before
+filling it and stores its sequence last, readers drop a slot whose sequence changed while it
+was read. A reader lagging more than a full ring behind skips to the oldest slot still intact.
+
+A ring of another layout is replaced by a new file, never resized in place, so mapped readers
+keep a valid mapping; they map the new file once the old one stops moving. The feeder latency
+histograms are shared through a file next to the ring.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from django.conf import settings
+
+from .pricing import PRICE_SCALE
+from .tick_latency import tick_latency
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'TRING002'
+#magic, slot count, next sequence, payload size
+HEADER = struct.Struct('<8sqqq')
+NEXT_OFFSET = 16
+#sequence, receive time, sell/buy/low/high units, symbol and payload lengths; followed by the
+#chart symbol and the JSON of the client message
+SLOT = struct.Struct('<qd4qHI')
+SYMBOL_SIZE = 128
+WRITING = -1
+
+
+def ring_path():
+    return getattr(settings, 'TICK_RING_PATH', '/dev/shm/trade_ticks')
+
+
+def stats_path():
+    return ring_path() + '.latency'
+
+
+def feeder_stats():
+    """
+    Latency histograms last stored by the price feeder of this host, empty when there are none
+    """
+    try:
+        with open(stats_path()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def replace_file(path, write):
+    """
+    Writes a new file through `write(file)` and moves it over `path`
+    """
+    temporary = '%s.%s' % (path, os.getpid())
+    with open(temporary, 'wb') as f:
+        write(f)
+    os.rename(temporary, path)
+
+
+class TickRing(object):
+
+    def __init__(self, path, slots=None, payload_size=None, writable=False):
+        if writable:
+            slots = slots or getattr(settings, 'TICK_RING_SLOTS', 65536)
+            payload_size = payload_size or getattr(settings, 'TICK_RING_PAYLOAD_SIZE', 2048)
+            if self.layout(path) != (MAGIC, slots, payload_size):
+                def write(f):
+                    f.truncate(HEADER.size + (SLOT.size + SYMBOL_SIZE + payload_size) * slots)
+                    f.write(HEADER.pack(MAGIC, slots, 0, payload_size))
+                #truncating the mapped file in place would fault the readers still mapping it
+                replace_file(path, write)
+        self.path = path
+        self.file = open(path, 'r+b' if writable else 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+            magic, self.slots, next_sequence, self.payload_size = HEADER.unpack_from(self.map, 0)
+        except (ValueError, struct.error):
+            self.file.close()
+            raise ValueError('%s is not a tick ring' % path)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a tick ring' % path)
+        self.slot_size = SLOT.size + SYMBOL_SIZE + self.payload_size
+
+    @staticmethod
+    def layout(path):
+        """
+        (magic, slot count, payload size) of an existing ring file, None when there is none
+        """
+        try:
+            with open(path, 'rb') as f:
+                magic, slots, next_sequence, payload_size = HEADER.unpack(f.read(HEADER.size))
+        except (IOError, struct.error):
+            return None
+        return magic, slots, payload_size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    @property
+    def next_sequence(self):
+        return struct.unpack_from('<q', self.map, NEXT_OFFSET)[0]
+
+    def offset(self, sequence):
+        return HEADER.size + self.slot_size * (sequence % self.slots)
+
+
+class TickRingWriter(TickRing):
+
+    def __init__(self, path=None, slots=None, payload_size=None):
+        super(TickRingWriter, self).__init__(path or ring_path(), slots, payload_size, writable=True)
+        self.sequence = self.next_sequence
+        self.dropped = 0
+
+    def write(self, received, msg, units, symbol):
+        symbol = symbol.encode('utf-8')
+        payload = json.dumps(msg, separators=(',', ':'))
+        if len(payload) > self.payload_size or len(symbol) > SYMBOL_SIZE:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(
+                    'Tick of %s does not fit the ring: %s payload bytes of %s, %s ticks dropped so far',
+                    symbol, len(payload), self.payload_size, self.dropped
+                )
+            return False
+        offset = self.offset(self.sequence)
+        struct.pack_into('<q', self.map, offset, WRITING)
+        SLOT.pack_into(
+            self.map, offset, WRITING, received,
+            units['sell'], units['buy'], units['low'], units['high'],
+            len(symbol), len(payload)
+        )
+        start = offset + SLOT.size
+        self.map[start:start + len(symbol)] = symbol
+        start += SYMBOL_SIZE
+        self.map[start:start + len(payload)] = payload
+        #the sequence goes last, readers take the slot as complete only once it matches
+        struct.pack_into('<q', self.map, offset, self.sequence)
+        self.sequence += 1
+        struct.pack_into('<q', self.map, NEXT_OFFSET, self.sequence)
+        return True
+
+
+class TickRingReader(TickRing):
+
+    def __init__(self, path=None):
+        super(TickRingReader, self).__init__(path or ring_path())
+        #start with the next tick, history is already stale
+        self.sequence = self.next_sequence
+        self.lost = 0
+        self.remaps = 0
+
+    def replaced(self):
+        """
+        True when the ring path now holds another file than the mapped one
+        """
+        try:
+            current = os.stat(self.path)
+        except OSError:
+            #between feeder restarts, keep the old mapping
+            return False
+        mapped = os.fstat(self.file.fileno())
+        return (current.st_dev, current.st_ino) != (mapped.st_dev, mapped.st_ino)
+
+    def remap(self):
+        self.close()
+        super(TickRingReader, self).__init__(self.path)
+        #every tick of the new ring is newer than the ones read from the old one
+        self.sequence = 0
+        self.remaps += 1
+        logger.warning('Tick ring %s was replaced, mapped again', self.path)
+
+    def read(self):
+        """
+        Yields (msg, units, chart symbol, receive time) of the ticks written since the previous call
+        """
+        end = self.next_sequence
+        #a replaced ring stops moving, checked only then to spare a stat per poll
+        if end == self.sequence and self.replaced():
+            self.remap()
+            end = self.next_sequence
+        elif end < self.sequence:
+            #the ring was reset in place with the same layout, its sequence started over
+            self.sequence = 0
+        if end - self.sequence > self.slots:
+            self.lost += end - self.slots - self.sequence
+            self.sequence = end - self.slots
+        while self.sequence < end:
+            offset = self.offset(self.sequence)
+            (sequence, received, sell, buy, low, high,
+             symbol_length, payload_length) = SLOT.unpack_from(self.map, offset)
+            #only the used bytes are copied, lengths of a torn slot are bounded by the slot
+            start = offset + SLOT.size
+            symbol = self.map[start:start + min(symbol_length, SYMBOL_SIZE)]
+            start += SYMBOL_SIZE
+            payload = self.map[start:start + min(payload_length, self.payload_size)]
+            #the writer went over the slot while it was read
+            if sequence != self.sequence or struct.unpack_from('<q', self.map, offset)[0] != sequence:
+                self.lost += 1
+            else:
+                units = {'sell': sell, 'buy': buy, 'low': low, 'high': high}
+                yield json.loads(payload), units, symbol.decode('utf-8'), received
+            self.sequence += 1
+
+
+class PriceFeeder(object):
+    """
+    The single per host rates consumer. Normalizes ticks like the in process broadcast does,
+    keeps and persists the candles and hands the result to the socket workers through the ring.
+    """
+
+    def __init__(self, writer=None):
+        from .socketio_namespaces import InstrumentsPriceNamespace, candle_builder
+        self.normalize = InstrumentsPriceNamespace.normalize
+        self.candle_builder = candle_builder
+        self.writer = writer or TickRingWriter()
+        self.flush_interval = getattr(settings, 'CANDLE_FLUSH_INTERVAL', 5)
+        self.last_flush = time.time()
+
+    def on_tick(self, msg):
+        received = time.time()
+        normalized = self.normalize(msg, received)
+        if normalized is None:
+            return
+        instrument, units = normalized
+        symbol = instrument.chart_code or instrument.url_slug
+        self.candle_builder.update(symbol, float(units['sell']) / PRICE_SCALE)
+        self.writer.write(received, msg, units, symbol)
+
+        if received - self.last_flush > self.flush_interval:
+            self.last_flush = received
+            try:
+                self.candle_builder.flush()
+            except Exception:
+                #the bars stay queued and are retried on the next run
+                logger.exception('Candle flush failed')
+            if tick_latency.enabled:
+                #quantize and cache are only measured here, the socket workers serve them from the file
+                try:
+                    replace_file(stats_path(), lambda f: json.dump(tick_latency.stats(), f))
+                except (IOError, OSError):
+                    logger.exception('Storing the feeder latency failed')
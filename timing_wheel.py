@@ -0,0 +1,78 @@
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel. Scheduling and cancelling are O(1), advancing costs
+    one slot per tick plus a cascade of the upper level slot every time a level wraps.
+    With the defaults a tick is a second and four levels of 64 slots cover ~194 days,
+    later deadlines are parked in the furthest slot and re-placed on cascade.
+    """
+
+    def __init__(self, start, tick=1, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.current = int(start // tick)
+        self.wheels = [[set() for i in range(slots)] for level in range(levels)]
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def schedule(self, key, deadline):
+        """
+        Schedules `key` to expire at `deadline` (same unit as `start`), replacing a previous schedule
+        """
+        self.cancel(key)
+        self._place(key, max(int(deadline // self.tick), self.current + 1))
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            expires, level, slot = entry
+            self.wheels[level][slot].discard(key)
+
+    def advance(self, now):
+        """
+        Moves the wheel to `now` and returns the keys that expired on the way
+        """
+        target = int(now // self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            #pull the upper level slots that start at this tick down to the lower levels
+            span = 1
+            for level in range(1, self.levels):
+                span *= self.slots
+                if self.current % span:
+                    break
+                self._cascade(level, (self.current // span) % self.slots)
+            bucket = self.wheels[0][self.current % self.slots]
+            for key in bucket:
+                del self.entries[key]
+            expired.extend(bucket)
+            bucket.clear()
+        return expired
+
+    def _place(self, key, expires):
+        span = 1
+        position = expires
+        for level in range(self.levels):
+            if expires // span - self.current // span < self.slots:
+                break
+            span *= self.slots
+        else:
+            #beyond the wheel horizon, park in the furthest slot of the top level
+            span //= self.slots
+            position = (self.current // span + self.slots - 1) * span
+        slot = (position // span) % self.slots
+        self.wheels[level][slot].add(key)
+        self.entries[key] = (expires, level, slot)
+
+    def _cascade(self, level, slot):
+        bucket = self.wheels[level][slot]
+        self.wheels[level][slot] = set()
+        for key in bucket:
+            expires = self.entries.pop(key)[0]
+            self._place(key, max(expires, self.current))
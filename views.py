@@ -1,19 +1,36 @@
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect
 from django.conf import settings
-from django.http import HttpResponse
-import mongoengine
-from mongoengine import Q
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+import numpy as np
 
 from models import Position
 from mongo_models import ChartHistory
+from chart_service import ChartService, Bars, columnar_payload
 from service import TradeService
+from db_router import replica_view
+from tick_latency import tick_latency
+from tick_ring import feeder_stats
 from forms import OpenPositionForm
 from accounts.service import AccountService
 
 from rest_framework.renderers import JSONRenderer
 
 
+#`period` request values
+PERIODS = {
+    'M1': ChartHistory.TYPE_M1,
+    'M5': ChartHistory.TYPE_M5,
+    'M15': ChartHistory.TYPE_M15,
+    'M30': ChartHistory.TYPE_M30,
+    'H1': ChartHistory.TYPE_H1,
+    'H4': ChartHistory.TYPE_H4,
+    'DAILY': ChartHistory.TYPE_DAILY,
+    'WEEKLY': ChartHistory.TYPE_WEEKLY,
+    'MONTHLY': ChartHistory.TYPE_MONTHLY,
+}
+
+
 @login_required
 def create_position(request):
     if request.method == 'POST':
@@ -32,6 +49,7 @@ def create_position(request):
     return render(request, 'positions/create_position.html', locals())
 
 @login_required
+@replica_view
 def positions_list(request):
     open_positions_list = AccountService(request.user).user_current_open_positions()
     closed_position_list = AccountService(request.user).user_history_by_positions()
@@ -44,25 +62,20 @@ def close_position(request, pk):
     return redirect('positions-list')
 
 
-def serialize_history(qs):
-    result = []
-    for obj in qs:
-        row = [
-            obj.date.strftime('%Y-%m-%d %H:%M'),
-            obj.open,
-            obj.high,
-            obj.low,
-            obj.close,
-            0
-        ]
-        result.append(row)
+def serialize_history(bars):
+    #newest bar first
+    bars = Bars(*[column[::-1] for column in bars])
+    rows = np.empty((len(bars.date), 6), dtype=object)
+    rows[:, 0] = np.char.replace(
+        np.datetime_as_string(bars.date.astype('datetime64[s]'), unit='m'), 'T', ' '
+    )
+    for column, values in enumerate(bars[1:], 1):
+        rows[:, column] = values
 
-    return JSONRenderer().render(result)
+    return JSONRenderer().render(rows.tolist())
 
 
 def chartiq(request):
-    mongoengine.connect(**settings.MONGO_DATABASES['chart_history'])
-
     context = {
         'data': [],
         'data_intraday': []
@@ -71,22 +84,67 @@ def chartiq(request):
     if request.GET.get('symbol'):
         symbol = request.GET.get('symbol', '')
         period = request.GET.get('period', 'DAILY')
-        type = getattr(ChartHistory, 'TYPE_%s' % period, ChartHistory.TYPE_DAILY)
+        if period not in PERIODS:
+            return HttpResponseBadRequest()
+        type = PERIODS[period]
 
         context['symbol'] = symbol
 
-        context['data'] = serialize_history(ChartHistory.objects.filter(
-            instrument=symbol,
-            type=ChartHistory.TYPE_DAILY
-        ).order_by('-date')[:100])
+        context['data'] = serialize_history(ChartService.get_bars(symbol, type))
 
-        context['data_intraday'] = serialize_history(ChartHistory.objects.filter(
-            instrument=symbol,
-            type=ChartHistory.TYPE_M1
-        ).order_by('-date')[:100])
+        context['data_intraday'] = serialize_history(ChartService.get_bars(symbol, ChartHistory.TYPE_M1))
 
         # Partials, now not used
         if request.is_ajax() and request.GET.get('period'):
-            return HttpResponse(data=context['data'], mimetype='application/json')
-
-    return render(request, 'trade/chartiq.html', context)
\ No newline at end of file
+            return chart_data(request)
+
+    return render(request, 'trade/chartiq.html', context)
+
+
+def chart_data(request):
+    """
+    Columnar chart history: `t0` epoch seconds of the first bar, `dt` deltas to the following
+    bars and parallel `o`/`h`/`l`/`c`/`v` arrays. `from`/`to` page through older ranges,
+    `since` returns only the bar open at that time and newer ones.
+    """
+    symbol = request.GET.get('symbol')
+    if not symbol:
+        return HttpResponseBadRequest()
+    period = request.GET.get('period', 'DAILY')
+    if period not in PERIODS:
+        return HttpResponseBadRequest()
+    type = PERIODS[period]
+
+    try:
+        params = dict(
+            (name, int(request.GET[name])) for name in ('from', 'to', 'since') if request.GET.get(name)
+        )
+        limit = max(1, min(int(request.GET.get('limit', 100)), getattr(settings, 'CHART_MAX_BARS', 5000)))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    bars = ChartService.get_bars(
+        symbol,
+        type,
+        limit=limit,
+        date_from=params.get('from'),
+        date_to=params.get('to'),
+        since=params.get('since')
+    )
+    result = columnar_payload(bars)
+    result.update({'symbol': symbol, 'period': period})
+    return HttpResponse(JSONRenderer().render(result), content_type='application/json')
+
+
+def tick_latency_stats(request):
+    """
+    Tick latency histograms of this socket server process per stage and instrument, in microseconds.
+    With the tick ring the stages measured in the price feeder of the host come from the feeder.
+    """
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'INTERNAL_IPS', ()) and not request.user.is_staff:
+        return HttpResponseForbidden()
+    stats = tick_latency.stats()
+    if getattr(settings, 'TICK_RING_ENABLED', False):
+        for stage, histograms in feeder_stats().items():
+            stats.setdefault(stage, histograms)
+    return HttpResponse(JSONRenderer().render(stats), content_type='application/json')